@@ -0,0 +1,462 @@
+##################################################################################
+# Description
+##################################################################################
+# This module is designed to simulate the makespan of a rocoto control flow
+# offline, before burning allocation.  The control flow xml is parsed with the
+# utilities in rocoto_utilities.py, including its entities, cycle groups and
+# task dependencies, and per-task run times, tries and queue waits are read from
+# the .store databases and workflow logs of past runs.  A discrete-event
+# simulation then predicts the campaign makespan and its critical path.  What-if
+# runs are defined by the total number of nodes, overridden entities such as
+# WPS_PROC (with run times scaled by Amdahl's law on the requested cores) and
+# by overlapping cycles up to the cycle throttle instead of chaining each cycle
+# to the boot task of the previous cycle.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+import os
+import math
+import heapq
+import glob
+from datetime import datetime as dt
+from datetime import timedelta
+from rocoto_utilities import (
+                              CSES, CTR_FLWS, CYC_FMT, get_workflow_paths,
+                              parse_workflow, get_task_cycles, expand_cyclestr,
+                              read_store_jobs,
+                             )
+
+##################################################################################
+# SET GLOBAL PARAMETERS
+##################################################################################
+# case study and control flow to simulate, defaulting to the first monitored
+CSE = CSES[0]
+CTR_FLW = CTR_FLWS[0]
+
+# past case-flow workflow databases / logs to read task durations and queue
+# waits from, defaulting to the simulated workflow
+HIST_FLWS = [(CSE, CTR_FLW)]
+
+# total number of nodes available to the workflow, None for unlimited
+N_NODES = None
+
+# what-if values of the control flow entities, e.g., {'WPS_PROC': '48'}
+ENTITIES = {}
+
+# run cycles concurrently up to the cycle throttle rather than chaining each
+# cycle to the boot task of the previous cycle
+OVERLAP = False
+
+# max number of concurrently active cycles, None for the control flow setting
+CYCLE_THROTTLE = None
+
+# task which releases the first tasks of the next cycle on completion
+BOOT_TASK = 'boot_next_cycle'
+
+# parallel fraction of task run times for Amdahl scaling of what-if core counts
+PAR_FRAC = 0.9
+
+# fraction of the walltime used as run time of tasks without history
+WC_FRAC = 0.5
+
+##################################################################################
+# UTILITY METHODS
+##################################################################################
+# converts [[dd:]hh:]mm:ss strings to seconds
+
+def to_seconds(wc_str):
+    fields = [int(x) for x in wc_str.split(':')]
+    fields = [0] * (4 - len(fields)) + fields
+
+    return ((fields[0] * 24 + fields[1]) * 60 + fields[2]) * 60 + fields[3]
+
+##################################################################################
+# returns the number of cores / nodes requested by a task
+
+def get_task_resources(task):
+    if task['nodes']:
+        # nodes of the form N:ppn=M+N:ppn=M
+        nodes = 0
+        cores = 0
+        for spec in task['nodes'].split('+'):
+            split_spec = spec.split(':ppn=')
+            nodes += int(split_spec[0])
+            cores += int(split_spec[0]) * int(split_spec[-1])
+
+    else:
+        cores = int(task['cores'] or 1)
+        nodesize = int(task['nodesize'] or cores)
+        nodes = int(math.ceil(cores / nodesize))
+
+    return cores, nodes
+
+##################################################################################
+# reads the median run time and mean number of tries of each task from the
+# succeeded jobs of the workflow databases
+
+def get_store_history(store_paths):
+    durations = {}
+    tries = {}
+    for store_path in store_paths:
+        for job in read_store_jobs(store_path):
+            if job.state == 'SUCCEEDED' and job.duration:
+                durations.setdefault(job.task, []).append(job.duration)
+                tries.setdefault(job.task, []).append(job.tries or 1)
+
+    durations = {task: sorted(vals)[len(vals) // 2]
+                 for task, vals in durations.items()}
+    tries = {task: sum(vals) / len(vals) for task, vals in tries.items()}
+
+    return durations, tries
+
+##################################################################################
+# reads the median queue wait of each task from the rocoto workflow logs, as
+# the time between the job first logged QUEUED and first logged RUNNING
+
+def get_log_waits(log_paths):
+    log_fmt = '%Y-%m-%d %H:%M:%S'
+    queued = {}
+    running = {}
+    for log_path in log_paths:
+        with open(log_path) as f:
+            for line in f:
+                split_line = line.split(' :: ')
+                if len(split_line) < 3 or\
+                        not split_line[2].startswith('Task '):
+                    continue
+
+                try:
+                    log_time = dt.strptime(split_line[0][:19], log_fmt)
+                    msg = split_line[2].split(',')
+                    task = msg[0].split()[1]
+                    job_id = msg[1].split('=')[1].strip()
+                    state = msg[2].split()[2]
+
+                except (IndexError, ValueError):
+                    continue
+
+                key = (task, job_id)
+                if state == 'QUEUED':
+                    queued.setdefault(key, log_time)
+
+                elif state == 'RUNNING':
+                    running.setdefault(key, log_time)
+
+    waits = {}
+    for key in queued:
+        if key in running:
+            wait = (running[key] - queued[key]).total_seconds()
+            waits.setdefault(key[0], []).append(max(0, wait))
+
+    return {task: sorted(vals)[len(vals) // 2] for task, vals in waits.items()}
+
+##################################################################################
+# evaluates a rocoto dependency element for the task instance on cycle, where
+# done is the set of completed (cycle, task) pairs, and returns None for the
+# dependencies that can never be satisfied by task completions
+
+def eval_dep(node, cycle, workflow, done, cycles, optimistic=False):
+    def offset(node):
+        sign = -1 if node.get('cycle_offset', '').startswith('-') else 1
+        off_str = node.get('cycle_offset', '0:0').lstrip('-')
+        return cycle + sign * timedelta(seconds=to_seconds(off_str))
+
+    children = [eval_dep(child, cycle, workflow, done, cycles, optimistic)
+                for child in node]
+
+    if node.tag in ['dependency', 'and']:
+        return all(children)
+
+    elif node.tag == 'or':
+        return any(children)
+
+    elif node.tag == 'not':
+        return not children[0]
+
+    elif node.tag == 'nand':
+        return not all(children)
+
+    elif node.tag == 'nor':
+        return not any(children)
+
+    elif node.tag == 'xor':
+        return sum(children) == 1
+
+    elif node.tag == 'some':
+        return sum(children) >= float(node.get('threshold', 1)) * len(children)
+
+    elif node.tag == 'taskdep':
+        # task failures are not simulated, so only SUCCEEDED is ever reached
+        if node.get('state', 'SUCCEEDED') != 'SUCCEEDED':
+            return False
+
+        return optimistic or (offset(node), node.get('task')) in done
+
+    elif node.tag == 'metataskdep':
+        names = workflow['metatasks'].get(node.get('metatask'), [])
+        return optimistic or all((offset(node), name) in done for name in names)
+
+    elif node.tag == 'cycleexistdep':
+        return offset(node) in cycles
+
+    # data / time dependencies are assumed satisfied in offline simulation
+    return True
+
+##################################################################################
+# simulates the workflow with the given task run times / queue waits / tries,
+# returning the makespan, critical path and task instance schedule
+
+def simulate(workflow, durations, waits=None, tries=None, n_nodes=None,
+             cyclethrottle=None, overlap=False, boot_task=BOOT_TASK,
+             base_workflow=None):
+    waits = waits or {}
+    tries = tries or {}
+    cyclethrottle = cyclethrottle or workflow['cyclethrottle']
+    base_tasks = {task['name']: task
+                  for task in (base_workflow or workflow)['tasks']}
+
+    # define the instances of each task on each cycle
+    instances = {}
+    cycle_tasks = {}
+    for task in workflow['tasks']:
+        name = task['name']
+        cores, nodes = get_task_resources(task)
+        if n_nodes and nodes > n_nodes:
+            raise ValueError('Task ' + name + ' requests ' + str(nodes) +\
+                             ' nodes, more than the ' + str(n_nodes) +\
+                             ' available.')
+
+        if name in durations:
+            # scale the historical run time to the what-if core count
+            base_cores, _ = get_task_resources(base_tasks.get(name, task))
+            run_time = durations[name] * (PAR_FRAC * base_cores / cores +\
+                                          1 - PAR_FRAC)
+
+        else:
+            run_time = WC_FRAC * to_seconds(task['walltime'] or '00:00:00')
+
+        n_tries = min(tries.get(name, 1), task['maxtries'])
+        dep = task['element'].find('dependency')
+        for cycle in get_task_cycles(workflow, task):
+            cycle_tasks.setdefault(cycle, []).append(name)
+            instances[(cycle, name)] = {
+                    'dep'      : dep,
+                    'nodes'    : nodes,
+                    'run_time' : n_tries * run_time,
+                    'wait'     : n_tries * waits.get(name, 0.0),
+                    'ready'    : None,
+                    'start'    : None,
+                    'end'      : None,
+                    'pred'     : None,
+                   }
+
+    cycles = sorted(cycle_tasks)
+    cycle_set = set(cycles)
+
+    # instances that can never be triggered by task completions are gated,
+    # released only when their cycle is booted
+    for (cycle, name), inst in instances.items():
+        inst['gated'] = inst['dep'] is not None and\
+                not eval_dep(inst['dep'], cycle, workflow, set(), cycle_set,
+                             optimistic=True)
+
+    chained = boot_task in [task['name'] for task in workflow['tasks']] and\
+            not overlap
+    booted = set(cycles[:1]) if chained else set(cycles)
+    active = []
+    activated = set()
+    n_activated = 0
+    done = set()
+    free_nodes = n_nodes
+    events = []
+    queue = []
+    seq = 0
+
+    def release(t, pred):
+        # activates the booted cycles, which rocotoboot activates regardless of
+        # the throttle, and the next cycles up to the throttle, then submits the
+        # ready instances
+        nonlocal n_activated, seq
+        if chained:
+            for cycle in sorted(booted - activated):
+                active.append(cycle)
+                activated.add(cycle)
+
+        while len(active) < cyclethrottle and n_activated < len(cycles):
+            cycle = cycles[n_activated]
+            n_activated += 1
+            if cycle not in activated:
+                active.append(cycle)
+                activated.add(cycle)
+
+        for cycle in active:
+            for name in cycle_tasks[cycle]:
+                inst = instances[(cycle, name)]
+                if inst['ready'] is not None:
+                    continue
+
+                if inst['gated']:
+                    ready = cycle in booted
+
+                else:
+                    ready = inst['dep'] is None or\
+                            eval_dep(inst['dep'], cycle, workflow, done,
+                                     cycle_set)
+
+                if ready:
+                    inst['ready'] = t
+                    inst['pred'] = pred
+                    seq += 1
+                    heapq.heappush(events, (t + inst['wait'], seq, 'eligible',
+                                            (cycle, name)))
+
+    def dispatch(t):
+        # starts the eligible instances in order while nodes are available
+        nonlocal free_nodes, seq
+        while queue:
+            key = queue[0]
+            inst = instances[key]
+            if free_nodes is not None and inst['nodes'] > free_nodes:
+                break
+
+            queue.pop(0)
+            if free_nodes is not None:
+                free_nodes -= inst['nodes']
+
+            inst['start'] = t
+            inst['end'] = t + inst['run_time']
+            seq += 1
+            heapq.heappush(events, (inst['end'], seq, 'end', key))
+
+    release(0.0, None)
+    t = 0.0
+    while events:
+        t, _, event, key = heapq.heappop(events)
+        if event == 'eligible':
+            queue.append(key)
+
+        else:
+            cycle, name = key
+            done.add(key)
+            if free_nodes is not None:
+                free_nodes += instances[key]['nodes']
+
+            if chained and name == boot_task:
+                indx = cycles.index(cycle)
+                if indx + 1 < len(cycles):
+                    booted.add(cycles[indx + 1])
+
+            if all((cycle, x) in done for x in cycle_tasks[cycle]):
+                active.remove(cycle)
+
+            release(t, key)
+
+        dispatch(t)
+
+    # trace the critical path back from the last instance to complete
+    finished = [key for key in instances if instances[key]['end'] is not None]
+    path = []
+    key = max(finished, key=lambda x: instances[x]['end']) if finished else None
+    while key is not None:
+        path.append(key)
+        key = instances[key]['pred']
+
+    return {
+            'makespan'   : t,
+            'path'       : path[::-1],
+            'instances'  : instances,
+            'unfinished' : sorted(set(instances) - done),
+           }
+
+##################################################################################
+# prints the simulated makespan and critical path
+
+def report(result):
+    print('Simulated makespan ' + '%.2f'%(result['makespan'] / 3600) + ' hours')
+    if result['unfinished']:
+        print('WARNING: ' + str(len(result['unfinished'])) + ' task instances'
+              ' never triggered, e.g., ' + result['unfinished'][0][1] + ' on ' +\
+              result['unfinished'][0][0].strftime(CYC_FMT))
+
+    print('Critical path:')
+    print('%12s    %-32s %10s %10s %10s'%('CYCLE', 'TASK', 'READY (h)',
+                                          'START (h)', 'END (h)'))
+    for (cycle, name) in result['path']:
+        inst = result['instances'][(cycle, name)]
+        print('%12s    %-32s %10.2f %10.2f %10.2f'%(cycle.strftime(CYC_FMT),
+              name, inst['ready'] / 3600, inst['start'] / 3600,
+              inst['end'] / 3600))
+
+##################################################################################
+# Execute the following lines as script
+##################################################################################
+
+if __name__ == '__main__':
+    xml_path, _, _ = get_workflow_paths(CSE, CTR_FLW)
+    base_workflow = parse_workflow(xml_path)
+    workflow = parse_workflow(xml_path, ENTITIES) if ENTITIES else base_workflow
+
+    # read the task history from the past databases and workflow logs
+    store_paths = []
+    log_paths = []
+    for (cse, ctr_flw) in HIST_FLWS:
+        hist_xml, hist_store, _ = get_workflow_paths(cse, ctr_flw)
+        if os.path.isfile(hist_store):
+            store_paths.append(hist_store)
+
+        hist_workflow = parse_workflow(hist_xml)
+        log_elem = hist_workflow['root'].find('log')
+        for cycle in sorted({cycle for task in hist_workflow['tasks']
+                             for cycle in get_task_cycles(hist_workflow, task)}):
+            log_paths += glob.glob(expand_cyclestr(log_elem, cycle))
+
+    durations, tries = get_store_history(store_paths)
+    waits = get_log_waits(log_paths)
+    print('Read run times of ' + str(len(durations)) + ' tasks and queue waits'
+          ' of ' + str(len(waits)) + ' tasks')
+
+    result = simulate(workflow, durations, waits, tries, n_nodes=N_NODES,
+                      cyclethrottle=CYCLE_THROTTLE, overlap=OVERLAP,
+                      base_workflow=base_workflow)
+    report(result)
+
+##################################################################################
+# end
@@ -50,8 +50,17 @@
 # Imports
 ##################################################################################
 import os
+import re
 import time
+import subprocess
+import copy
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+from datetime import timedelta, timezone
 
 ##################################################################################
 # SET GLOBAL PARAMETERS
@@ -74,6 +83,35 @@ CTR_FLWS = [
 
 END = dt(2024, 1, 1, 0)
 
+# max number of workflows to run rocoto commands for concurrently
+N_WORKERS = 8
+
+# timeout in seconds for a single rocoto command before it is killed
+CMD_TIMEOUT = 600
+
+# write status tables from the rocoto databases instead of calling rocotostat
+STAT_FROM_STORE = True
+
+# only rewrite the status tables of workflows that changed since the last pass
+STAT_INCREMENTAL = True
+
+# min / max seconds between polls of a workflow by the adaptive scheduler
+POLL_MIN = 30
+POLL_MAX = 600
+
+# factor by which the poll interval grows while a workflow is unchanged
+POLL_BACKOFF = 2
+
+# automatically rewind / boot DEAD and LOST tasks when polling workflows
+AUTO_RECOVER = True
+
+# max number of automatic recoveries of a single task of a cycle
+RECOVER_MAX = 3
+
+# base / max seconds of the exponential backoff before recovering a task
+RECOVER_BASE = 300
+RECOVER_CAP = 3600
+
 ##################################################################################
 # Derived paths
 ##################################################################################
@@ -83,6 +121,9 @@ settings_dir =  USR_HME + '/simulation_settings'
 # path to database
 dbs_dir = USR_HME + '/workflow_status'
 
+# path to log of automatic recovery actions
+recover_log = USR_HME + '/logs/rocoto_recovery.log'
+
 ##################################################################################
 # Rocoto utility commands
 ##################################################################################
@@ -159,15 +200,1141 @@ def run_rocotorewind(cses, flows, cycles, tasks):
         # update workflow statuses after loops
         run_rocotostat()
 
+##################################################################################
+# Concurrent rocoto drivers
+##################################################################################
+# The following commands run rocoto for all workflows at once through a bounded
+# pool of workers, each of which drives its own rocoto subprocess.  A pass over
+# every CSES x CTR_FLWS pair thus costs about as long as the slowest workflow
+# rather than the sum of all of them.  Every command is killed if it exceeds the
+# timeout, and a result is returned for each command of the form:
+#
+#    {
+#     'workflow' : 'DeepDive-2022122800_valid_date_ensemble',
+#     'cmd'      : 'rocotorun',
+#     'status'   : 0,
+#     'time'     : 12.3,
+#    }
+#
+# where status is the exit code of the command, or 'TIMEOUT' / 'ERROR' if the
+# command did not complete. The status table of each workflow is written to a
+# temporary file and moved into place, so that readers never see a partial file.
+#
+##################################################################################
+# lock to keep the output of concurrent commands from interleaving
+print_lock = threading.Lock()
+
+def get_workflow_paths(cse, ctr_flw):
+    # returns the control flow xml, database and status table paths of workflow
+    xml = settings_dir + '/' + cse + '/' + ctr_flw + '/ctr_flw.xml'
+    store = dbs_dir + '/' + cse + '-' + ctr_flw + '.store'
+    status = dbs_dir + '/' + cse + '-' + ctr_flw + '_workflow_status.txt'
+
+    return xml, store, status
+
+def get_rocoto_cmd(rocoto_exe, cse, ctr_flw, args=None):
+    # returns the argument list for a rocoto executable called on workflow
+    xml, store, _ = get_workflow_paths(cse, ctr_flw)
+    cmd = [RCT_HME + '/bin/' + rocoto_exe, '-w', xml, '-d', store]
+    if args:
+        cmd += args
+
+    return cmd
+
+def run_cmd(cmd, out_path=None, timeout=CMD_TIMEOUT):
+    # runs command, writing its output to out_path if given, or else printing
+    # its output once complete, and returns the exit status and wall time
+    t0 = time.time()
+    tmp_path = None
+    try:
+        if out_path:
+            tmp_path = out_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                proc = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE,
+                                      text=True, timeout=timeout)
+            if proc.returncode == 0:
+                os.replace(tmp_path, out_path)
+
+        else:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, text=True,
+                                  timeout=timeout)
+
+        status = proc.returncode
+        output = proc.stderr if out_path else proc.stdout
+
+    except subprocess.TimeoutExpired:
+        status = 'TIMEOUT'
+        output = 'ERROR: ' + ' '.join(cmd) + ' timed out after ' +\
+                 str(timeout) + ' seconds.\n'
+
+    except OSError as err:
+        status = 'ERROR'
+        output = 'ERROR: ' + ' '.join(cmd) + ' failed with ' + str(err) + '\n'
+
+    if tmp_path and os.path.isfile(tmp_path):
+        # clean up the partial output of a failed command
+        os.remove(tmp_path)
+
+    if output:
+        with print_lock:
+            print(output, end='', flush=True)
+
+    return status, time.time() - t0
+
+def run_workflow_cmds(cse, ctr_flw, rocoto_exes, timeout=CMD_TIMEOUT,
+                      force=False):
+    # runs the rocoto executables in sequence on a single workflow, skipping
+    # the status refresh of unchanged workflows unless forced
+    _, _, status_path = get_workflow_paths(cse, ctr_flw)
+    results = []
+    for rocoto_exe in rocoto_exes:
+        if rocoto_exe == 'rocotostat':
+            t0 = time.time()
+            signature = None
+            if STAT_INCREMENTAL:
+                changed, signature = check_status_changed(cse, ctr_flw)
+                if not changed and not force:
+                    results.append({
+                                    'workflow' : cse + '-' + ctr_flw,
+                                    'cmd'      : rocoto_exe,
+                                    'status'   : 'SKIPPED',
+                                    'time'     : time.time() - t0,
+                                   })
+                    continue
+
+        if rocoto_exe == 'rocotorun':
+            cmd = get_rocoto_cmd(rocoto_exe, cse, ctr_flw, ['-v', '10'])
+            out_path = None
+
+        elif rocoto_exe == 'rocotostat' and STAT_FROM_STORE:
+            # read the database directly, falling back to rocotostat on failure
+            try:
+                write_status_from_store(cse, ctr_flw)
+                if signature:
+                    stat_signatures[(cse, ctr_flw)] = signature
+
+                results.append({
+                                'workflow' : cse + '-' + ctr_flw,
+                                'cmd'      : 'storestat',
+                                'status'   : 0,
+                                'time'     : time.time() - t0,
+                               })
+                continue
+
+            except (OSError, sqlite3.Error, ET.ParseError, ValueError) as err:
+                with print_lock:
+                    print('WARNING: reading ' + cse + '-' + ctr_flw +\
+                          ' database failed with ' + str(err) +\
+                          ', falling back to rocotostat')
+
+            cmd = get_rocoto_cmd(rocoto_exe, cse, ctr_flw, ['-c', 'all'])
+            out_path = status_path
+
+        elif rocoto_exe == 'rocotostat':
+            cmd = get_rocoto_cmd(rocoto_exe, cse, ctr_flw, ['-c', 'all'])
+            out_path = status_path
+
+        else:
+            raise ValueError('Unsupported rocoto command ' + rocoto_exe)
+
+        status, ellapsed = run_cmd(cmd, out_path=out_path, timeout=timeout)
+        if rocoto_exe == 'rocotostat' and status == 0 and signature:
+            stat_signatures[(cse, ctr_flw)] = signature
+
+        results.append({
+                        'workflow' : cse + '-' + ctr_flw,
+                        'cmd'      : rocoto_exe,
+                        'status'   : status,
+                        'time'     : ellapsed,
+                       })
+
+    return results
+
+def run_concurrent(func, args_list, n_workers=N_WORKERS):
+    # maps func over the argument tuples in the bounded worker pool, returning
+    # the concatenated result lists in the order of args_list
+    if not args_list:
+        return []
+
+    n_workers = max(1, min(n_workers, len(args_list)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(func, *args) for args in args_list]
+        results = []
+        for future in futures:
+            results += future.result()
+
+    return results
+
+def report_results(results, ellapsed):
+    # prints the exit status and timing of each command in the pass
+    print('Rocoto pass completed in ' + '%.1f'%ellapsed + ' seconds:')
+    for res in results:
+        print('    ' + res['workflow'] + ' ' + res['cmd'] + ' status ' +\
+              str(res['status']) + ' in ' + '%.1f'%res['time'] + ' seconds')
+
+    failed = [res for res in results if res['status'] not in [0, 'SKIPPED']]
+    if failed:
+        print('WARNING: ' + str(len(failed)) + ' rocoto commands failed.')
+
+    # count the status refreshes made / skipped in this pass
+    stat_counters['refreshed'] = len([res for res in results
+                                      if res['cmd'] != 'rocotorun' and
+                                      res['status'] == 0])
+    stat_counters['skipped'] = len([res for res in results
+                                    if res['status'] == 'SKIPPED'])
+    if stat_counters['skipped']:
+        print('Skipped ' + str(stat_counters['skipped']) + ' of ' +\
+              str(stat_counters['skipped'] + stat_counters['refreshed']) +\
+              ' workflow status refreshes as unchanged')
+
+def run_rocotorun_concurrent(cses=None, flows=None, n_workers=N_WORKERS,
+                             timeout=CMD_TIMEOUT):
+    # advances every workflow and then refreshes its status table, running all
+    # workflows at once
+    cses = CSES if cses is None else cses
+    flows = CTR_FLWS if flows is None else flows
+    t0 = time.time()
+    args_list = [(cse, ctr_flw, ['rocotorun', 'rocotostat'], timeout)
+                 for cse in cses for ctr_flw in flows]
+
+    results = run_concurrent(run_workflow_cmds, args_list, n_workers)
+    report_results(results, time.time() - t0)
+
+    return results
+
+def run_rocotostat_concurrent(cses=None, flows=None, n_workers=N_WORKERS,
+                              timeout=CMD_TIMEOUT, force=False):
+    # refreshes the status table of every workflow, running all workflows at once
+    cses = CSES if cses is None else cses
+    flows = CTR_FLWS if flows is None else flows
+    t0 = time.time()
+    args_list = [(cse, ctr_flw, ['rocotostat'], timeout, force)
+                 for cse in cses for ctr_flw in flows]
+
+    results = run_concurrent(run_workflow_cmds, args_list, n_workers)
+    report_results(results, time.time() - t0)
+
+    return results
+
+##################################################################################
+# Change-driven status refresh
+##################################################################################
+# The following methods decide whether the status table of a workflow must be
+# rewritten.  A workflow is unchanged if the modification time and size of its
+# database and control flow are the same as at the last refresh.  As rocotorun
+# writes its lock to the database on every call, a workflow whose files changed
+# is also compared by a hash of its job states / tries / ids, cycle completion
+# and number of tasks, and the table is only rewritten if these have changed.
+# The number of refreshes made and skipped in the last pass are kept in
+# stat_counters.
+#
+##################################################################################
+# signatures of the workflows at their last status refresh
+stat_signatures = {}
+
+# number of status refreshes made / skipped in the last pass
+stat_counters = {'refreshed': 0, 'skipped': 0}
+
+def get_file_signature(cse, ctr_flw):
+    # returns the modification times and sizes of the workflow database / xml
+    signature = []
+    for path in get_workflow_paths(cse, ctr_flw)[:2]:
+        try:
+            f_stat = os.stat(path)
+            signature += [f_stat.st_mtime_ns, f_stat.st_size]
+
+        except OSError:
+            signature += [None, None]
+
+    return tuple(signature)
+
+def get_content_signature(cse, ctr_flw):
+    # returns a hash of the job / cycle states and number of tasks of workflow
+    xml_path, store_path, _ = get_workflow_paths(cse, ctr_flw)
+    with open_store(store_path) as con:
+        jobs = con.execute('SELECT id, jobid, state, tries FROM jobs'
+                           ' ORDER BY id').fetchall()
+        cycles = con.execute('SELECT cycle, done FROM cycles'
+                             ' ORDER BY cycle').fetchall()
+    con.close()
+    n_tasks = len(parse_workflow(xml_path)['tasks'])
+
+    return hash((tuple(jobs), tuple(cycles), n_tasks))
+
+def check_status_changed(cse, ctr_flw):
+    # returns whether the workflow changed since its last status refresh, and
+    # its current signature to record once the refresh succeeds
+    _, _, status_path = get_workflow_paths(cse, ctr_flw)
+    file_sig = get_file_signature(cse, ctr_flw)
+    prev = stat_signatures.get((cse, ctr_flw))
+    has_status = os.path.isfile(status_path)
+    if prev is not None and has_status and prev['file'] == file_sig:
+        return False, prev
+
+    try:
+        content_sig = get_content_signature(cse, ctr_flw)
+
+    except (OSError, sqlite3.Error, ET.ParseError, ValueError):
+        # refresh with rocotostat, which reports any errors, if not readable
+        return True, None
+
+    signature = {'file': file_sig, 'content': content_sig}
+    if prev is None or not has_status:
+        return True, signature
+
+    if prev['content'] == content_sig:
+        stat_signatures[(cse, ctr_flw)] = signature
+        return False, signature
+
+    return True, signature
+
+##################################################################################
+# Rocoto database and control flow readers
+##################################################################################
+# The following methods read the workflow state directly from the rocoto .store
+# SQLite database under dbs_dir, and the task / cycle definitions directly from
+# the control flow xml, without calling rocotostat.  The database is opened
+# read-only, and its jobs and cycles tables are returned as typed records:
+#
+#    JobRecord(cycle, task, job_id, state, native_state, exit_status, tries,
+#              nunknowns, duration, cores)
+#    CycleRecord(cycle, activated, expired, done)
+#
+# where cycle times are naive UTC datetimes and unset cycle times are None.
+# The control flow is parsed with its entities expanded and its metatasks
+# unrolled, with the parsed result cached until the xml file is modified.  The
+# status table written by write_status_from_store reproduces the columns of
+# 'rocotostat -c all', including rows for tasks that have not been submitted.
+#
+##################################################################################
+# rocoto cycle string format
+CYC_FMT = '%Y%m%d%H%M'
+
+JobRecord = namedtuple('JobRecord', [
+                                     'cycle', 'task', 'job_id', 'state',
+                                     'native_state', 'exit_status', 'tries',
+                                     'nunknowns', 'duration', 'cores',
+                                    ])
+
+CycleRecord = namedtuple('CycleRecord', ['cycle', 'activated', 'expired', 'done'])
+
+# parsed control flows keyed by xml path, storing the mtime at parse time
+workflow_cache = {}
+
+def from_epoch(seconds):
+    # converts a rocoto database time stamp to a naive UTC datetime, or None
+    if not seconds:
+        return None
+
+    return dt.fromtimestamp(int(seconds), timezone.utc).replace(tzinfo=None)
+
+def open_store(store_path, timeout=30):
+    # opens the rocoto database read-only, waiting on rocoto's lock if needed
+    if not os.path.isfile(store_path):
+        raise FileNotFoundError('Rocoto database ' + store_path +\
+                                ' does not exist.')
+
+    return sqlite3.connect('file:' + store_path + '?mode=ro', uri=True,
+                           timeout=timeout)
+
+def read_store_jobs(store_path):
+    # returns the job records of the rocoto database, ordered by cycle and id
+    with open_store(store_path) as con:
+        rows = con.execute('SELECT cycle, taskname, jobid, state, native_state,'
+                           ' exit_status, tries, nunknowns, duration, cores'
+                           ' FROM jobs ORDER BY cycle, id').fetchall()
+    con.close()
+
+    return [JobRecord(from_epoch(row[0]), *row[1:]) for row in rows]
+
+def read_store_cycles(store_path):
+    # returns the cycle records of the rocoto database, ordered by cycle
+    with open_store(store_path) as con:
+        rows = con.execute('SELECT cycle, activated, expired, done FROM cycles'
+                           ' ORDER BY cycle').fetchall()
+    con.close()
+
+    return [CycleRecord(*[from_epoch(x) for x in row]) for row in rows]
+
+def read_store(cse, ctr_flw):
+    # returns the cycle and job records of the workflow database
+    _, store_path, _ = get_workflow_paths(cse, ctr_flw)
+
+    return read_store_cycles(store_path), read_store_jobs(store_path)
+
+def store_to_dataframe(records):
+    # converts a list of records to a pandas DataFrame, importing pandas only
+    # when needed as it is not otherwise required by this module
+    import pandas as pd
+
+    return pd.DataFrame.from_records(records, columns=records[0]._fields
+                                     if records else JobRecord._fields)
+
+def substitute_vars(elem, var_dict):
+    # replaces metatask #var# strings in the text and attributes of element
+    for node in elem.iter():
+        for name, value in var_dict.items():
+            key = '#' + name + '#'
+            if node.text:
+                node.text = node.text.replace(key, value)
+
+            if node.tail:
+                node.tail = node.tail.replace(key, value)
+
+            for attr in node.attrib:
+                node.attrib[attr] = node.attrib[attr].replace(key, value)
+
+def expand_tasks(parent, metatask=None):
+    # unrolls the tasks and nested metatasks below parent in document order,
+    # returning task elements paired with their outer-most metatask name
+    tasks = []
+    for child in parent:
+        if child.tag == 'task':
+            tasks.append((child, metatask))
+
+        elif child.tag == 'metatask':
+            name = child.get('name')
+            var_vals = {var.get('name'): (var.text or '').split()
+                        for var in child.findall('var')}
+            n_vals = len(next(iter(var_vals.values()))) if var_vals else 0
+            for i in range(n_vals):
+                var_dict = {key: vals[i] for key, vals in var_vals.items()}
+                for grandchild in child:
+                    if grandchild.tag in ['task', 'metatask']:
+                        grandchild = copy.deepcopy(grandchild)
+                        substitute_vars(grandchild, var_dict)
+                        wrapper = ET.Element('wrapper')
+                        wrapper.append(grandchild)
+                        tasks += expand_tasks(wrapper, metatask or name)
+
+    return tasks
+
+def parse_cycledef(spec):
+    # returns the cycle datetimes of a 'start end interval' cycledef string,
+    # with interval given as [[dd:]hh:]mm:ss, crontab style cycledefs are not
+    # supported
+    split_spec = spec.split()
+    if len(split_spec) != 3:
+        raise ValueError('Unsupported cycledef ' + spec)
+
+    start = dt.strptime(split_spec[0], CYC_FMT)
+    end = dt.strptime(split_spec[1], CYC_FMT)
+    fields = [int(x) for x in split_spec[2].split(':')]
+    fields = [0] * (4 - len(fields)) + fields
+    interval = timedelta(days=fields[0], hours=fields[1], minutes=fields[2],
+                         seconds=fields[3])
+
+    cycles = []
+    cycle = start
+    while cycle <= end:
+        cycles.append(cycle)
+        if interval.total_seconds() == 0:
+            break
+
+        cycle += interval
+
+    return cycles
+
+def parse_workflow(xml_path, entities=None):
+    # parses the control flow into its cycle groups and unrolled tasks of the
+    # form {'cyclethrottle': int, 'cycledefs': {group: [cycles]},
+    # 'tasks': [task dicts], 'metatasks': {name: [task names]}, 'root': root},
+    # where entities optionally overrides the values of the xml entities
+    mtime = os.path.getmtime(xml_path)
+    if not entities and xml_path in workflow_cache and\
+            workflow_cache[xml_path][0] == mtime:
+        return workflow_cache[xml_path][1]
+
+    if entities:
+        with open(xml_path) as f:
+            xml_text = f.read()
+
+        for name, value in entities.items():
+            pattern = r'(<!ENTITY\s+' + re.escape(name) + r'\s+")[^"]*(")'
+            if not re.search(pattern, xml_text):
+                raise ValueError('Entity ' + name + ' is not defined in ' +\
+                                 xml_path)
+
+            xml_text = re.sub(pattern, lambda m: m.group(1) + str(value) +\
+                              m.group(2), xml_text)
+
+        root = ET.fromstring(xml_text)
+
+    else:
+        root = ET.parse(xml_path).getroot()
+
+    cycledefs = {}
+    for cycledef in root.findall('cycledef'):
+        group = cycledef.get('group', '')
+        cycledefs.setdefault(group, [])
+        cycledefs[group] += parse_cycledef(cycledef.text)
+
+    tasks = []
+    metatasks = {}
+    for elem, metatask in expand_tasks(root):
+        groups = elem.get('cycledefs')
+        task = {
+                'name'      : elem.get('name'),
+                'cycledefs' : groups.split(',') if groups else None,
+                'maxtries'  : int(elem.get('maxtries', 1)),
+                'metatask'  : metatask,
+                'element'   : elem,
+               }
+
+        for key in ['cores', 'nodes', 'nodesize', 'walltime']:
+            node = elem.find(key)
+            task[key] = node.text.strip() if node is not None and\
+                    node.text else None
+
+        tasks.append(task)
+        if metatask:
+            metatasks.setdefault(metatask, []).append(task['name'])
+
+    workflow = {
+                'cyclethrottle' : int(root.get('cyclethrottle', 1)),
+                'cycledefs'     : cycledefs,
+                'tasks'         : tasks,
+                'metatasks'     : metatasks,
+                'root'          : root,
+               }
+    if not entities:
+        workflow_cache[xml_path] = (mtime, workflow)
+
+    return workflow
+
+def expand_cyclestr(elem, cycle):
+    # returns the text of element with its cyclestr children expanded for cycle
+    if elem is None:
+        return None
+
+    text = elem.text or ''
+    for child in elem:
+        if child.tag == 'cyclestr':
+            child_cycle = cycle
+            offset = child.get('offset')
+            if offset:
+                sign = -1 if offset.startswith('-') else 1
+                fields = [int(x) for x in offset.lstrip('-').split(':')]
+                fields = [0] * (4 - len(fields)) + fields
+                child_cycle += sign * timedelta(days=fields[0],
+                                                hours=fields[1],
+                                                minutes=fields[2],
+                                                seconds=fields[3])
+
+            child_text = child.text or ''
+            for key in ['Y', 'm', 'd', 'H', 'M', 'S']:
+                child_text = child_text.replace('@' + key,
+                                                child_cycle.strftime('%' + key))
+            text += child_text
+
+        text += child.tail or ''
+
+    return text.strip()
+
+def get_task_cycles(workflow, task):
+    # returns the sorted cycles over which task is defined
+    groups = task['cycledefs'] or workflow['cycledefs'].keys()
+    cycles = set()
+    for group in groups:
+        cycles.update(workflow['cycledefs'].get(group, []))
+
+    return sorted(cycles)
+
+def format_status_row(cycle, task, job=None):
+    # formats a single row of the status table in the rocotostat layout
+    fmt = '%12s    %-32s %20s %16s %12s %8s %12s\n'
+    if job is None:
+        return fmt%(cycle.strftime(CYC_FMT), task, '-', '-', '-', '-', '-')
+
+    return fmt%(
+                cycle.strftime(CYC_FMT), task,
+                job.job_id if job.job_id is not None else '-',
+                job.state,
+                job.exit_status if job.exit_status is not None else '-',
+                job.tries if job.tries is not None else '-',
+                '%.1f'%job.duration if job.duration is not None else '-',
+               )
+
+def write_status_from_store(cse, ctr_flw):
+    # writes the status table of workflow from its database and control flow,
+    # with the same columns and rows as 'rocotostat -c all'
+    xml_path, store_path, status_path = get_workflow_paths(cse, ctr_flw)
+    workflow = parse_workflow(xml_path)
+    cycles, jobs = read_store(cse, ctr_flw)
+    jobs = {(job.cycle, job.task): job for job in jobs}
+
+    # list the tasks defined on each cycle in control flow order
+    cycle_tasks = {cycle.cycle: [] for cycle in cycles}
+    for task in workflow['tasks']:
+        for cycle in get_task_cycles(workflow, task):
+            cycle_tasks.setdefault(cycle, []).append(task['name'])
+
+    # tasks in the database that are no longer in the control flow are kept
+    for (cycle, task) in jobs:
+        tasks = cycle_tasks.setdefault(cycle, [])
+        if task not in tasks:
+            tasks.append(task)
+
+    tmp_path = status_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('%12s    %-32s %20s %16s %12s %8s %12s\n'%(
+                'CYCLE', 'TASK', 'JOBID', 'STATE', 'EXIT STATUS', 'TRIES',
+                'DURATION'))
+        f.write('=' * 124 + '\n')
+        for cycle in sorted(cycle_tasks):
+            for task in cycle_tasks[cycle]:
+                f.write(format_status_row(cycle, task, jobs.get((cycle, task))))
+
+    os.replace(tmp_path, status_path)
+
+##################################################################################
+# Batched rocoto boot / rewind
+##################################################################################
+# The following commands collapse the case x flow x cycle x task loops of the
+# boot and rewind commands above into a single rocoto invocation per workflow,
+# using the comma separated cycle / task lists and the metatask selector of the
+# native rocoto commands.  The grouped calls are run concurrently across
+# workflows, the status tables are refreshed once at the end, and a result is
+# returned for each task (or metatask) of the form:
+#
+#    {
+#     'workflow'    : 'DeepDive-3denvar_test_run',
+#     'cycle'       : '201902081800',
+#     'task'        : 'ungrib_ens_00',
+#     'status'      : 0,
+#     'time'        : 3.2,
+#     'job_id'      : '123456',
+#     'state'       : 'QUEUED',
+#    }
+#
+# where status is the exit status of the grouped command and job_id / state
+# are read from the refreshed status table, or None if the task is not listed.
+# One can, e.g., boot all ensemble ungrib tasks over several cycles with:
+#
+#    run_rocotoboot_batch(
+#                         ['DeepDive'],
+#                         ['3denvar_test_run'],
+#                         ['201902081800', '201902090000'],
+#                         ['ungrib_ens_' + str(i).zfill(2) for i in range(21)]
+#                        )
+#
+##################################################################################
+
+def read_status_file(cse, ctr_flw):
+    # parses the rocotostat table of workflow into a dictionary keyed by
+    # (cycle, task), returning an empty dictionary if the table doesn't exist
+    _, _, status_path = get_workflow_paths(cse, ctr_flw)
+    status = {}
+    if not os.path.isfile(status_path):
+        return status
+
+    with open(status_path) as f:
+        for line in f:
+            split_line = line.split()
+            if len(split_line) < 7 or not split_line[0].isdigit():
+                # skip header and malformed lines
+                continue
+
+            cycle, task, job_id, state, exit_status, tries, duration = \
+                    split_line[:7]
+            status[(cycle, task)] = {
+                                     'job_id'      : job_id,
+                                     'state'       : state,
+                                     'exit_status' : exit_status,
+                                     'tries'       : tries,
+                                     'duration'    : duration,
+                                    }
+
+    return status
+
+def run_batch_cmd(rocoto_exe, cse, ctr_flw, cycles, tasks, metatasks,
+                  timeout=CMD_TIMEOUT):
+    # runs a single grouped rocoto boot / rewind command on workflow
+    args = ['-c', ','.join(cycles)]
+    if tasks:
+        args += ['-t', ','.join(tasks)]
+
+    if metatasks:
+        args += ['-m', ','.join(metatasks)]
+
+    cmd = get_rocoto_cmd(rocoto_exe, cse, ctr_flw, args)
+    status, ellapsed = run_cmd(cmd, timeout=timeout)
+    results = []
+    for cycle in cycles:
+        for task in list(tasks or []) + list(metatasks or []):
+            results.append({
+                            'workflow' : cse + '-' + ctr_flw,
+                            'cycle'    : cycle,
+                            'task'     : task,
+                            'status'   : status,
+                            'time'     : ellapsed,
+                           })
+
+    return results
+
+def run_rocoto_batch(rocoto_exe, cses, flows, cycles, tasks=None, metatasks=None,
+                     n_workers=N_WORKERS, timeout=CMD_TIMEOUT):
+    # runs the grouped rocoto command on every workflow, then refreshes the
+    # workflow statuses once and attaches the new task states to the results
+    if not tasks and not metatasks:
+        raise ValueError('At least one task or metatask must be specified.')
+
+    t0 = time.time()
+    args_list = [(rocoto_exe, cse, ctr_flw, cycles, tasks, metatasks, timeout)
+                 for cse in cses for ctr_flw in flows]
+
+    results = run_concurrent(run_batch_cmd, args_list, n_workers)
+    print(rocoto_exe + ' batch completed in ' + '%.1f'%(time.time() - t0) +\
+          ' seconds')
+
+    # update workflow statuses after all grouped calls
+    run_rocotostat_concurrent(cses, flows, n_workers, timeout)
+    statuses = {}
+    for cse in cses:
+        for ctr_flw in flows:
+            statuses[cse + '-' + ctr_flw] = read_status_file(cse, ctr_flw)
+
+    for res in results:
+        task_stat = statuses[res['workflow']].get((res['cycle'], res['task']))
+        res['job_id'] = task_stat['job_id'] if task_stat else None
+        res['state'] = task_stat['state'] if task_stat else None
+
+    return results
+
+def run_rocotoboot_batch(cses, flows, cycles, tasks=None, metatasks=None,
+                         n_workers=N_WORKERS, timeout=CMD_TIMEOUT):
+    # boots the tasks / metatasks over all cycles with one call per workflow
+    return run_rocoto_batch('rocotoboot', cses, flows, cycles, tasks,
+                            metatasks, n_workers, timeout)
+
+def run_rocotorewind_batch(cses, flows, cycles, tasks=None, metatasks=None,
+                           n_workers=N_WORKERS, timeout=CMD_TIMEOUT):
+    # rewinds the tasks / metatasks over all cycles with one call per workflow
+    return run_rocoto_batch('rocotorewind', cses, flows, cycles, tasks,
+                            metatasks, n_workers, timeout)
+
+##################################################################################
+# Workflow status index
+##################################################################################
+# The following methods keep a keyed index of the task states of workflows,
+# read directly from the rocoto database and control flow, of the form:
+#
+#    status_index[(cse, ctr_flw, cycle, task)] = StatusRecord(state, job_id,
+#                                                             timestamp)
+#
+# where cycle is the rocoto cycle string, e.g., '201902081800', state / job_id
+# are None for tasks that have not been submitted and timestamp is the time the
+# current state was first observed.  One can query the index, or wait for a
+# task to reach a state, which returns as soon as the state is observed, e.g.,
+#
+#    boot_next_cycle('DeepDive', '3denvar_test_run', '201902081800')
+#
+# boots the first task of the cycle and returns its record once it is queued.
+#
+##################################################################################
+StatusRecord = namedtuple('StatusRecord', ['state', 'job_id', 'timestamp'])
+
+# states of a task once it has been accepted by the scheduler
+BOOTED_STATES = ['QUEUED', 'RUNNING', 'SUCCEEDED', 'FAILED', 'DEAD']
+
+status_index = {}
+
+def update_status_index(cse, ctr_flw):
+    # refreshes the index entries of workflow from its database and control flow
+    xml_path, store_path, _ = get_workflow_paths(cse, ctr_flw)
+    workflow = parse_workflow(xml_path)
+    jobs = {(job.cycle, job.task): job for job in read_store_jobs(store_path)}
+    keys = set(jobs)
+    for task in workflow['tasks']:
+        keys.update((cycle, task['name'])
+                    for cycle in get_task_cycles(workflow, task))
+
+    now = time.time()
+    for (cycle, task) in keys:
+        job = jobs.get((cycle, task))
+        state = job.state if job else None
+        job_id = job.job_id if job else None
+        key = (cse, ctr_flw, cycle.strftime(CYC_FMT), task)
+        record = status_index.get(key)
+        if record is None or (record.state, record.job_id) != (state, job_id):
+            status_index[key] = StatusRecord(state, job_id, now)
+
+def query_status(cse, ctr_flw, cycle=None, task=None, states=None):
+    # returns the index entries of workflow, optionally restricted to a cycle,
+    # task and / or list of states
+    return {key: record for key, record in status_index.items()
+            if key[:2] == (cse, ctr_flw) and
+            (cycle is None or key[2] == cycle) and
+            (task is None or key[3] == task) and
+            (states is None or record.state in states)}
+
+def get_first_task(cse, ctr_flw, cycle):
+    # returns the first task of the control flow defined on cycle, or None
+    xml_path, _, _ = get_workflow_paths(cse, ctr_flw)
+    workflow = parse_workflow(xml_path)
+    cycle_dt = dt.strptime(cycle, CYC_FMT)
+    for task in workflow['tasks']:
+        if cycle_dt in get_task_cycles(workflow, task):
+            return task['name']
+
+    return None
+
+def wait_for_state(cse, ctr_flw, cycle, task, states=BOOTED_STATES,
+                   timeout=2 * POLL_MAX, interval=POLL_MIN):
+    # advances the workflow with rocotorun and polls its database until the
+    # task reaches one of the states, returning its record, or None if the
+    # timeout is reached first, where the database leaves SUBMITTING only once
+    # rocotorun collects the job id, so that the timeout by default outlasts
+    # the longest poll interval of the scheduler
+    t0 = time.time()
+    while True:
+        run_workflow_cmds(cse, ctr_flw, ['rocotorun'])
+        update_status_index(cse, ctr_flw)
+        record = status_index.get((cse, ctr_flw, cycle, task))
+        if record is not None and record.state in states:
+            return record
+
+        if time.time() - t0 >= timeout:
+            return None
+
+        time.sleep(min(interval, max(0, timeout - (time.time() - t0))))
+
+def boot_next_cycle(cse, ctr_flw, cycle, timeout=2 * POLL_MAX):
+    # boots the first task of cycle and waits for it to be queued, returning
+    # its record or None if it did not update within the timeout
+    task = get_first_task(cse, ctr_flw, cycle)
+    if task is None:
+        print('ERROR: no task of ' + cse + '-' + ctr_flw +\
+              ' is defined on cycle ' + cycle)
+        return None
+
+    run_rocotoboot_batch([cse], [ctr_flw], [cycle], [task])
+    record = wait_for_state(cse, ctr_flw, cycle, task, timeout=timeout)
+    if record is None:
+        print('ERROR: task ' + task + ' did not update.')
+
+    else:
+        print('Task ' + task + ' booted for cycle ' + cycle + ' with job id:')
+        print(record.job_id)
+
+    return record
+
+##################################################################################
+# Automatic failure recovery
+##################################################################################
+# The following methods detect DEAD / LOST tasks in the workflow databases and
+# recover them by rewinding and booting them with rocoto.  The failure of each
+# task is classified from the tail of its job log, given by the join / stderr
+# of the task in the control flow, by the patterns in FAILURE_CLASSES below.
+# Failures of the classes in RECOVER_CLASSES are recovered after an exponential
+# backoff of RECOVER_BASE * 2**attempts seconds, capped at RECOVER_CAP, up to
+# RECOVER_MAX times for each task of a cycle, while other failures are left for
+# the user to inspect.  Every action is written to the recover_log.
+#
+##################################################################################
+# failure classes and the job log patterns identifying them, in order of
+# precedence
+FAILURE_CLASSES = [
+                   ('walltime',   r'DUE TO TIME LIMIT|TIMEOUT|time limit'),
+                   ('node_fail',  r'NODE_FAIL|NODE FAIL|node failure'),
+                   ('oom',        r'oom-kill|OUT_OF_MEMORY|Out of memory'),
+                   ('filesystem', r'No space left|Disk quota exceeded|'
+                                  r'Stale file handle|Input/output error'),
+                   ('mpi',        r'MPI_ABORT|BAD TERMINATION|mpirun noticed'),
+                   ('crash',      r'Segmentation fault|SIGSEGV|Bus error'),
+                   ('cancelled',  r'CANCELLED'),
+                  ]
+
+# failure classes which are considered transient and recovered automatically
+RECOVER_CLASSES = ['walltime', 'node_fail', 'filesystem', 'mpi', 'lost',
+                   'unknown']
+
+# failure states of jobs recovered by the engine
+FAILED_STATES = ['DEAD', 'LOST']
+
+# recovery state of each (cse, ctr_flw, cycle, task) failure
+recover_states = {}
+
+def log_recovery(msg):
+    # prints and appends a time stamped message to the recovery log
+    line = dt.now().strftime('%Y-%m-%d %H:%M:%S') + ' :: ' + msg
+    with print_lock:
+        print(line, flush=True)
+        with open(recover_log, 'a') as f:
+            f.write(line + '\n')
+
+def read_log_tail(log_path, n_bytes=65536):
+    # returns the last n_bytes of the job log, or an empty string if unreadable
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - n_bytes))
+            return f.read().decode(errors='replace')
+
+    except (OSError, TypeError):
+        return ''
+
+def classify_failure(job, log_tail):
+    # returns the failure class of a job from its state and log tail
+    if job.state == 'LOST':
+        return 'lost'
+
+    for failure, pattern in FAILURE_CLASSES:
+        if re.search(pattern, log_tail):
+            return failure
+
+    return 'unknown'
+
+def get_job_log(workflow, task_name, cycle):
+    # returns the path of the job log of task on cycle from the control flow
+    for task in workflow['tasks']:
+        if task['name'] == task_name:
+            for key in ['join', 'stderr', 'stdout']:
+                elem = task['element'].find(key)
+                if elem is not None:
+                    return expand_cyclestr(elem, cycle)
+
+    return None
+
+def recover_workflow(cse, ctr_flw, jobs, timeout=CMD_TIMEOUT):
+    # recovers the failed jobs of workflow that are due, returning the number
+    # of recoveries made and the earliest time of a pending recovery, or None
+    xml_path, _, _ = get_workflow_paths(cse, ctr_flw)
+    workflow = parse_workflow(xml_path)
+    now = time.time()
+    due = {}
+    pending = None
+    for job in jobs:
+        if job.state not in FAILED_STATES:
+            continue
+
+        cycle = job.cycle.strftime(CYC_FMT)
+        key = (cse, ctr_flw, cycle, job.task)
+        state = recover_states.setdefault(key, {
+                                                'attempts'  : 0,
+                                                'job_id'    : None,
+                                                'next_time' : None,
+                                                'failure'   : None,
+                                               })
+        if state['job_id'] != job.job_id:
+            # new failure, classify and schedule the recovery
+            state['job_id'] = job.job_id
+            log_path = get_job_log(workflow, job.task, job.cycle)
+            state['failure'] = classify_failure(job, read_log_tail(log_path))
+            if state['failure'] not in RECOVER_CLASSES:
+                log_recovery(cse + '-' + ctr_flw + ' ' + job.task + ' ' +\
+                             cycle + ' ' + job.state + ' with ' +\
+                             state['failure'] + ' failure, not recoverable,'
+                             ' see ' + str(log_path))
+                state['next_time'] = None
+
+            elif state['attempts'] >= RECOVER_MAX:
+                log_recovery(cse + '-' + ctr_flw + ' ' + job.task + ' ' +\
+                             cycle + ' ' + job.state + ' with ' +\
+                             state['failure'] + ' failure, recovery budget of' +\
+                             ' ' + str(RECOVER_MAX) + ' exhausted')
+                state['next_time'] = None
+
+            else:
+                delay = min(RECOVER_BASE * 2**state['attempts'], RECOVER_CAP)
+                state['next_time'] = now + delay
+                log_recovery(cse + '-' + ctr_flw + ' ' + job.task + ' ' +\
+                             cycle + ' ' + job.state + ' with ' +\
+                             state['failure'] + ' failure, recovering in ' +\
+                             str(delay) + ' seconds')
+
+        if state['next_time'] is None:
+            continue
+
+        if state['next_time'] <= now:
+            due.setdefault(cycle, []).append(job.task)
+
+        else:
+            pending = state['next_time'] if pending is None else\
+                    min(pending, state['next_time'])
+
+    # rewind and boot the due tasks with one grouped call per cycle
+    for cycle, tasks in due.items():
+        for rocoto_exe in ['rocotorewind', 'rocotoboot']:
+            results = run_batch_cmd(rocoto_exe, cse, ctr_flw, [cycle], tasks,
+                                    None, timeout)
+            log_recovery(cse + '-' + ctr_flw + ' ' + rocoto_exe + ' ' +\
+                         ','.join(tasks) + ' ' + cycle + ' status ' +\
+                         str(results[0]['status']))
+
+        for task in tasks:
+            state = recover_states[(cse, ctr_flw, cycle, task)]
+            state['attempts'] += 1
+            state['next_time'] = None
+
+    return sum(len(tasks) for tasks in due.values()), pending
+
+##################################################################################
+# Adaptive polling scheduler
+##################################################################################
+# The following methods replace the fixed 60 second polling of every workflow
+# with a scheduler keeping a state for each workflow.  A workflow is polled
+# with rocotorun / rocotostat at POLL_MIN seconds after its jobs are submitted
+# or change state, and the interval grows by POLL_BACKOFF up to POLL_MAX while
+# nothing changes.  Running jobs are expected to end after the median duration
+# of the same task in previous cycles, and the workflow is polled again as soon
+# as a job reaches its expected end, once per job, so that jobs running past
+# their expected end fall back to the backoff.  Workflows whose cycles are all
+# done in the database are dropped, and the scheduler exits when all workflows
+# are dropped or the end date is reached.  If AUTO_RECOVER is set, the failed
+# tasks of each polled workflow are recovered as above, and the workflow is
+# polled again when a pending recovery is due.
+#
+##################################################################################
+# states of jobs queued or running in the scheduler
+ACTIVE_STATES = ['SUBMITTING', 'QUEUED', 'RUNNING']
+
+def new_poll_state():
+    # returns the initial scheduler state of a workflow
+    return {
+            'next_poll'     : 0.0,
+            'interval'      : POLL_MIN,
+            'signature'     : None,
+            'running_since' : {},
+            'end_polled'    : set(),
+            'done'          : False,
+           }
+
+def is_workflow_done(cse, ctr_flw):
+    # returns True if every cycle of the control flow is done in the database
+    xml_path, store_path, _ = get_workflow_paths(cse, ctr_flw)
+    workflow = parse_workflow(xml_path)
+    cycles = set()
+    for group_cycles in workflow['cycledefs'].values():
+        cycles.update(group_cycles)
+
+    done = {cycle.cycle for cycle in read_store_cycles(store_path)
+            if cycle.done}
+
+    return bool(cycles) and cycles.issubset(done)
+
+def get_expected_durations(jobs):
+    # returns the median duration in seconds of the succeeded jobs of each task
+    durations = {}
+    for job in jobs:
+        if job.state == 'SUCCEEDED' and job.duration:
+            durations.setdefault(job.task, []).append(job.duration)
+
+    return {task: sorted(vals)[len(vals) // 2]
+            for task, vals in durations.items()}
+
+def update_poll_state(state, jobs, now):
+    # updates the poll interval of workflow from the change in its job states
+    signature = tuple((job.cycle, job.task, job.state, job.tries)
+                      for job in jobs)
+
+    if signature != state['signature']:
+        interval = POLL_MIN
+
+    else:
+        interval = min(state['interval'] * POLL_BACKOFF, POLL_MAX)
+
+    # track when each running job was first seen running
+    running = {(job.cycle, job.task) for job in jobs if job.state == 'RUNNING'}
+    running_since = {key: state['running_since'].get(key, now)
+                     for key in running}
+
+    # poll again when a running job reaches its expected end, once per job,
+    # where the poll at or past the expected end marks the job as polled
+    expected = get_expected_durations(jobs)
+    end_polled = state['end_polled'] & running
+    for (cycle, task), since in running_since.items():
+        if task in expected and (cycle, task) not in end_polled:
+            time_to_end = since + expected[task] - now
+            if time_to_end <= 0:
+                end_polled.add((cycle, task))
+
+            elif time_to_end < interval:
+                interval = max(POLL_MIN, time_to_end)
+
+    if any(job.state == 'SUBMITTING' for job in jobs):
+        interval = POLL_MIN
+
+    state['signature'] = signature
+    state['interval'] = interval
+    state['running_since'] = running_since
+    state['end_polled'] = end_polled
+    state['next_poll'] = now + interval
+
+def poll_workflow(cse, ctr_flw, state, timeout=CMD_TIMEOUT):
+    # advances the workflow and updates its scheduler state
+    results = run_workflow_cmds(cse, ctr_flw, ['rocotorun', 'rocotostat'],
+                                timeout)
+    _, store_path, _ = get_workflow_paths(cse, ctr_flw)
+    now = time.time()
+    try:
+        jobs = read_store_jobs(store_path)
+        update_poll_state(state, jobs, now)
+        state['done'] = is_workflow_done(cse, ctr_flw)
+        if AUTO_RECOVER and not state['done']:
+            n_recovered, pending = recover_workflow(cse, ctr_flw, jobs, timeout)
+            if n_recovered:
+                state['interval'] = POLL_MIN
+
+            if pending:
+                state['interval'] = min(state['interval'],
+                                        max(POLL_MIN, pending - now))
+
+            state['next_poll'] = now + state['interval']
+
+    except (OSError, sqlite3.Error, ET.ParseError, ValueError) as err:
+        with print_lock:
+            print('WARNING: reading ' + cse + '-' + ctr_flw +\
+                  ' state failed with ' + str(err))
+        state['interval'] = POLL_MIN
+        state['next_poll'] = now + POLL_MIN
+
+    return results
+
+def run_adaptive_scheduler(cses=None, flows=None, end=None,
+                           n_workers=N_WORKERS, timeout=CMD_TIMEOUT):
+    # polls each workflow on its own adaptive interval until all workflows are
+    # done or the end date is reached
+    cses = CSES if cses is None else cses
+    flows = CTR_FLWS if flows is None else flows
+    end = END if end is None else end
+    states = {(cse, ctr_flw): new_poll_state()
+              for cse in cses for ctr_flw in flows}
+
+    while states and dt.now() < end:
+        now = time.time()
+        due = [key for key, state in states.items()
+               if state['next_poll'] <= now]
+
+        if due:
+            t0 = time.time()
+            args_list = [(cse, ctr_flw, states[(cse, ctr_flw)], timeout)
+                         for (cse, ctr_flw) in due]
+            results = run_concurrent(poll_workflow, args_list, n_workers)
+            report_results(results, time.time() - t0)
+
+            for key in due:
+                if states[key]['done']:
+                    print('Workflow ' + '-'.join(key) + ' completed all'
+                          ' cycles, no longer polling')
+                    del states[key]
+
+                else:
+                    print('Workflow ' + '-'.join(key) + ' next poll in ' +\
+                          '%.0f'%states[key]['interval'] + ' seconds')
+
+        if states:
+            next_poll = min(state['next_poll'] for state in states.values())
+            time.sleep(max(0, next_poll - time.time()))
+
 ##################################################################################
 # Execute the following lines as script
 ##################################################################################
 
 if __name__ == '__main__':
     # monitor and advance the jobs
-    while (dt.now() < END):
-        run_rocotorun()
-        time.sleep(60)
+    run_adaptive_scheduler()
 
 ##################################################################################
 # end
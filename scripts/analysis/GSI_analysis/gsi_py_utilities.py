@@ -48,6 +48,17 @@
 ##################################################################################
 from datetime import datetime as dt
 from datetime import timedelta
+import os
+import sys
+
+# table storage and manifest of completed outputs shared with the WRF analysis
+# scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'WRF_analysis'))
+from py_plt_utilities import (
+        write_tables, read_table, file_identity, load_manifest, save_manifest,
+        manifest_entry, is_complete, record_output,
+        )
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
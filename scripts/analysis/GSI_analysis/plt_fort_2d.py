@@ -66,14 +66,13 @@
 ##################################################################################
 import numpy as np
 import pandas as pd
-import pickle
 import datetime
 import matplotlib
 # use this setting on COMET / Skyriver for x forwarding
 matplotlib.use('TkAgg')
 from matplotlib import pyplot as plt
 from matplotlib.ticker import PercentFormatter
-from gsi_py_utilities import USR_HME
+from gsi_py_utilities import USR_HME, read_table
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
@@ -103,17 +102,12 @@ FORT='201'
 cse = CSE + '/' + CTR_FLW
 data_root = USR_HME + '/data/analysis' + '/' + cse + '/GSI_analysis'
 in_path = data_root + '/GSI_fort_' + FORT + '_' + START_DT + '_to_' +\
-          END_DT + '.bin'
+          END_DT + '.nc'
 out_path = data_root + '/GSI_fort_' + FORT + '_' + str(DOM) + '_' +\
            START_DT + '_to_' + END_DT + '.png'
 
-# load and plot data
-f = open(in_path, 'rb')
-data = pickle.load(f)
-f.close()
-
-# load dataframe
-exec('data = data[\'d0%s\']'%DOM)
+# load dataframe and plot data
+data = read_table(in_path, 'd0' + str(DOM))
 
 # define two panel figure with pre-defined size
 fig = plt.figure(figsize=(16,8))
@@ -66,7 +66,6 @@
 ##################################################################################
 import numpy as np
 import pandas as pd
-import pickle
 import datetime
 import matplotlib
 # use this setting on COMET / Skyriver for x forwarding
@@ -74,7 +73,7 @@ matplotlib.use('TkAgg')
 from matplotlib import pyplot as plt
 from matplotlib.ticker import PercentFormatter
 import seaborn as sns
-from gsi_py_utilities import USR_HME
+from gsi_py_utilities import USR_HME, read_table
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
@@ -136,17 +135,12 @@ for k in range(num_flws):
     cse = CSE + '/' + ctr_flw
     data_root = USR_HME + '/data/analysis' + '/' + cse + '/GSI_analysis'
     in_path = data_root + '/GSI_fort_' + FORT + '_' + START_DT + '_to_' +\
-              END_DT + '.bin'
+              END_DT + '.nc'
     out_path = data_root + '/GSI_fort_' + FORT + '_' + str(DOM) + '_' +\
                START_DT + '_to_' + END_DT + '.png'
     
-    # load and plot data
-    f = open(in_path, 'rb')
-    data = pickle.load(f)
-    f.close()
-    
-    # load dataframe
-    exec('data = data[\'d0%s\']'%DOM)
+    # load dataframe and plot data
+    data = read_table(in_path, 'd0' + str(DOM))
     
     # subset monitored data
     bkg_mon = data.loc[(data['use'] == 'mon') & (data['iter'] == 1.0)]
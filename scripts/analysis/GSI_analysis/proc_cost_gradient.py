@@ -62,10 +62,13 @@
 ##################################################################################
 import numpy as np
 import pandas as pd
-import pickle
 import copy
+import sys
 from datetime import datetime as dt
-from gsi_py_utilities import USR_HME, STR_INDT, get_anls
+from gsi_py_utilities import (
+        USR_HME, STR_INDT, get_anls, write_tables, load_manifest, is_complete,
+        record_output,
+        )
 import os
 
 ##################################################################################
@@ -89,6 +92,13 @@ CYCLE_INT = 6
 # define domains to process
 MAX_DOM = 1
 
+# skip processing if the output is recorded as complete in the manifest of the
+# output directory, with unchanged inputs and processing parameters
+RESUME = True
+
+# identify inputs by SHA-256 hash in addition to size / modification time
+HASH_INPUTS = False
+
 ##################################################################################
 # Process data
 ##################################################################################
@@ -104,10 +114,26 @@ end_dt = dt.fromisoformat(END_DT)
 
 # define the output name
 out_path = out_root + '/GSI_cost_grad_anl_' + START_DT +\
-           '_to_' + END_DT + '.bin'
+           '_to_' + END_DT + '.nc'
 
 # generate the date range for the analyses
-analyses = get_anls(start_dt, end_dt, CYCLE_INT)
+analyses = list(get_anls(start_dt, end_dt, CYCLE_INT))
+
+# input files of all domains / analyses
+in_paths = []
+for i in range(1, MAX_DOM + 1):
+    for (anl_date, anl_strng) in analyses:
+        in_paths.append(in_root + '/' + anl_strng + '/gsiprd/d0' + str(i) +\
+                        '/fort.220')
+
+# processing parameters recorded in the manifest with the output
+params = {'CYCLE_INT' : CYCLE_INT, 'MAX_DOM' : MAX_DOM}
+manifest_path = out_root + '/manifest.json'
+manifest = load_manifest(manifest_path)
+if RESUME and is_complete(manifest, out_path, in_paths, params,
+                          use_hash=HASH_INPUTS):
+    print('Output ' + out_path + ' is complete, skipping')
+    sys.exit(0)
 
 # initiate empty dataframe / dictionary
 d0 = pd.DataFrame.from_dict({
@@ -162,9 +188,9 @@ for i in range(1, MAX_DOM + 1):
     exec('data[\'d0%s\'] = d0%s'%(i,i))
 
 print('Writing out data to ' + out_path)
-f = open(out_path, 'wb')
-pickle.dump(data, f)
-f.close()
+write_tables(data, out_path)
+record_output(manifest, manifest_path, out_path, in_paths, params,
+              use_hash=HASH_INPUTS)
 
 ##################################################################################
 # end
@@ -69,13 +69,12 @@
 ##################################################################################
 import numpy as np
 import pandas as pd
-import pickle
 import datetime as dt
 import matplotlib
 # use this setting on COMET / Skyriver for x forwarding
 matplotlib.use('TkAgg')
 from matplotlib import pyplot as plt
-from py_plt_utilities import USR_HME
+from py_plt_utilities import USR_HME, read_table
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
@@ -98,17 +97,12 @@ DOM = 1
 # define derived data paths 
 data_root = USR_HME + '/data/analysis/' + CTR_FLW + '/WRF_analysis'
 in_path = data_root + '/' + CTR_FLW + '_WRF_dps_dmu_dt_' + START_DATE + '_to_' +\
-          END_DATE + '.bin'
+          END_DATE + '.nc'
 out_path = data_root + '/' + CTR_FLW + '_WRF_spin_up_' + START_DATE + '_to_' +\
           END_DATE + '.png'
 
-# load and plot data
-f = open(in_path, 'rb')
-tmp = pickle.load(f)
-f.close()
-
-# load dataframe
-exec('data = tmp[\'d0%s\']'%DOM)
+# load dataframe and plot data
+data = read_table(in_path, 'd0' + str(DOM))
 
 # define three panel figure with pre-defined size
 fig = plt.figure(figsize=(16,8))
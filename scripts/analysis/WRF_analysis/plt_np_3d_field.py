@@ -57,11 +57,11 @@ import seaborn as sns
 import cartopy.crs as crs
 import cartopy.feature as cfeature
 import numpy as np
-import pickle
 import os
 from datetime import datetime as dt
 from datetime import timedelta
 from py_plt_utilities import USR_HME
+from wrf_store_utilities import load_np_data
 
 ##################################################################################
 # SET GLOBAL PARAMETERS
@@ -102,10 +102,16 @@ in_path = data_root + '/' + start_dt.strftime('%Y%m%d%H')
 out_path = data_root + '/3df_plots'
 os.system('mkdir -p ' + out_path)
 
-# load data
-f = open(in_path + '/start_' + START_DT + '_forecast_' + ANL_DT + '.bin', 'rb')
-data = pickle.load(f)
-f.close()
+if C_PL != '' or C_VAR != 'slp':
+    # pressure level contours are plotted for rh at 250 hPa
+    C_PL = 250
+    C_VAR = 'rh'
+
+# load data, reading only the plotted pressure levels
+levels = [H_PL, W_PL] if C_PL == '' else [H_PL, W_PL, C_PL]
+data = load_np_data(in_path + '/start_' + START_DT + '_forecast_' + ANL_DT +\
+                    '.nc', fields=[H_VAR, C_VAR, 'rh', 'u', 'v'],
+                    levels=levels)
 
 # load the projection
 cart_proj = data['cart_proj']
@@ -222,8 +228,6 @@ if C_PL == '' and C_VAR == 'slp':
 
 else:
     # add pressure level contour plot
-    C_PL = 250
-    C_VAR = 'rh'
     c_var_levels = 4
     c_var_pl = data['d01']['pl_' + str(C_PL)][C_VAR].flatten()
 
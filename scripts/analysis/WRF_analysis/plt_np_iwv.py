@@ -57,11 +57,11 @@ import seaborn as sns
 import cartopy.crs as crs
 import cartopy.feature as cfeature
 import numpy as np
-import pickle
 import os
 from datetime import datetime as dt
 from datetime import timedelta
 from py_plt_utilities import USR_HME
+from wrf_store_utilities import load_np_data
 
 ##################################################################################
 # SET GLOBAL PARAMETERS
@@ -95,9 +95,8 @@ out_path = data_root + '/iwv_plots'
 os.system('mkdir -p ' + out_path)
 
 # load data
-f = open(in_path + '/start_' + START_DT + '_forecast_' + ANL_DT + '.bin', 'rb')
-data = pickle.load(f)
-f.close()
+data = load_np_data(in_path + '/start_' + START_DT + '_forecast_' + ANL_DT +\
+                    '.nc', fields=['iwv', 'slp', 'u', 'v'], levels=[W_PL])
 
 # load the projection
 cart_proj = data['cart_proj']
@@ -58,11 +58,11 @@ import seaborn as sns
 import cartopy.crs as crs
 import cartopy.feature as cfeature
 import numpy as np
-import pickle
 import os
 from datetime import datetime as dt
 from datetime import timedelta
 from py_plt_utilities import USR_HME
+from wrf_store_utilities import load_np_data
 
 ##################################################################################
 # SET GLOBAL PARAMETERS
@@ -112,16 +112,12 @@ out_path = data_root + '/iwv_diff_plots/' + CTR_FLW2 + '_diff_' + CTR_FLW1
 os.system('mkdir -p ' + out_path)
 
 # load control data file 1 which we subtract from treatment data
-f1 = open(in_path1 + '/start_' + START_DT1 + '_forecast_' +\
-        ANL_DT + '.bin', 'rb')
-dataf1 = pickle.load(f1)
-f1.close()
+dataf1 = load_np_data(in_path1 + '/start_' + START_DT1 + '_forecast_' +\
+                      ANL_DT + '.nc', fields=['iwv'])
 
 # load data file 2 which is used as the treatment data
-f2 = open(in_path2 + '/start_' + START_DT2 + '_forecast_' +\
-        ANL_DT + '.bin', 'rb')
-dataf2 = pickle.load(f2)
-f2.close()
+dataf2 = load_np_data(in_path2 + '/start_' + START_DT2 + '_forecast_' +\
+                      ANL_DT + '.nc', fields=['iwv'])
 
 # load the projection
 cart_proj = dataf1['cart_proj']
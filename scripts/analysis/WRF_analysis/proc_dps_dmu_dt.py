@@ -65,12 +65,15 @@
 ##################################################################################
 import numpy as np
 import pandas as pd
-import pickle
 import copy
 import glob
+import sys
 from datetime import datetime as dt
 from datetime import timedelta
-from py_plt_utilities import STR_INDT, get_anls, USR_HME
+from py_plt_utilities import (
+        STR_INDT, get_anls, USR_HME, write_tables, load_manifest, is_complete,
+        record_output,
+        )
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
@@ -90,6 +93,13 @@ CYCLE_INT = 6
 # define domains to process
 MAX_DOM = 1
 
+# skip processing if the output is recorded as complete in the manifest of the
+# output directory, with unchanged inputs and processing parameters
+RESUME = True
+
+# identify inputs by SHA-256 hash in addition to size / modification time
+HASH_INPUTS = False
+
 ##################################################################################
 # Process data
 ##################################################################################
@@ -103,10 +113,25 @@ end_date = dt.fromisoformat(END_DATE)
 
 # define the output name
 out_path = out_dir + '/' + CTR_FLW + '_WRF_dps_dmu_dt_' + START_DATE +\
-           '_to_' + END_DATE + '.bin'
+           '_to_' + END_DATE + '.nc'
 
 # generate the date range for the analyses
-analyses = get_anls(start_date, end_date, CYCLE_INT)
+analyses = list(get_anls(start_date, end_date, CYCLE_INT))
+
+# input files of all analyses, from the lexicographically last rsl directory
+in_paths = []
+for (anl_date, anl_strng) in analyses:
+    in_path = data_root + '/' + anl_strng + '/wrfprd/ens_00/rsl.wrf.*'
+    in_paths.append(sorted(glob.glob(in_path))[-1] + '/rsl.error.0000')
+
+# processing parameters recorded in the manifest with the output
+params = {'CYCLE_INT' : CYCLE_INT, 'MAX_DOM' : MAX_DOM}
+manifest_path = out_dir + '/manifest.json'
+manifest = load_manifest(manifest_path)
+if RESUME and is_complete(manifest, out_path, in_paths, params,
+                          use_hash=HASH_INPUTS):
+    print('Output ' + out_path + ' is complete, skipping')
+    sys.exit(0)
 
 # initiate empty dataframe / dictionary
 d0 = pd.DataFrame.from_dict({
@@ -191,9 +216,9 @@ for i in range(1, MAX_DOM + 1):
     exec('data[\'d0%s\'] = d0%s'%(i,i))
 
 print('Writing out data to ' + out_path)
-f = open(out_path, 'wb')
-pickle.dump(data, f)
-f.close()
+write_tables(data, out_path)
+record_output(manifest, manifest_path, out_path, in_paths, params,
+              use_hash=HASH_INPUTS)
 
 ##################################################################################
 # end
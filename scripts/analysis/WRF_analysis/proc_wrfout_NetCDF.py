@@ -59,8 +59,15 @@ from wrf import (
                  omp_set_num_threads, omp_get_num_procs, omp_enabled,
                 )
 from wrf_py_utilities import (
-                              USR_HME, STR_INDT, process_D3_vars,
-                              process_D3_raw_vars
+                              build_interp_weights,
+                              interp_D3_vars, interp_D3_raw_vars,
+                              region_window, SubsetDataset, get_diag,
+                              Prefetcher,
+                             )
+from wrf_cache_utilities import DiagCache, diag_key
+from py_plt_utilities import (
+                              USR_HME, STR_INDT, load_manifest, is_complete,
+                              record_output,
                              )
 
 ##################################################################################
@@ -71,7 +78,7 @@ CTR_FLW = 'deterministic_forecast'
 DOMAIN = 'd02'
 F_IN_PATH = sys.argv[1] 
 print(F_IN_PATH)
-F_OUT_PATH = PROJ_ROOT + 'data/analysis/forecast_io/' +\
+F_OUT_PATH = USR_HME + '/data/analysis/forecast_io/' +\
              CTR_FLW + '/processed_wrf_out/'
 
 # number of files processed per outfile
@@ -99,6 +106,17 @@ PLS = [
       ]
 N_PLS = len(PLS)
 
+# interpolate linearly in log pressure, or linearly in pressure if False as in
+# wrf-python interplevel
+LOG_P = True
+
+# subset the files at read time to a region of interest given by a lat / lon box,
+# e.g., {'lat' : (30, 45), 'lon' : (-130, -115)}, or by an index window of the
+# mass grid, e.g., {'j' : (100, 220), 'i' : (40, 160)}, where the window of the
+# first file of a batch is used for all of its files, or process the full
+# domain if None
+REGION = None
+
 # 2D variables to extract
 D2_VARS = [
            'XLAT', 'XLONG', 'SZA', 'HGT',
@@ -117,19 +135,122 @@ D3_units = ['dm', 'K',]
 N_D3 = len(D3_VARS)
 D3_INT_VARS = sorted(D3_VARS + D3_RAW_VARS)  
 
+# compute the diagnostics with wrf-python getvar if 'wrf', keeping the attributes
+# of the variables in the outputs, or from the raw arrays of the cache without
+# xarray metadata if 'np', with the units as the only attribute
+DIAG_BACKEND = 'wrf'
+
 # cache variables
 CACHE_VARS = ['P', 'PSFC', 'PB', 'PH', 'PHB', 'T', 'QVAPOR', 'HGT', 'U', 'V', 'W']
 CACHE_VARS = set.union(set(CACHE_VARS), set(D2_VARS), set(D3_RAW_VARS))
 CACHE_VARS = sorted(list(CACHE_VARS))
 
+# skip the batches with outputs recorded as complete in the manifest of
+# F_OUT_PATH, with unchanged inputs and processing parameters, so that re-runs
+# only redo stale or missing outputs
+RESUME = True
+MANIFEST = F_OUT_PATH + 'manifest.json'
+
+# identify inputs by SHA-256 hash in addition to size / modification time
+HASH_INPUTS = False
+
+# keep the interpolated 3D fields of each batch in a persistent diagnostics
+# cache, with LRU eviction above the quota in bytes, where the cache directory
+# may be shared with proc_wrfout_np.py / proc_wrfout_ens.py, or interpolate all
+# fields if DIAG_CACHE_DIR is None
+DIAG_CACHE_DIR = F_OUT_PATH + 'diag_cache'
+DIAG_CACHE_QUOTA = 20 * 2**30
+
+# number of wrfout files read ahead in a background thread while the current
+# batch is processed, or read when opened if 0, where the files are loaded whole
+# into memory if IN_MEMORY, at the cost of holding up to PREFETCH_AHEAD +
+# N_PER_OUT files in memory, else streamed through the page cache.  Files are
+# read whole, so that prefetching is disabled with a REGION, and the files of
+# batches with all 3D fields in the diagnostics cache are not read.
+PREFETCH_AHEAD = 2 * N_PER_OUT
+IN_MEMORY = False
+
+# memory budget in bytes of the cache variables and diagnostics of a batch,
+# processing the files of a batch in chunks of times fitting the budget,
+# appended one chunk at a time along the unlimited Time dimension with identical
+# outputs, or all times of a batch at once if None, where the memory of a time is
+# estimated as MEM_FACTOR times the size of the cache variables of a time, for
+# the diagnostics / interpolated levels computed from them, and a file is not
+# split over chunks
+MEM_BUDGET = None
+MEM_FACTOR = 4
+
+# processing parameters recorded in the manifest with each output
+PARAMS = {
+          'PLS' : PLS,
+          'LOG_P' : LOG_P,
+          'D2_VARS' : D2_VARS,
+          'D3_RAW_VARS' : D3_RAW_VARS,
+          'D3_VARS' : D3_VARS,
+          'D3_units' : D3_units,
+          'DIAG_BACKEND' : DIAG_BACKEND,
+          'REGION' : REGION,
+         }
+
 ##################################################################################
-# batch processing WRF outputs to NetCDF files
+# writes interpolated levels with dimensions ([Time,] level, y, x) to variable x,
+# starting at time index t0
 
-def batch_process_netcdf(names):
-    # generate file cache for performance
-    wrfin = [Dataset(x) for x in names]
-    wrf_cache = extract_vars(wrfin, ALL_TIMES, CACHE_VARS) 
-                                          
+def write_levels(x, pl_data, pl_attrs, t0=0):
+    if pl_data.ndim == 3:
+        # add the time dimension dropped for a single time
+        pl_data = pl_data[np.newaxis]
+
+    x[t0:t0 + len(pl_data), :, :, :] = pl_data
+
+    pl_attrs = dict(pl_attrs)
+    pl_attrs.pop('projection', None)
+    pl_attrs.pop('_FillValue', None)
+    x.setncatts(pl_attrs)
+
+##################################################################################
+# returns the levels / attributes of an interpolated 3D field of a batch of WRF
+# outputs from the diagnostics cache, computing them with compute() on a miss
+
+def cached_levels(names, var, units, backend, compute):
+    if diag_cache is None:
+        return compute()
+
+    return diag_cache.fetch(levels_key(names, var, units, backend), compute)
+
+##################################################################################
+# returns the diagnostics cache key of an interpolated 3D field of a batch of WRF
+# outputs
+
+def levels_key(names, var, units, backend):
+    return diag_key(names, var, units, backend, timeidx=ALL_TIMES,
+                    extra={'pls' : PLS, 'log_p' : LOG_P, 'region' : REGION},
+                    use_hash=HASH_INPUTS)
+
+##################################################################################
+# returns whether all interpolated 3D fields of a batch of WRF outputs processed
+# in a single time chunk are in the diagnostics cache, so that only the 2D
+# fields are read from its files
+
+def is_batch_cached(names):
+    if diag_cache is None or MEM_BUDGET is not None:
+        return False
+
+    try:
+        keys = [levels_key(names, var, None, 'raw') for var in D3_RAW_VARS]
+        keys += [levels_key(names, D3_VARS[k], D3_units[k], DIAG_BACKEND)
+                 for k in range(N_D3)]
+
+    except OSError:
+        # a missing file raises when opened
+        return False
+
+    return all(diag_cache.contains(key) for key in keys)
+
+##################################################################################
+# returns the date range of a batch of WRF outputs and its output file name
+
+def get_out_name(names):
     # split string name for dates 
     if names[0] == names[-1]:
         # only a single file
@@ -147,10 +268,125 @@ def batch_process_netcdf(names):
         date1 = t1_split_name[-2]
         time1 = t1_split_name[-1]
         date_range = date0 + '_' + time0 + '-' + date1 + '_' + time1    
+
+    out_name = F_OUT_PATH + 'processed_' + DOMAIN + '_' + date_range + '.nc'
+
+    return date_range, out_name
+
+##################################################################################
+# returns the estimated memory in bytes of processing a single time of a file
+
+def time_bytes(ds):
+    n_bytes = 0
+    for name in CACHE_VARS:
+        var = ds.variables[name]
+        n_bytes += int(np.prod(var.shape[1:])) * var.dtype.itemsize
+
+    return MEM_FACTOR * n_bytes
+
+##################################################################################
+# returns the (start, end) indices of the files of the time chunks of a batch,
+# with the times of each chunk fitting MEM_BUDGET, or at least one file
+
+def time_chunks(wrfin):
+    if MEM_BUDGET is None:
+        return [(0, len(wrfin))]
+
+    n_max = max(1, int(MEM_BUDGET // time_bytes(wrfin[0])))
+    chunks = []
+    f0 = 0
+    n_t = 0
+    for f, ds in enumerate(wrfin):
+        n = len(ds.dimensions['Time'])
+        if f > f0 and n_t + n > n_max:
+            chunks.append((f0, f))
+            f0 = f
+            n_t = 0
+
+        n_t += n
+
+    chunks.append((f0, len(wrfin)))
+
+    return chunks
+
+##################################################################################
+# processes a time chunk of the files of a batch, writing the 2D / 3D variables
+# d2_out / d3_out of the output starting at time index t0, and returns the number
+# of times of the chunk
+
+def process_chunk(wrfin, names, d2_out, d3_out, t0):
+    # generate file cache for performance
+    wrf_cache = extract_vars(wrfin, ALL_TIMES, CACHE_VARS)
+
+    # extract 2D fields from cache
+    for name, x in d2_out.items():
+        print(3*STR_INDT + 'Copying ' + name)
+        d2_var = wrf_cache[name]
+
+        # reshape array to dimensions
+        d2_data = d2_var.data
+        if d2_data.ndim == 2:
+            d2_data = d2_data[np.newaxis]
+
+        x[t0:t0 + len(d2_data), :, :] = d2_data
+
+        # set attributes
+        d2_attrs = dict(d2_var.attrs)
+        d2_attrs.pop('projection', None)
+        x.setncatts(d2_attrs)
+
+    # extract the pressures and compute the interpolation weights once for
+    # all variables and levels, only on the first diagnostics cache miss
+    interp = {}
+    def get_weights():
+        if 'weights' not in interp:
+            p_ds = get_diag(wrfin, 'pressure', timeidx=ALL_TIMES,
+                            cache=wrf_cache, backend=DIAG_BACKEND)
+            interp['weights'] = build_interp_weights(p_ds, PLS, log_p=LOG_P)
+
+        return interp['weights']
+
+    # interpolate 3D fields to all pressure levels at once
+    for k in range(N_D3R):
+        print(3*STR_INDT + 'Interpolating ' + D3_RAW_VARS[k] + ' to ' +\
+              str(N_PLS) + ' pressure levels')
+        compute = lambda: interp_D3_raw_vars(wrfin, get_weights(),
+                                             D3_RAW_VARS[k], cache=wrf_cache)
+        pl_data, pl_attrs = cached_levels(names, D3_RAW_VARS[k], None, 'raw',
+                                          compute)
+        write_levels(d3_out[D3_RAW_VARS[k]], pl_data, pl_attrs, t0)
+
+    for k in range(N_D3):
+        print(3*STR_INDT + 'Interpolating ' + D3_VARS[k] + ' to ' +\
+              str(N_PLS) + ' pressure levels')
+        compute = lambda: interp_D3_vars(wrfin, get_weights(), D3_VARS[k],
+                                         D3_units[k], timeidx=ALL_TIMES,
+                                         cache=wrf_cache, backend=DIAG_BACKEND)
+        pl_data, pl_attrs = cached_levels(names, D3_VARS[k], D3_units[k],
+                                          DIAG_BACKEND, compute)
+        write_levels(d3_out[D3_VARS[k]], pl_data, pl_attrs, t0)
+
+    return sum(len(ds.dimensions['Time']) for ds in wrfin)
+
+##################################################################################
+# batch processing WRF outputs to NetCDF files, opening the files in memory from
+# their bytes if given
+
+def batch_process_netcdf(names, memories=None):
+    if memories is None:
+        memories = [None] * len(names)
+
+    # open the files of the batch, reading the variables by time chunk
+    wrfin = [Dataset(x, memory=m) for x, m in zip(names, memories)]
+    if REGION is not None:
+        # read only the hyperslab of the region from each file
+        window = region_window(wrfin[0], REGION)
+        wrfin = [SubsetDataset(x, window) for x in wrfin]
+
+    date_range, out_name = get_out_name(names)
     print(STR_INDT + 'Processing dates ' + date_range)
     
     # initialize output NetCDF output file
-    out_name = f_out_path + 'processed_' + domain + '_' + date_range + '.nc' 
     print(STR_INDT + 'Creating file ' + out_name)
     
     with Dataset(out_name, 'w', format='NETCDF4') as dst:
@@ -159,6 +395,9 @@ def batch_process_netcdf(names):
         
         # copy global attributes all at once via dictionary
         dst.setncatts(src.__dict__)
+        if REGION is not None:
+            # record the index window of the region on the full domain
+            dst.setncattr('REGION_WINDOW', np.array(src.window))
         
         # copy dimensions
         for name, dimension in src.dimensions.items():
@@ -176,101 +415,55 @@ def batch_process_netcdf(names):
                 print(2*STR_INDT + 'Creating dimension ' + name)
                 dst.createDimension(name, None)
             
+            elif REGION is not None and name == 'south_north':
+                # set the horizontal dimensions to the region
+                print(2*STR_INDT + 'Creating dimension ' + name)
+                dst.createDimension(name, src.window[1] - src.window[0])
+
+            elif REGION is not None and name == 'west_east':
+                print(2*STR_INDT + 'Creating dimension ' + name)
+                dst.createDimension(name, src.window[3] - src.window[2])
+
             else:
                 # copy all other dimensions
                 print(2*STR_INDT + 'Creating dimension ' + name)
                 dst.createDimension(name, len(dimension))
         
-        # extract 2D fields from cache
-        for name, variable in src.variables.items():
-            if name in D2_VARS:
-                print(3*STR_INDT + 'Copying ' + name)
-                x = dst.createVariable(name, variable.datatype,
-                                       variable.dimensions)
-                d2_var = wrf_cache[name]
-
-                # reshape array to dimensions
-                d2_data = d2_var.data
-                var_shape = np.shape(d2_data)
-                if len(var_shape) == 2:
-                    y_dim, x_dim = np.shape(d2_data)
-                    d2_data = np.reshape(d2_data, [1, y_dim, x_dim])
-                    x[:, :, :] = d2_data
-
-                else:
-                    x[:, :, :] = d2_data
-        
-                # set attributes
-                d2_attrs = d2_var.attrs
-                del d2_attrs['projection']
-                x.setncatts(d2_attrs)
-        
         if omp_enabled:
             # set opm parameters for parallelism
             omp_np = omp_get_num_procs()
             print(2*STR_INDT + 'Running OpenMP with ' +
                   str(omp_np) + ' processes')
             omp_set_num_threads(omp_np)
-        
-        # extract the pressures
-        p_ds = getvar(wrfin, 'pressure', cache=wrf_cache)
-        
-        # specific humidity is reference 3D variable for datatype / dimensions
+
+        # create the 2D variables, then the interpolated 3D variables with
+        # specific humidity as reference 3D variable for datatype / dimensions
+        d2_out = {}
+        for name, variable in src.variables.items():
+            if name in D2_VARS:
+                d2_out[name] = dst.createVariable(name, variable.datatype,
+                                                  variable.dimensions)
+
         q_ds = src['QVAPOR']
-        
-        # interpolate 3D fields to pressure levels
-        for k in range(N_D3R):
-            print(3*STR_INDT + 'Interpolating ' + D3_RAW_VARS[k])
-            x = dst.createVariable(D3_RAW_VARS[k], q_ds.datatype, q_ds.dimensions)
-
-            for i in range(N_PLS):
-                print(4*STR_INDT + 'Pressure level ' + str(PLS[i]))
-                pl_var = process_D3_raw_vars(wrfin, p_ds, PLS[i], D3_RAW_VARS[k],
-                                             cache=wrf_cache)
-                # reshape array to dimensions
-                if N_PER_OUT == 1:
-                    pl_data = pl_var.data
-                    y_dim, x_dim = np.shape(pl_data)
-                    pl_data = np.reshape(pl_data, [1, 1, y_dim, x_dim]) 
-                    x[:, i, :, :] = pl_data
-
-                else:
-                    pl_data = pl_var.data
-                    t_dim, y_dim, x_dim = np.shape(pl_data)
-                    pl_data = np.reshape(pl_data, [t_dim, 1, y_dim, x_dim]) 
-                    x[:, i, :, :] = pl_data
-
-            pl_attrs = pl_var.attrs
-            del pl_attrs['projection']
-            del pl_attrs['_FillValue']
-            x.setncatts(pl_attrs)
-        
-        for k in range(N_D3):
-            print(3*STR_INDT + 'Interpolating ' + D3_VARS[k])
-            x = dst.createVariable(D3_VARS[k], q_ds.datatype, q_ds.dimensions)
-        
-            for i in range(N_PLS):
-                print(4*STR_INDT + 'Pressure level ' + str(PLS[i]))
-                pl_var = process_D3_vars(wrfin, p_ds, PLS[i], D3_VARS[k],
-                                         D3_units[k], cache=wrf_cache)
-        
-                # reshape array to dimensions
-                if N_PER_OUT == 1:
-                    pl_data = pl_var.data
-                    y_dim, x_dim = np.shape(pl_data)
-                    pl_data = np.reshape(pl_data, [1, 1, y_dim, x_dim]) 
-                    x[:, i, :, :] = pl_data
-
-                else:
-                    pl_data = pl_var.data
-                    t_dim, y_dim, x_dim = np.shape(pl_data)
-                    pl_data = np.reshape(pl_data, [t_dim, 1, y_dim, x_dim]) 
-                    x[:, i, :, :] = pl_data
-            
-            pl_attrs = pl_var.attrs
-            del pl_attrs['projection']
-            del pl_attrs['_FillValue']
-            x.setncatts(pl_attrs)
+        d3_out = {}
+        for name in D3_RAW_VARS + D3_VARS:
+            d3_out[name] = dst.createVariable(name, q_ds.datatype,
+                                              q_ds.dimensions)
+
+        # process the files in time chunks, appended along the Time dimension
+        chunks = time_chunks(wrfin)
+        if len(chunks) > 1:
+            print(2*STR_INDT + 'Processing ' + str(len(chunks)) +\
+                  ' time chunks of at most ' +\
+                  '%.2f'%(MEM_BUDGET / 2**30) + ' GB each')
+
+        t0 = 0
+        for f0, f1 in chunks:
+            t0 += process_chunk(wrfin[f0:f1], names[f0:f1], d2_out, d3_out, t0)
+
+        if diag_cache is not None:
+            print(2*STR_INDT + 'Diagnostics cache: ' +\
+                  diag_cache.format_stats())
 
         print(STR_INDT + 'Completed processing dates ' + date_range)
 
@@ -306,14 +499,55 @@ n_batch = int(math.ceil(len(fnames) / N_PER_OUT))
 print(str(n_batch) + ' total batches of ' + str(N_PER_OUT) +
       ' files per batch combined in processed outputs')
 
-# loop file names in increments of N_PER_OUT
+# outputs completed over all previous runs
+manifest = load_manifest(MANIFEST)
+
+# diagnostics computed over all previous runs
+if DIAG_CACHE_DIR is None:
+    diag_cache = None
+
+else:
+    diag_cache = DiagCache(DIAG_CACHE_DIR, quota=DIAG_CACHE_QUOTA)
+
+# loop file names in increments of N_PER_OUT, collecting the incomplete batches
+batches = []
 for k in range(n_batch):
     if k == (n_batch - 1):
-        print('Start batch ' + str(k+1) + ' of ' + str(n_batch))
-        batch_process_netcdf(fnames[k * N_PER_OUT:])
+        names = fnames[k * N_PER_OUT:]
     else:
+        names = fnames[k * N_PER_OUT : (k+1) * N_PER_OUT]
+
+    _, out_name = get_out_name(names)
+    if RESUME and is_complete(manifest, out_name, names, PARAMS,
+                              use_hash=HASH_INPUTS):
+        print('Skipping batch ' + str(k+1) + ' of ' + str(n_batch) +\
+              ', output ' + out_name + ' is complete')
+        continue
+
+    batches.append((k, names, out_name))
+
+# read the files of the next batches ahead of their processing
+in_paths = [name for _, names, _ in batches for name in names]
+cached = {name for _, names, _ in batches if is_batch_cached(names)
+          for name in names}
+if REGION is None:
+    ahead = PREFETCH_AHEAD
+    in_memory = IN_MEMORY
+
+else:
+    ahead = 0
+    in_memory = False
+
+with Prefetcher(in_paths, ahead=ahead, in_memory=in_memory,
+                skip=lambda name: name in cached) as reader:
+    for k, names, out_name in batches:
+        memories = [next(reader)[1] for name in names]
         print('Start batch ' + str(k+1) + ' of ' + str(n_batch))
-        batch_process_netcdf(fnames[k * N_PER_OUT : (k+1) * N_PER_OUT])
+        batch_process_netcdf(names, memories)
+        record_output(manifest, MANIFEST, out_name, names, PARAMS,
+                      use_hash=HASH_INPUTS)
+
+print('Prefetching: ' + reader.format_stats())
 
 t1 = time.time()
 print('Batch processing complete')
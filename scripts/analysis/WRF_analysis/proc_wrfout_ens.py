@@ -0,0 +1,445 @@
+##################################################################################
+# Description
+##################################################################################
+# This script computes ensemble statistics of the IVT / IWV and pressure-level
+# fields of proc_wrfout_np.py over the members of an ensemble forecast.  Members
+# are streamed one at a time through the IVT / IWV kernel and the pressure-level
+# interpolation, updating the ensemble mean, variance and the probabilities of
+# exceeding thresholds, e.g., IVT > 250 kg m-1 s-1, online with Welford
+# accumulators.  Members are split over a process pool, with the accumulators
+# of the workers merged per analysis hour and domain, so that memory scales with
+# the size of a single member per worker rather than with the ensemble size.
+# Outputs are written in the NetCDF4 format of wrf_store_utilities, with the
+# fields of each statistic named, e.g., ivtm_mean, ivtm_std and ivtm_prob_250,
+# referencing the geometry store shared with proc_wrfout_np.py.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from datetime import timedelta
+from wrf import (
+        to_np, getvar, extract_vars, omp_enabled, omp_set_num_threads,
+        )
+from wrf_py_utilities import (
+        build_interp_weights, interp_D3_vars, comp_IVT_IWV_fast,
+        diag_cache_vars, domain_geometry, new_accum, update_accum,
+        merge_accum, finalize_accum, open_wrfout, eval_fields, field_raw_vars,
+        )
+from wrf_geo_utilities import (
+        get_nest_attrs, get_nest_indices, get_grid_key, load_geo_store,
+        save_geo_store,
+        )
+from wrf_store_utilities import write_np_data
+from wrf_cache_utilities import DiagCache, cached_fields
+from py_plt_utilities import (
+        STR_INDT, load_manifest, is_complete, record_output,
+        )
+
+##################################################################################
+# SET GLOBAL PARAMETERS
+##################################################################################
+# read in paths and start / analysis date time from function call, where IN_DIR
+# contains the ens_XX member directories, e.g., the wrfprd directory of a cycle
+IN_DIR = sys.argv[1] 
+OUT_DIR = sys.argv[2]
+START_DT = sys.argv[3]
+ANL_START = int(sys.argv[4])
+ANL_INT = int(sys.argv[5])
+ANL_END = int(sys.argv[6])
+
+# list of ensemble member indices
+MEM_LIST = [str(i).zfill(2) for i in range(1, 21)]
+
+# pressure levels to interpolate to
+PLVS = [250, 500, 700, 850, 925]
+
+# domains to be processed, this assumes completely heirarchical nesting
+MAX_DOM = 2
+
+# 3D variables to extract and units
+IN_VARS = ['z',  'ua', 'va', 'temp', 'rh']
+UNITS =   ['dm', 'kt', 'kt', 'K',    '']
+
+# 3D pressure-level interpolated variables to save
+OUT_VARS = ['geop', 'u', 'v', 'temp', 'rh']
+
+# subset every member at read time to a region of interest given by a lat / lon
+# box or an index window of the mass grid, as in proc_wrfout_np.py, or process
+# the full domains if None
+REGION = None
+
+# thresholds for the probabilities of exceedance of the 2D fields
+EXCEED = {
+          'ivtm' : [250, 500, 750],
+          'iwv'  : [20, 30],
+         }
+
+# interpolate linearly in log pressure, or linearly in pressure if False as in
+# wrf-python interplevel
+LOG_P = True
+
+# diagnostics computed from each file, from which the raw wrfout variables read
+# once into the extract_vars cache of each member are derived
+DIAGS = ['pressure'] + IN_VARS + ['ivt']
+
+# fields computed from each member, as (name, units) of the derived-field
+# registry of wrf_py_utilities, where <name>_pl is interpolated to PLVS
+OUTPUTS = [(IN_VARS[k] + '_pl', UNITS[k]) for k in range(len(IN_VARS))] +\
+          ['ivtm', 'ivtu', 'ivtv', 'iwv']
+CACHE_VARS = sorted(set(diag_cache_vars(DIAGS)) | set(field_raw_vars(OUTPUTS)))
+
+# compute the diagnostics with wrf-python getvar if 'wrf', or directly from the
+# raw arrays of the cache without xarray metadata if 'np'
+DIAG_BACKEND = 'np'
+
+# number of worker processes over the members, where the members are processed
+# serially in the main process if N_WORKERS = 1
+N_WORKERS = 1
+
+# OpenMP threads of wrf-python per worker, where 0 divides the available cores
+# evenly over the workers
+OMP_THREADS = 0
+
+# geometry store shared with proc_wrfout_np.py over all start dates
+GEO_PATH = os.path.join(os.path.dirname(os.path.normpath(OUT_DIR)),
+                        'geometry.bin')
+
+# skip the analysis hours with outputs recorded as complete in the manifest
+RESUME = True
+MANIFEST = OUT_DIR + '/manifest.json'
+
+# identify inputs by SHA-256 hash in addition to size / modification time
+HASH_INPUTS = False
+
+# keep the computed fields of each member in the persistent diagnostics cache
+# shared with proc_wrfout_np.py, or compute all fields if DIAG_CACHE_DIR is None
+DIAG_CACHE_DIR = os.path.join(os.path.dirname(os.path.normpath(OUT_DIR)),
+                              'diag_cache')
+DIAG_CACHE_QUOTA = 20 * 2**30
+
+# processing parameters recorded in the manifest with each output
+PARAMS = {
+          'MEM_LIST' : MEM_LIST,
+          'PLVS' : PLVS,
+          'MAX_DOM' : MAX_DOM,
+          'IN_VARS' : IN_VARS,
+          'UNITS' : UNITS,
+          'OUT_VARS' : OUT_VARS,
+          'EXCEED' : EXCEED,
+          'LOG_P' : LOG_P,
+          'DIAG_BACKEND' : DIAG_BACKEND,
+          'REGION' : REGION,
+         }
+
+##################################################################################
+# Processing methods
+##################################################################################
+# returns the path of the wrfout file of a member / analysis hour / domain
+
+def get_in_path(mem, anl_dt, domain):
+    return IN_DIR + '/ens_' + mem + '/wrfout_' + domain + '_' + anl_dt
+
+##################################################################################
+# returns the path of the ensemble statistics of an analysis hour
+
+def get_out_path(anl_dt):
+    return OUT_DIR + '/start_' + START_DT + '_forecast_' + anl_dt +\
+            '_ens_stats.nc'
+
+##################################################################################
+# returns the number of cores available to this process, e.g., in a SLURM job
+
+def get_n_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+
+    except AttributeError:
+        return os.cpu_count()
+
+##################################################################################
+# sets the wrf-python OpenMP threads of a process
+
+def set_omp_threads(n_threads):
+    if omp_enabled():
+        omp_set_num_threads(n_threads)
+
+##################################################################################
+# computes the fields of the outputs, a subset of OUTPUTS, from a member file
+
+def compute_fields(nc_file, outputs):
+    # read the variables of all diagnostics once into the cache
+    cache = extract_vars(nc_file, 0, CACHE_VARS)
+    if DIAG_BACKEND == 'np':
+        # all fields in one pass over the derived-field registry
+        return eval_fields(nc_file, outputs, cache=cache, pls=PLVS,
+                           log_p=LOG_P)
+
+    # interpolate 3D fields to all pressure levels at once
+    vals = {}
+    p_ds = getvar(nc_file, 'pressure', cache=cache)
+    weights = build_interp_weights(p_ds, PLVS, log_p=LOG_P)
+    for k in range(len(IN_VARS)):
+        vals[IN_VARS[k] + '_pl'], _ = interp_D3_vars(nc_file, weights,
+                                                     IN_VARS[k], UNITS[k],
+                                                     cache=cache)
+
+    ivt = comp_IVT_IWV_fast(nc_file, p_ds, cache=cache)
+    for name, val in zip(['ivtm', 'ivtu', 'ivtv', 'iwv'], ivt):
+        vals[name] = to_np(val)
+
+    return vals
+
+##################################################################################
+# computes the 2D and pressure-level fields of a member, keyed by the output
+# dictionary key of pressure-level fields, or None for 2D fields, and variable
+
+def member_fields(mem, anl_dt, domain):
+    fname = get_in_path(mem, anl_dt, domain)
+    print(STR_INDT * 2 + 'Processing member file ' + fname)
+    nc_file, window = open_wrfout(fname, REGION)
+    with nc_file:
+        if diag_cache is None:
+            vals = compute_fields(nc_file, OUTPUTS)
+
+        else:
+            # read / compute only the fields missing from the diagnostics cache
+            compute = lambda missing: compute_fields(nc_file, missing)
+            vals = cached_fields(diag_cache, fname, OUTPUTS, compute,
+                                 DIAG_BACKEND, pls=PLVS, log_p=LOG_P,
+                                 extra={'region' : window},
+                                 use_hash=HASH_INPUTS)
+
+    fields = {}
+    for k in range(len(IN_VARS)):
+        pl_vars = vals.pop(IN_VARS[k] + '_pl')
+        for j, pl in enumerate(PLVS):
+            fields[('pl_' + str(pl), OUT_VARS[k])] = pl_vars[..., j, :, :]
+
+    for name in ['ivtm', 'ivtu', 'ivtv', 'iwv']:
+        fields[(None, name)] = vals.pop(name)
+
+    return fields
+
+##################################################################################
+# streams the members of an analysis hour / domain through the accumulators,
+# holding the fields of a single member at a time
+
+def process_members(mems, anl_dt, domain):
+    accs = {}
+    for mem in mems:
+        fields = member_fields(mem, anl_dt, domain)
+        for key, field in fields.items():
+            if key not in accs:
+                accs[key] = new_accum(field.shape, EXCEED.get(key[1], ()))
+
+            update_accum(accs[key], field)
+
+        del fields
+
+    if diag_cache is not None:
+        print(STR_INDT * 2 + 'Diagnostics cache: ' + diag_cache.format_stats())
+
+    return accs
+
+##################################################################################
+# returns the geometry of the domain grid of an analysis hour, computed from the
+# first member if not in the geometry store, with its grid key / nest attributes
+
+def process_geometry(anl_dt, i):
+    domain = domains[i]
+    nc_file, window = open_wrfout(get_in_path(MEM_LIST[0], anl_dt, domain),
+                                  REGION)
+    with nc_file:
+        grid_key = get_grid_key(nc_file, domain, window)
+        nest_attrs = get_nest_attrs(nc_file)
+        if grid_key in geo_store['grids']:
+            return grid_key, nest_attrs
+
+        print(STR_INDT * 2 + 'Computing the geometry of grid ' + domain)
+        p_ds = getvar(nc_file, 'pressure')
+        if i == 0:
+            geo = domain_geometry(p_ds, nc_file)
+
+        else:
+            p_fname = get_in_path(MEM_LIST[0], anl_dt, domains[0])
+            p_file, _ = open_wrfout(p_fname, REGION)
+            with p_file:
+                geo = domain_geometry(p_ds, p_file)
+
+    geo_store['grids'][grid_key] = geo
+    save_geo_store(geo_store, GEO_PATH)
+
+    return grid_key, nest_attrs
+
+##################################################################################
+# processes the ensemble statistics of an analysis hour, splitting the members
+# of each domain over the pool if given, and writes them out
+
+def process_hour(anl_dt, pool=None):
+    print(STR_INDT + 'Begin analysis of simulation hour ' + anl_dt)
+    data = {'date' : anl_dt}
+    attrs = {}
+    attrs_ids = []
+    for i in range(MAX_DOM):
+        domain = domains[i]
+        grid_key, nest_attrs = process_geometry(anl_dt, i)
+        attrs[nest_attrs['GRID_ID']] = nest_attrs
+        attrs_ids.append(nest_attrs['GRID_ID'])
+        if i == 0:
+            data['geometry'] = {
+                                'path' : os.path.relpath(GEO_PATH, OUT_DIR),
+                                'root' : grid_key,
+                               }
+
+        # find the parent grid indices that lie within the nested domain
+        grid = geo_store['grids'][grid_key]
+        if i >= 1 and 'indx' not in grid:
+            p_grid = geo_store['grids'][data['d01']['grid']]
+            xy = (p_grid['xx'], p_grid['yy'], grid['xx'], grid['yy'])
+            grid['indx'] = get_nest_indices(attrs, attrs_ids[i], attrs_ids[0],
+                                            xy=xy)
+            save_geo_store(geo_store, GEO_PATH)
+
+        # stream the members, dealt round-robin over the workers; the merged
+        # statistics do not depend on how the members are split
+        print(STR_INDT * 2 + 'Streaming ' + str(len(MEM_LIST)) +\
+                ' members of domain ' + domain)
+        if pool is None:
+            accs = process_members(MEM_LIST, anl_dt, domain)
+
+        else:
+            n_chunks = min(N_WORKERS, len(MEM_LIST))
+            chunks = [MEM_LIST[k::n_chunks] for k in range(n_chunks)]
+            futures = [pool.submit(process_members, chunk, anl_dt, domain)
+                       for chunk in chunks]
+            accs = futures[0].result()
+            for future in futures[1:]:
+                for key, acc in future.result().items():
+                    merge_accum(accs[key], acc)
+
+        # compute the statistics, under the pressure-level keys of the output
+        dom_data = {'grid' : grid_key}
+        for pl in PLVS:
+            dom_data['pl_' + str(pl)] = {}
+
+        for (pl_key, var), acc in accs.items():
+            mean, std, probs = finalize_accum(acc)
+            out = dom_data if pl_key is None else dom_data[pl_key]
+            out[var + '_mean'] = mean
+            out[var + '_std'] = std
+            for thr, prob in probs.items():
+                out[var + '_prob_' + str(thr)] = prob
+
+        data[domain] = dom_data
+
+    fname = get_out_path(anl_dt)
+    print(STR_INDT * 2 + 'Writing ensemble statistics out to ' + fname)
+    write_np_data(data, fname)
+    in_paths = [get_in_path(mem, anl_dt, domain) for mem in MEM_LIST
+                for domain in domains]
+    record_output(manifest, MANIFEST, fname, in_paths, PARAMS,
+                  use_hash=HASH_INPUTS)
+
+##################################################################################
+# Process data
+##################################################################################
+anl_hrs = range(ANL_START, ANL_END + 1, ANL_INT)
+
+# convert to date time object
+start_dt = dt.fromisoformat(START_DT)
+
+domains = []
+for i in range(1, MAX_DOM + 1):
+    exec('domains.append(\'d0%i\')'%i)
+
+# geometry of the domain grids computed over all previous runs
+geo_store = load_geo_store(GEO_PATH)
+
+# outputs completed over all previous runs
+manifest = load_manifest(MANIFEST)
+
+# diagnostics computed over all previous runs
+if DIAG_CACHE_DIR is None:
+    diag_cache = None
+
+else:
+    diag_cache = DiagCache(DIAG_CACHE_DIR, quota=DIAG_CACHE_QUOTA)
+
+if __name__ == '__main__':
+    # make output root
+    os.system('mkdir -p ' + OUT_DIR)
+
+    print('Begin ensemble analysis of simulations starting on ' + START_DT)
+    print('Over members:')
+    print(STR_INDT + ', '.join(MEM_LIST))
+
+    # output formatted analysis date time strings
+    anl_dts = []
+    for hr in anl_hrs:
+        anl_dt = start_dt + timedelta(hours=hr)
+        anl_dts.append(anl_dt.strftime('%Y-%m-%d_%H:%M:%S'))
+
+    if RESUME:
+        anl_dts = [anl_dt for anl_dt in anl_dts if not is_complete(
+            manifest, get_out_path(anl_dt),
+            [get_in_path(mem, anl_dt, domain) for mem in MEM_LIST
+             for domain in domains],
+            PARAMS, use_hash=HASH_INPUTS)]
+
+    if N_WORKERS > 1:
+        omp_threads = OMP_THREADS or max(1, get_n_cores() // N_WORKERS)
+        print('Running ' + str(N_WORKERS) + ' workers with ' +\
+                str(omp_threads) + ' OpenMP threads each')
+        with ProcessPoolExecutor(max_workers=N_WORKERS,
+                                 initializer=set_omp_threads,
+                                 initargs=(omp_threads,)) as pool:
+            for anl_dt in anl_dts:
+                process_hour(anl_dt, pool=pool)
+
+    else:
+        for anl_dt in anl_dts:
+            process_hour(anl_dt)
+
+##################################################################################
+# end
@@ -49,21 +49,30 @@
 ##################################################################################
 # Imports
 ##################################################################################
-from netCDF4 import Dataset
 import numpy as np
 import pickle
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime as dt
 from datetime import timedelta
 from wrf import (
-        to_np, get_cartopy, cartopy_xlim, getvar,
-        cartopy_ylim, latlon_coords, ll_to_xy,
+        to_np, getvar, extract_vars, omp_enabled, omp_set_num_threads,
         )
 from wrf_py_utilities import (
-        process_D3_vars, process_D3_raw_vars, comp_IVT_IWV,
+        build_interp_weights, interp_D3_vars, comp_IVT_IWV_fast,
+        diag_cache_vars, CountingDataset, format_read_counts, domain_geometry,
+        open_wrfout, eval_fields, field_raw_vars, diag_parity, Prefetcher,
+        )
+from wrf_geo_utilities import (
+        get_nest_attrs, get_nest_indices, get_grid_key, load_geo_store,
+        save_geo_store, GEO_FIELDS,
+        )
+from wrf_store_utilities import write_np_data
+from wrf_cache_utilities import DiagCache, cached_fields, has_fields
+from py_plt_utilities import (
+        STR_INDT, load_manifest, is_complete, record_output,
         )
-from py_plt_utilities import STR_INDT
 
 ##################################################################################
 # SET GLOBAL PARAMETERS
@@ -82,6 +91,41 @@ PLVS = [250, 500, 700, 850, 925]
 # domains to be processed, this assumes completely heirarchical nesting
 MAX_DOM = 2
 
+# find the parent grid points within each nest from the nesting attributes of
+# the wrfout files if True, or from the x / y grid values of the nest on the
+# parent domain as computed by ll_to_xy otherwise
+NEST_FROM_ATTRS = False
+
+# subset every domain at read time to a region of interest given by a lat / lon
+# box, e.g., {'lat' : (30, 45), 'lon' : (-130, -115)} for West Coast landfall,
+# or by an index window of the mass grid, e.g., {'j' : (100, 220), 'i' : (40,
+# 160)}, so that I/O and compute scale with the region, or process the full
+# domains if None.  Nest indices are then always found from the x / y grid
+# values, relative to the region of the parent domain.
+REGION = None
+
+# keep the geometry of each domain, i.e., lat / lon, x / y grid values, limits,
+# projection and nest indices, in a geometry store shared by all start dates in
+# the parent directory of OUT_DIR, referenced by the outputs of each forecast
+# hour, or duplicate the geometry in every output if False
+SHARE_GEOMETRY = True
+GEO_PATH = os.path.join(os.path.dirname(os.path.normpath(OUT_DIR)),
+                        'geometry.bin')
+
+# write outputs to compressed NetCDF4 files chunked per variable / level, read
+# with load_np_data of wrf_store_utilities, or pickle them to .bin files if
+# False, where NetCDF4 outputs require SHARE_GEOMETRY
+OUT_NC = True
+
+# skip the analysis hours with outputs recorded as complete in the manifest of
+# OUT_DIR, with unchanged inputs and processing parameters, so that re-runs only
+# redo stale or missing outputs
+RESUME = True
+MANIFEST = OUT_DIR + '/manifest.json'
+
+# identify inputs by SHA-256 hash in addition to size / modification time
+HASH_INPUTS = False
+
 # 3D variables to extract and units
 IN_VARS = ['z',  'ua', 'va', 'temp', 'rh', 'wspd_wdir']
 UNITS =   ['dm', 'kt', 'kt', 'K',    '',   'kts']
@@ -89,11 +133,428 @@ UNITS =   ['dm', 'kt', 'kt', 'K',    '',   'kts']
 # 3D pressure-level interpolated variables to save
 OUT_VARS = ['geop', 'u', 'v', 'temp', 'rh', 'wspd']
 
+# interpolate linearly in log pressure, or linearly in pressure if False as in
+# wrf-python interplevel
+LOG_P = True
+
+# diagnostics computed from each file, from which the raw wrfout variables read
+# once into the extract_vars cache of each domain / time are derived
+DIAGS = ['pressure'] + IN_VARS + ['slp', 'ivt']
+
+# fields computed from each file, as (name, units) of the derived-field registry
+# of wrf_py_utilities, where <name>_pl is interpolated to PLVS
+OUTPUTS = [(IN_VARS[k] + '_pl', UNITS[k]) for k in range(len(IN_VARS))] +\
+          [('slp', 'hPa'), 'ivtm', 'ivtu', 'ivtv', 'iwv']
+CACHE_VARS = sorted(set(diag_cache_vars(DIAGS)) | set(field_raw_vars(OUTPUTS)))
+
+# compute the diagnostics with wrf-python getvar if 'wrf', or directly from the
+# raw arrays of the cache without xarray metadata if 'np'
+DIAG_BACKEND = 'np'
+
+# print the difference of the NumPy diagnostics from getvar for each file
+CHECK_PARITY = False
+
+# keep the computed fields of each file in a persistent diagnostics cache, with
+# LRU eviction above the quota in bytes, so that re-runs with, e.g., new PLVS
+# skip recomputing the unchanged fields, where the cache may be shared with the
+# other processing scripts, or compute all fields if DIAG_CACHE_DIR is None
+DIAG_CACHE_DIR = os.path.join(os.path.dirname(os.path.normpath(OUT_DIR)),
+                              'diag_cache')
+DIAG_CACHE_QUOTA = 20 * 2**30
+
+# processing parameters recorded in the manifest with each output
+PARAMS = {
+          'PLVS' : PLVS,
+          'MAX_DOM' : MAX_DOM,
+          'IN_VARS' : IN_VARS,
+          'UNITS' : UNITS,
+          'OUT_VARS' : OUT_VARS,
+          'LOG_P' : LOG_P,
+          'DIAG_BACKEND' : DIAG_BACKEND,
+          'NEST_FROM_ATTRS' : NEST_FROM_ATTRS,
+          'REGION' : REGION,
+          'SHARE_GEOMETRY' : SHARE_GEOMETRY,
+          'OUT_NC' : OUT_NC,
+         }
+
+# report the number of reads of each variable per file to verify the cache
+COUNT_READS = True
+
+# number of worker processes over (analysis hour, domain) work units, where the
+# work units are processed serially in the main process if N_WORKERS = 1
+N_WORKERS = 1
+
+# OpenMP threads of wrf-python per worker, where 0 divides the available cores
+# evenly over the workers
+OMP_THREADS = 0
+
+# number of wrfout files read ahead in a background thread while the current
+# file is processed, in the serial processing only, or read when opened if 0,
+# where the files are loaded whole into memory if IN_MEMORY, at the cost of
+# holding up to PREFETCH_AHEAD + 1 files in memory, else streamed through the
+# page cache.  Files are read whole, so that prefetching is disabled with a
+# REGION, and files with all fields in the diagnostics cache are not read.
+PREFETCH_AHEAD = 2
+IN_MEMORY = False
+
+##################################################################################
+# Processing methods
+##################################################################################
+# returns the number of cores available to this process, e.g., in a SLURM job
+
+def get_n_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+
+    except AttributeError:
+        return os.cpu_count()
+
+##################################################################################
+# sets the wrf-python OpenMP threads of a process
+
+def set_omp_threads(n_threads):
+    if omp_enabled():
+        omp_set_num_threads(n_threads)
+
+##################################################################################
+# returns the path of the wrfout file of an analysis hour / domain
+
+def get_in_path(anl_dt, domain):
+    return IN_DIR + '/wrfout_' + domain + '_' + anl_dt
+
+##################################################################################
+# returns the path of the processed output of an analysis hour
+
+def get_out_path(anl_dt):
+    fname = OUT_DIR + '/start_' + START_DT + '_forecast_' + anl_dt
+
+    return fname + '.nc' if OUT_NC else fname + '.bin'
+
+##################################################################################
+# returns True if the output of an analysis hour is recorded as complete
+
+def is_hour_complete(anl_dt):
+    in_paths = [get_in_path(anl_dt, domain) for domain in domains]
+
+    return is_complete(manifest, get_out_path(anl_dt), in_paths, PARAMS,
+                       use_hash=HASH_INPUTS)
+
+##################################################################################
+# returns the keys of the domain grids in the geometry store
+
+def known_grids():
+    if SHARE_GEOMETRY:
+        return frozenset(geo_store['grids'])
+
+    else:
+        return frozenset()
+
+##################################################################################
+# computes the pressure-level / 2D fields of the outputs, a subset of OUTPUTS,
+# from a wrfout file, reading the variables of all diagnostics once into the
+# cache, where the NumPy backend evaluates the fields in one pass over the
+# derived-field registry, computing the shared intermediates, e.g., the full
+# pressure or the destaggered winds, once
+
+def compute_fields(nc_file, outputs):
+    print(STR_INDT * 2 + 'Caching variables')
+    cache = extract_vars(nc_file, 0, CACHE_VARS)
+    if DIAG_BACKEND == 'np':
+        return eval_fields(nc_file, outputs, cache=cache, pls=PLVS,
+                           log_p=LOG_P)
+
+    # with getvar, sharing the interpolation weights over all 3D fields
+    fields = {}
+    p_ds = getvar(nc_file, 'pressure', cache=cache)
+    weights = build_interp_weights(p_ds, PLVS, log_p=LOG_P)
+    for k in range(n_vars):
+        fields[IN_VARS[k] + '_pl'], _ = interp_D3_vars(nc_file, weights,
+                                                       IN_VARS[k], UNITS[k],
+                                                       cache=cache)
+
+    fields['slp'] = to_np(getvar(nc_file, 'slp', units='hPa', cache=cache))
+    ivt = comp_IVT_IWV_fast(nc_file, p_ds, cache=cache)
+    for name, val in zip(['ivtm', 'ivtu', 'ivtv', 'iwv'], ivt):
+        fields[name] = to_np(val)
+
+    return fields
+
+##################################################################################
+# processes the wrfout file of a single analysis hour / domain, returning the
+# domain data, the geometry and the nesting attributes of the domain, where the
+# geometry is None if the domain grid is in the set of known grids
+
+def process_domain(anl_dt, i, known, memory=None):
+    domain = domains[i]
+    fname = get_in_path(anl_dt, domain)
+    print(STR_INDT * 2 + 'Opening file ' + fname)
+    try:
+        nc_file, window = open_wrfout(fname, REGION, memory=memory)
+        if COUNT_READS:
+            nc_file = CountingDataset(nc_file)
+
+    except:
+        print(fname + ' does not exist, skipping')
+        raise
+
+    # compare the NumPy diagnostics backend against getvar
+    if CHECK_PARITY:
+        cache = extract_vars(nc_file, 0, CACHE_VARS)
+        print(STR_INDT * 2 + 'Relative difference of the NumPy diagnostics:')
+        for k in range(n_vars):
+            err = diag_parity(nc_file, IN_VARS[k], UNITS[k], cache=cache)
+            print(STR_INDT * 3 + IN_VARS[k] + ' ' + str(err))
+
+        err = diag_parity(nc_file, 'slp', 'hPa', cache=cache)
+        print(STR_INDT * 3 + 'slp ' + str(err))
+
+    # compute the geometry of the domain grid only if not already known
+    grid_key = get_grid_key(nc_file, domain, window)
+    if grid_key in known:
+        print(STR_INDT * 2 + 'Using stored geometry of grid')
+        geo = None
+
+    else:
+        # Get the lat / lon, plot limits and projection of domain, with the
+        # grid points in x / y ON THE PARENT DOMAIN 
+        print(STR_INDT * 2 + 'Computing the geometry of grid')
+        p_ds = getvar(nc_file, 'pressure')
+        if i == 0:
+            geo = domain_geometry(p_ds, nc_file)
+
+        else:
+            p_file, _ = open_wrfout(get_in_path(anl_dt, domains[0]), REGION)
+            with p_file:
+                geo = domain_geometry(p_ds, p_file)
+
+    # add the grid key under domain key
+    print(STR_INDT * 2 + 'Begin processing domain ' + domain)
+    data = {'grid' : grid_key} if SHARE_GEOMETRY else {}
+    if diag_cache is None:
+        fields = compute_fields(nc_file, OUTPUTS)
+
+    else:
+        # read / compute only the fields missing from the diagnostics cache
+        compute = lambda missing: compute_fields(nc_file, missing)
+        fields = cached_fields(diag_cache, fname, OUTPUTS, compute,
+                               DIAG_BACKEND, pls=PLVS, log_p=LOG_P,
+                               extra={'region' : window},
+                               use_hash=HASH_INPUTS)
+        print(STR_INDT * 2 + 'Diagnostics cache: ' + diag_cache.format_stats())
+
+    # add the 3D fields interpolated to all pressure levels to data dict
+    print(STR_INDT * 2 + 'Begin interpolating 3D fields to pressure levels:')
+    for pl in PLVS:
+        data['pl_' + str(pl)] = {}
+
+    for k in range(n_vars):
+        print(STR_INDT * 3 + 'Variable ' + IN_VARS[k] +\
+                ' interpolated to ' + OUT_VARS[k])
+        pl_vars = fields[IN_VARS[k] + '_pl']
+
+        # level dimension precedes the horizontal dimensions
+        for j, pl in enumerate(PLVS):
+            data['pl_' + str(pl)][OUT_VARS[k]] = pl_vars[..., j, :, :]
+    
+    # add 2D fields to data dict
+    print(STR_INDT * 2 + 'Begin processing 2D fields:')
+    print(STR_INDT * 3 + 'Sea level pressure')
+    data['slp'] = fields['slp']
+    print(STR_INDT * 3 + 'IVT and IWV')
+    data['ivtm'] = fields['ivtm']
+    data['ivtu'] = fields['ivtu']
+    data['ivtv'] = fields['ivtv']
+    data['iwv']  = fields['iwv']
+
+    # get the nesting attributes of the domain
+    nest_attrs = get_nest_attrs(nc_file)
+
+    if COUNT_READS:
+        print(STR_INDT * 2 + 'Variable reads in domain ' + domain + ': ' +\
+                format_read_counts(nc_file.reads))
+
+    nc_file.close()
+    print(STR_INDT * 2 + 'Finished processing domain ' + domain)
+
+    return data, geo, nest_attrs
+
+##################################################################################
+# merges the domain data of an analysis hour and writes it out
+
+def write_hour(anl_dt, results):
+    new_geo = False
+    if SHARE_GEOMETRY:
+        # add the geometry of new grids to the geometry store
+        for result in results:
+            if result[1] is not None and \
+                    result[0]['grid'] not in geo_store['grids']:
+                geo_store['grids'][result[0]['grid']] = result[1]
+                new_geo = True
+
+        grids = [geo_store['grids'][result[0]['grid']] for result in results]
+
+        # create storage for data, referencing the geometry store and the grid
+        # of the parent domain for the cartopy mapping object
+        data = {
+                'geometry' : {
+                              'path' : os.path.relpath(GEO_PATH, OUT_DIR),
+                              'root' : results[0][0]['grid'],
+                             },
+                'date' : anl_dt,
+               }
+
+    else:
+        grids = [result[1] for result in results]
+
+        # create storage for data, with the cartopy mapping object of parent
+        # domain
+        data = {
+                'cart_proj' : grids[0]['cart_proj'],
+                'date' : anl_dt,
+               }
+
+    # nesting attributes of all domains keyed by grid id
+    attrs_ids = [result[2]['GRID_ID'] for result in results]
+    attrs = {result[2]['GRID_ID']: result[2] for result in results}
+
+    for i in range(MAX_DOM):
+        if SHARE_GEOMETRY:
+            data[domains[i]] = results[i][0]
+
+        else:
+            # add grid data under domain key
+            data[domains[i]] = {name: grids[i][name] for name in GEO_FIELDS}
+            data[domains[i]].update(results[i][0])
+
+        if i >=1 and 'indx' not in grids[i]:
+            print(STR_INDT * 2 +\
+                    'Find parent grid indices that lie within the nested domain')
+            if NEST_FROM_ATTRS and REGION is None:
+                xy = None
+
+            else:
+                xy = (
+                      grids[0]['xx'], grids[0]['yy'],
+                      grids[i]['xx'], grids[i]['yy'],
+                     )
+
+            # indices for the values of the parent domain lying in the nest,
+            # computed once per pair of grids
+            indx = get_nest_indices(attrs, attrs_ids[i], attrs_ids[0], xy=xy)
+            if SHARE_GEOMETRY:
+                grids[i]['indx'] = indx
+                new_geo = True
+
+            else:
+                data[domains[i]]['indx'] = indx,
+
+    if new_geo:
+        print(STR_INDT * 2 + 'Writing geometry store ' + GEO_PATH)
+        save_geo_store(geo_store, GEO_PATH)
+
+    print(STR_INDT * 2 + 'Completed processing all domains')
+    fname = get_out_path(anl_dt)
+    print(STR_INDT * 2 + 'Writing processed data out to ' + fname)
+    if OUT_NC:
+        write_np_data(data, fname)
+
+    else:
+        f = open(fname, 'wb')
+        pickle.dump(data,f)
+        f.close()
+
+    # record the completed output with the identity of its inputs
+    in_paths = [get_in_path(anl_dt, domain) for domain in domains]
+    record_output(manifest, MANIFEST, fname, in_paths, PARAMS,
+                  use_hash=HASH_INPUTS)
+
+##################################################################################
+# returns whether all fields of a wrfout file are in the diagnostics cache
+
+def is_cached(fname):
+    if diag_cache is None or CHECK_PARITY:
+        return False
+
+    try:
+        return has_fields(diag_cache, fname, OUTPUTS, DIAG_BACKEND, pls=PLVS,
+                          log_p=LOG_P, extra={'region' : None},
+                          use_hash=HASH_INPUTS)
+
+    except OSError:
+        # a missing file raises when opened
+        return False
+
+##################################################################################
+# processes all analysis hours serially in the main process, reading the files
+# of the next domains / hours ahead of their processing
+
+def process_serial(anl_dts):
+    in_paths = [get_in_path(anl_dt, domain)
+                for anl_dt in anl_dts for domain in domains]
+    if REGION is None:
+        ahead = PREFETCH_AHEAD
+        in_memory = IN_MEMORY
+
+    else:
+        ahead = 0
+        in_memory = False
+
+    with Prefetcher(in_paths, ahead=ahead, in_memory=in_memory,
+                    skip=is_cached) as reader:
+        for anl_dt in anl_dts:
+            print(STR_INDT + 'Begin analysis of simulation hour ' + anl_dt)
+            results = []
+            for i in range(MAX_DOM):
+                _, memory = next(reader)
+                results.append(process_domain(anl_dt, i, known_grids(),
+                                              memory=memory))
+
+            write_hour(anl_dt, results)
+
+    print('Prefetching: ' + reader.format_stats())
+
+##################################################################################
+# processes the (analysis hour, domain) work units of the analysis hours over
+# the pool, writing each analysis hour once all of its domains complete
+
+def process_pool(pool, anl_dts):
+    results = {}
+    futures = {}
+    known = known_grids()
+    for anl_dt in anl_dts:
+        results[anl_dt] = [None] * MAX_DOM
+        for i in range(MAX_DOM):
+            future = pool.submit(process_domain, anl_dt, i, known)
+            futures[future] = (anl_dt, i)
+
+    for future in as_completed(futures):
+        anl_dt, i = futures[future]
+        results[anl_dt][i] = future.result()
+        if all(result is not None for result in results[anl_dt]):
+            print(STR_INDT + 'Completed simulation hour ' + anl_dt)
+            write_hour(anl_dt, results.pop(anl_dt))
+
+##################################################################################
+# processes all analysis hours over a process pool, with the OpenMP threads of
+# each worker sized so that workers do not oversubscribe the cores.  The first
+# hour is processed alone so that the geometry of the grids is computed once.
+
+def process_parallel(anl_dts, n_workers, omp_threads):
+    if not omp_threads:
+        omp_threads = max(1, get_n_cores() // n_workers)
+
+    print('Running ' + str(n_workers) + ' workers with ' + str(omp_threads) +\
+            ' OpenMP threads each')
+
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=set_omp_threads,
+                             initargs=(omp_threads,)) as pool:
+        process_pool(pool, anl_dts[:1])
+        process_pool(pool, anl_dts[1:])
+
 ##################################################################################
 # Process data
 ##################################################################################
-# make output root
-os.system('mkdir -p ' + OUT_DIR)
 anl_hrs = range(ANL_START, ANL_END + 1, ANL_INT)
 
 # convert to date time object
@@ -102,147 +563,58 @@ start_dt = dt.fromisoformat(START_DT)
 # define the total number of vars to process
 n_vars = len(IN_VARS)
 
-print('Begin analysis of simulations starting on ' + START_DT)
-print('Processing variables:')
-for i in range(n_vars):
-    print(STR_INDT + IN_VARS[i] + ' in units ' + UNITS[i] + ' to ' + OUT_VARS[i])
-    
 domains = []
-print('Over domains:')
 for i in range(1, MAX_DOM + 1):
-    print(STR_INDT + 'd0%s'%i)
     exec('domains.append(\'d0%i\')'%i)
-    
-# loop over analysis hours
-for hr in anl_hrs:
-    # output formatted analysis date time string
-    anl_dt = start_dt + timedelta(hours=hr)
-    anl_dt = anl_dt.strftime('%Y-%m-%d_%H:%M:%S')
-    print(STR_INDT + 'Begin analysis of simulation hour ' + anl_dt)
-
-    # define storage for each domain's output files
-    nc_files = []
-    p_ds = []
-    lats = []
-    lons = []
-    x_lims = []
-    y_lims = []
-    xxs = []
-    yys = []
-    
-    for i in range(MAX_DOM):
-        # Open the NetCDF files
-        fname = IN_DIR + '/wrfout_' + domains[i] + '_' + anl_dt
-        print(STR_INDT * 2 + 'Opening file ' + fname)
-        try:
-            nc_files.append(Dataset(fname))
-        except:
-            print(fname + ' does not exist, skipping')
-            pass
-    
-        # extract the pressures in domain
-        print(STR_INDT * 2 + 'Extracting pressure levels')
-        p_ds.append(getvar(nc_files[i], 'pressure'))
-    
-        # Get the latitude and longitude points of domain
-        print(STR_INDT * 2 + 'Extracting lat and lon values for grid')
-        lat, lon = latlon_coords(p_ds[i])
-        lats.append(to_np(lat))
-        lons.append(to_np(lon))
-        
-        # get the boundary of the domain
-        x_lim = cartopy_xlim(p_ds[i])
-        y_lim = cartopy_ylim(p_ds[i])
-        x_lims.append(x_lim)
-        y_lims.append(y_lim)
-        
-        # grid the points in x / y ON THE PARENT DOMAIN 
-        print(STR_INDT * 2 +\
-                'Extracting x / y grid values corresponding to parent domain')
-        xx, yy = ll_to_xy(nc_files[0], lat, lon, meta=False)  
-        xxs.append(xx)
-        yys.append(yy)
-    
-    # get the cartopy mapping object of parent domain
-    cart_proj = get_cartopy(p_ds[0])
-        
-    # create storage for data
-    data = {
-            'cart_proj' : cart_proj,
-            'date' : anl_dt,
-           }
-    
-    for i in range(MAX_DOM):
-        print(STR_INDT * 2 + 'Begin processing domain ' + domains[i])
-        # add grid data under domain key
-        data[domains[i]] = { 
-                            'xx' : xxs[i],
-                            'yy' : yys[i],
-                            'lons' : lons[i],
-                            'lats' : lats[i],
-                            'x_lim' : x_lims[i],
-                            'y_lim' : y_lims[i],
-                           }
-    
-        # interpolate 3D fields to pressure levels and add to data dict
-        print(STR_INDT * 2 + 'Begin interpolating 3D fields to pressure levels:')
-        for pl in PLVS:
-            print(STR_INDT * 3 + 'Interpolating pressure level ' + str(pl))
-            key = 'pl_' + str(pl)
-            data[domains[i]][key] = {}
-    
-            for k in range(n_vars):
-                print(STR_INDT * 4 + 'Variable ' + IN_VARS[k] +\
-                        ' interpolated to ' + OUT_VARS[k])
-                pl_var = process_D3_vars(nc_files[i], p_ds[i],
-                                         pl, IN_VARS[k], UNITS[k])
-    
-                data[domains[i]][key][OUT_VARS[k]] = to_np(pl_var) 
-        
-        # extract / compute 2D fields and add to data dict
-        print(STR_INDT * 2 + 'Begin processing 2D fields:')
-        print(STR_INDT * 3 + 'Sea level pressure')
-        data[domains[i]]['slp'] = to_np(getvar(nc_files[i], 'slp', units='hPa'))
-        print(STR_INDT * 3 + 'IVT and IWV')
-        ivtm, ivtu, ivtv, iwv = comp_IVT_IWV(nc_files[i], p_ds[i])
-        data[domains[i]]['ivtm'] = to_np(ivtm) 
-        data[domains[i]]['ivtu'] = to_np(ivtu)
-        data[domains[i]]['ivtv'] = to_np(ivtv)
-        data[domains[i]]['iwv']  = to_np(iwv) 
-    
-        if i >=1:
-            print(STR_INDT * 2 +\
-                    'Find parent grid indices that lie within the nested domain')
-            # find the min / max indices of the nest grid
-            d_end = [
-                       [np.min(xxs[i]), np.max(xxs[i])],
-                       [np.min(yys[i]), np.max(yys[i])],
-                      ]
-            
-            lines = len(xxs[0])
-            indx = []
-            
-            # find all indices of the parent domain that lie within the nest
-            for j in range(lines):
-                if (
-                    xxs[0][j] >= d_end[0][0] and\
-                    xxs[0][j] <= d_end[0][1] and\
-                    yys[0][j] >= d_end[1][0] and\
-                    yys[0][j] <= d_end[1][1]
-                   ):
-                    indx.append(j)
-    
-            # append indices for the values of the parent domain lying in the nest
-            data[domains[i]]['indx'] = indx,
-    
-        print(STR_INDT * 2 + 'Finished processing domain ' + domains[i])
-    
-    print(STR_INDT * 2 + 'Completed processing all domains')
-    fname = OUT_DIR + '/start_' + START_DT + '_forecast_' + anl_dt + '.bin'
-    print(STR_INDT * 2 + 'Writing processed data out to ' + fname)
-    f = open(fname, 'wb')
-    pickle.dump(data,f)
-    f.close()
+
+# geometry of the domain grids computed over all previous runs
+geo_store = load_geo_store(GEO_PATH) if SHARE_GEOMETRY else None
+
+# outputs completed over all previous runs
+manifest = load_manifest(MANIFEST)
+
+# diagnostics computed over all previous runs
+if DIAG_CACHE_DIR is None:
+    diag_cache = None
+
+else:
+    diag_cache = DiagCache(DIAG_CACHE_DIR, quota=DIAG_CACHE_QUOTA)
+
+if __name__ == '__main__':
+    # make output root
+    os.system('mkdir -p ' + OUT_DIR)
+
+    print('Begin analysis of simulations starting on ' + START_DT)
+    print('Processing variables:')
+    for i in range(n_vars):
+        print(STR_INDT + IN_VARS[i] + ' in units ' + UNITS[i] + ' to ' +\
+                OUT_VARS[i])
+
+    print('Caching variables:')
+    print(STR_INDT + ', '.join(CACHE_VARS))
+
+    print('Over domains:')
+    for domain in domains:
+        print(STR_INDT + domain)
+
+    # output formatted analysis date time strings
+    anl_dts = []
+    for hr in anl_hrs:
+        anl_dt = start_dt + timedelta(hours=hr)
+        anl_dts.append(anl_dt.strftime('%Y-%m-%d_%H:%M:%S'))
+
+    # skip completed outputs, unless the geometry they reference is missing
+    if RESUME and (os.path.isfile(GEO_PATH) or not SHARE_GEOMETRY):
+        n_hrs = len(anl_dts)
+        anl_dts = [anl_dt for anl_dt in anl_dts if not is_hour_complete(anl_dt)]
+        print('Skipping ' + str(n_hrs - len(anl_dts)) + ' of ' + str(n_hrs) +\
+                ' analysis hours with complete outputs')
+
+    if N_WORKERS > 1:
+        process_parallel(anl_dts, N_WORKERS, OMP_THREADS)
+
+    else:
+        process_serial(anl_dts)
 
 ##################################################################################
 # end
@@ -46,6 +46,12 @@
 ##################################################################################
 from datetime import datetime as dt
 from datetime import timedelta
+import xarray as xr
+import pickle
+import hashlib
+import fcntl
+import json
+import os
 
 ##################################################################################
 # SET GLOBAL PARAMETERS 
@@ -84,5 +90,124 @@ def get_anls(start_date, end_date, cycle_int):
 
     return zip(anl_dates, anl_strng)
 
+##################################################################################
+# writes a dictionary of DataFrames to the groups of a NetCDF4 file, with one
+# zlib compressed variable per column, in place of a pickled dictionary
+
+def write_tables(tables, out_path, complevel=4):
+    mode = 'w'
+    for name, table in tables.items():
+        ds = table.infer_objects().to_xarray()
+        encoding = {}
+        for var in ds.data_vars:
+            if ds[var].dtype.kind in 'biufM':
+                encoding[var] = {'zlib' : True, 'complevel' : complevel}
+
+        ds.to_netcdf(out_path, mode=mode, group=name, format='NETCDF4',
+                     encoding=encoding)
+        mode = 'a'
+
+##################################################################################
+# reads a DataFrame from a group of a NetCDF4 file written by write_tables,
+# reading only the listed columns if given, or from the pickled dictionary of a
+# .bin file
+
+def read_table(in_path, name, columns=None):
+    if in_path.endswith('.bin'):
+        with open(in_path, 'rb') as f:
+            table = pickle.load(f)[name]
+
+    else:
+        with xr.open_dataset(in_path, group=name) as ds:
+            if columns is not None:
+                ds = ds[columns]
+
+            table = ds.to_dataframe()
+
+    if columns is not None:
+        table = table[columns]
+
+    return table
+
+##################################################################################
+# returns the identity of a file as its size and modification time, adding its
+# SHA-256 hash if use_hash is True to detect rewrites that keep both
+
+def file_identity(path, use_hash=False):
+    stat = os.stat(path)
+    identity = {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+    if use_hash:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+
+        identity['sha256'] = sha.hexdigest()
+
+    return identity
+
+##################################################################################
+# loads the manifest of completed outputs, or an empty manifest if none exists
+
+def load_manifest(path):
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+
+    return {}
+
+##################################################################################
+# writes the manifest atomically, so an interrupted run never leaves it
+# partially written
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp.' + str(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_path, path)
+
+##################################################################################
+# returns the manifest entry of an output from the identities of its inputs
+# and its processing parameters, normalized as stored in JSON
+
+def manifest_entry(in_paths, params, use_hash=False):
+    return {
+            'inputs' : {path: file_identity(path, use_hash=use_hash)
+                        for path in in_paths},
+            'params' : json.loads(json.dumps(params)),
+           }
+
+##################################################################################
+# returns True if the output exists and is recorded in the manifest with the
+# same inputs, unchanged, and the same processing parameters
+
+def is_complete(manifest, out_path, in_paths, params, use_hash=False):
+    entry = manifest.get(os.path.abspath(out_path))
+    if entry is None or not os.path.isfile(out_path):
+        return False
+
+    try:
+        return entry == manifest_entry(in_paths, params, use_hash=use_hash)
+
+    except OSError:
+        # an input is missing
+        return False
+
+##################################################################################
+# records a completed output in the manifest and writes the manifest, merging in
+# place the outputs recorded by concurrent processes since the manifest was
+# loaded, e.g., by the watcher workers or array jobs, under a lock of the
+# manifest, so that no completed output is lost
+
+def record_output(manifest, path, out_path, in_paths, params,
+                  use_hash=False):
+    entry = manifest_entry(in_paths, params, use_hash=use_hash)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest.update(load_manifest(path))
+        manifest[os.path.abspath(out_path)] = entry
+        save_manifest(manifest, path)
+
 ##################################################################################
 # end
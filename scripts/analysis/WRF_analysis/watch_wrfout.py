@@ -0,0 +1,292 @@
+##################################################################################
+# Description
+##################################################################################
+# This script watches a wrfprd directory while WRF is running and hands each
+# forecast hour to the processing pipeline as soon as the wrfout files of all
+# of its domains are complete, so that diagnostics are ready within minutes of
+# the model finishing rather than after a full post-processing run.  A wrfout
+# file is complete once WRF has opened a later output of the same domain, once
+# the forecast has logged its successful completion, or once its size and
+# modification time are unchanged over SETTLE_T seconds and it opens as a valid
+# NetCDF file.  The directory is polled, as inotify is not available on all
+# parallel file systems.  Each forecast hour is processed by running
+# proc_wrfout_np.py over that hour, with the same arguments as that script.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+from netCDF4 import Dataset
+import subprocess
+import glob
+import time
+import os
+import sys
+from datetime import datetime as dt
+from datetime import timedelta
+from py_plt_utilities import STR_INDT
+
+##################################################################################
+# SET GLOBAL PARAMETERS
+##################################################################################
+# read in paths and start / analysis date time from function call, as in
+# proc_wrfout_np.py
+IN_DIR = sys.argv[1] 
+OUT_DIR = sys.argv[2]
+START_DT = sys.argv[3]
+ANL_START = int(sys.argv[4])
+ANL_INT = int(sys.argv[5])
+ANL_END = int(sys.argv[6])
+
+# domains to be processed, this assumes completely heirarchical nesting
+MAX_DOM = 2
+
+# seconds between polls of the wrfprd directory
+POLL_INT = 30
+
+# seconds the size / modification time of the latest wrfout file of a domain
+# must be unchanged to consider it complete
+SETTLE_T = 120
+
+# seconds to wait without any new complete forecast hour before giving up
+WAIT_MAX = 6 * 3600
+
+# max number of forecast hours processed at once
+MAX_PROCS = 1
+
+# processing script run over each complete forecast hour
+PROC_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'proc_wrfout_np.py')
+
+# message logged to the rsl files on successful completion of the forecast
+WRF_COMPLETE = 'SUCCESS COMPLETE WRF'
+
+##################################################################################
+# Watch methods
+##################################################################################
+# returns the path of the wrfout file of an analysis hour / domain
+
+def get_in_path(anl_dt, domain):
+    return IN_DIR + '/wrfout_' + domain + '_' + anl_dt
+
+##################################################################################
+# returns True if the tail of the rsl file logs the completion of WRF
+
+def rsl_complete(rsl_path):
+    try:
+        with open(rsl_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4096))
+            return WRF_COMPLETE in f.read().decode(errors='ignore')
+
+    except OSError:
+        return False
+
+##################################################################################
+# returns True if the forecast writing the wrfout files has completed, from the
+# rsl files in the working directory, or those moved to an rsl.wrf.* directory
+# at the end of the run if newer than the wrfout files, ignoring earlier runs
+
+def forecast_complete(since):
+    if rsl_complete(IN_DIR + '/rsl.out.0000'):
+        return True
+
+    for rsl_path in glob.glob(IN_DIR + '/rsl.wrf.*/rsl.out.0000'):
+        if os.path.getmtime(rsl_path) >= since and rsl_complete(rsl_path):
+            return True
+
+    return False
+
+##################################################################################
+# returns True if the file opens as a NetCDF file with a written time record
+
+def is_readable(path):
+    try:
+        with Dataset(path) as ds:
+            return len(ds.dimensions['Time']) > 0
+
+    except (OSError, KeyError):
+        return False
+
+##################################################################################
+# returns True if WRF has finished writing the wrfout file, where sizes maps
+# file paths to their last seen (size, mtime) and the time they were first seen
+
+def is_file_complete(path, later_exists, wrf_done, sizes, now):
+    if not os.path.isfile(path):
+        return False
+
+    if later_exists or wrf_done:
+        return True
+
+    stat = os.stat(path)
+    sig = (stat.st_size, stat.st_mtime_ns)
+    if path not in sizes or sizes[path][0] != sig:
+        sizes[path] = (sig, now)
+        return False
+
+    return now - sizes[path][1] >= SETTLE_T and is_readable(path)
+
+##################################################################################
+# returns the analysis hours with wrfout files complete over all domains
+
+def find_complete(anl_dts, sizes, now):
+    # latest wrfout file of each domain, where names sort by date
+    latest = {}
+    for domain in domains:
+        outs = sorted(glob.glob(IN_DIR + '/wrfout_' + domain + '_*'))
+        latest[domain] = outs[-1] if outs else None
+
+    wrf_done = None
+    complete = []
+    for anl_dt in anl_dts:
+        done = True
+        for domain in domains:
+            path = get_in_path(anl_dt, domain)
+            later_exists = latest[domain] is not None and latest[domain] > path
+            if not later_exists and wrf_done is None and os.path.isfile(path):
+                # check the rsl files only once the latest outputs are reached
+                wrf_done = forecast_complete(os.path.getmtime(path))
+
+            if not is_file_complete(path, later_exists, bool(wrf_done), sizes,
+                                    now):
+                done = False
+                break
+
+        if done:
+            complete.append(anl_dt)
+
+    return complete
+
+##################################################################################
+# starts processing of a single forecast hour with the processing script
+
+def start_proc(hr):
+    cmd = [
+           sys.executable, PROC_SCRIPT, IN_DIR, OUT_DIR, START_DT, str(hr),
+           str(ANL_INT), str(hr),
+          ]
+    print(STR_INDT + 'Running ' + ' '.join(cmd))
+
+    return subprocess.Popen(cmd, cwd=os.path.dirname(PROC_SCRIPT))
+
+##################################################################################
+# watches the wrfprd directory until all forecast hours are processed or no new
+# forecast hour completes within WAIT_MAX seconds, returning failed hours
+
+def watch(anl_hrs):
+    anl_dts = [(start_dt + timedelta(hours=hr)).strftime('%Y-%m-%d_%H:%M:%S')
+               for hr in anl_hrs]
+    hrs = dict(zip(anl_dts, anl_hrs))
+    pending = list(anl_dts)
+    queue = []
+    running = {}
+    failed = []
+    sizes = {}
+    t_last = time.time()
+
+    while pending or queue or running:
+        now = time.time()
+
+        # queue forecast hours once complete, in forecast order
+        for anl_dt in find_complete(pending, sizes, now):
+            print('Forecast hour ' + anl_dt + ' is complete')
+            pending.remove(anl_dt)
+            queue.append(anl_dt)
+            t_last = now
+
+        # collect finished processing
+        for anl_dt, proc in list(running.items()):
+            if proc.poll() is not None:
+                if proc.returncode != 0:
+                    print('Processing of ' + anl_dt + ' failed with code ' +\
+                          str(proc.returncode))
+                    failed.append(anl_dt)
+
+                else:
+                    print('Processing of ' + anl_dt + ' complete')
+
+                del running[anl_dt]
+
+        # start processing of queued hours
+        while queue and len(running) < MAX_PROCS:
+            anl_dt = queue.pop(0)
+            running[anl_dt] = start_proc(hrs[anl_dt])
+
+        if pending and now - t_last > WAIT_MAX:
+            print('No forecast hour completed in ' + str(WAIT_MAX) +\
+                  ' seconds, stopping watch with hours pending:')
+            for anl_dt in pending:
+                print(STR_INDT + anl_dt)
+
+            failed += pending
+            pending = []
+
+        if pending or queue or running:
+            time.sleep(POLL_INT)
+
+    return failed
+
+##################################################################################
+# Watch data
+##################################################################################
+anl_hrs = range(ANL_START, ANL_END + 1, ANL_INT)
+
+# convert to date time object
+start_dt = dt.fromisoformat(START_DT)
+
+domains = []
+for i in range(1, MAX_DOM + 1):
+    exec('domains.append(\'d0%i\')'%i)
+
+if __name__ == '__main__':
+    print('Watching ' + IN_DIR + ' for forecast hours ' + str(ANL_START) +\
+          ' to ' + str(ANL_END) + ' every ' + str(ANL_INT) + ' hours')
+    failed = watch(anl_hrs)
+    if failed:
+        print('Forecast hours not processed:')
+        for anl_dt in failed:
+            print(STR_INDT + anl_dt)
+
+        sys.exit(1)
+
+    print('All forecast hours processed')
+
+##################################################################################
+# end
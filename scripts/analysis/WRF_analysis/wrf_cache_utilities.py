@@ -0,0 +1,330 @@
+##################################################################################
+# Description
+##################################################################################
+# This module contains utility methods for a persistent, content-addressed cache
+# of computed diagnostics, shared by the processing scripts over runs.  Each
+# entry is keyed by the SHA-256 hash of the identities of the input wrfout
+# files, the diagnostic, its units, the time index, the processing parameters it
+# depends on, e.g., the pressure levels of interpolated fields, and the version
+# of the code computing it, and is stored as a compressed .npz file of the
+# arrays and their attributes.  The cache is kept below a size quota by evicting
+# the least recently used entries, with the modification time of the entries
+# refreshed on every hit, and counts its hits / misses / evictions per process.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+import numpy as np
+import hashlib
+import json
+import os
+import wrf
+import wrf_py_utilities
+from py_plt_utilities import file_identity
+
+##################################################################################
+# SET GLOBAL PARAMETERS 
+##################################################################################
+# version of the cache format and keys, invalidating all entries when changed
+CACHE_VERSION = 1
+
+# default size quota of the cache in bytes
+QUOTA = 20 * 2**30
+
+# hash of the source of wrf_py_utilities, which computes the NumPy diagnostics
+# and interpolates the fields of all backends to pressure levels, read once
+with open(wrf_py_utilities.__file__, 'rb') as f:
+    SOURCE_HASH = hashlib.sha256(f.read()).hexdigest()[:16]
+
+##################################################################################
+# UTILITY METHODS
+##################################################################################
+# returns the version of the code computing the diagnostics of a backend, i.e.,
+# the hash of the source of wrf_py_utilities, with the wrf-python version for
+# getvar
+
+def code_version(backend):
+    version = backend + ' ' + SOURCE_HASH
+    if backend == 'wrf':
+        version += ' wrf-python ' + wrf.__version__
+
+    return version
+
+##################################################################################
+# returns the key of a diagnostic of the input wrfout files computed by the
+# backend, with the parameters in extra it depends on
+
+def diag_key(in_paths, var, units, backend, timeidx=0, extra=None,
+             use_hash=False):
+    if isinstance(in_paths, str):
+        in_paths = [in_paths]
+
+    key = {
+           'version' : CACHE_VERSION,
+           'code' : code_version(backend),
+           'inputs' : [[os.path.abspath(path),
+                        file_identity(path, use_hash=use_hash)]
+                       for path in in_paths],
+           'var' : var,
+           'units' : units or None,
+           'timeidx' : timeidx,
+           'extra' : extra,
+          }
+    key = json.dumps(key, sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+##################################################################################
+# converts the attributes of a diagnostic to JSON values, as strings if needed
+
+def json_attrs(attrs):
+    out = {}
+    for name, val in attrs.items():
+        if isinstance(val, np.generic):
+            val = val.item()
+
+        elif isinstance(val, np.ndarray):
+            val = val.tolist()
+
+        try:
+            json.dumps(val)
+
+        except TypeError:
+            val = str(val)
+
+        out[name] = val
+
+    return out
+
+##################################################################################
+# persistent cache of diagnostics in the directory root, with the size quota in
+# bytes
+
+class DiagCache:
+    def __init__(self, root, quota=QUOTA):
+        self.root = root
+        self.quota = quota
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self.entries())
+
+    # paths of all entries of the cache
+    def entries(self):
+        for dirpath, _, fnames in os.walk(self.root):
+            for fname in fnames:
+                if fname.endswith('.npz'):
+                    yield os.path.join(dirpath, fname)
+
+    # path of the entry of a key, sharded over subdirectories
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npz')
+
+    # returns whether the entry of a key is in the cache, without reading it
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    # returns the value, i.e., an array or a tuple of arrays, and the attributes
+    # of the entry of a key, or None if not cached
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as npz:
+                meta = json.loads(str(npz['meta']))
+                val = tuple(npz['arr_' + str(i)] for i in range(meta['n']))
+
+            # mark as recently used
+            os.utime(path)
+
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        except Exception:
+            # drop unreadable entries, e.g., partially copied
+            self.misses += 1
+            if os.path.isfile(path):
+                os.remove(path)
+
+            return None
+
+        self.hits += 1
+        if not meta['tuple']:
+            val = val[0]
+
+        return val, meta['attrs']
+
+    # stores the value and attributes of the entry of a key atomically, then
+    # evicts the least recently used entries if over the quota
+    def put(self, key, val, attrs=None):
+        is_tuple = isinstance(val, tuple)
+        arrays = val if is_tuple else (val,)
+        meta = {
+                'n' : len(arrays),
+                'tuple' : is_tuple,
+                'attrs' : json_attrs(attrs or {}),
+               }
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.' + str(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, *[np.asarray(arr) for arr in arrays],
+                                meta=json.dumps(meta))
+
+        # replace an existing entry of the key, e.g., written concurrently
+        try:
+            old_size = os.path.getsize(path)
+
+        except FileNotFoundError:
+            old_size = 0
+
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path) - old_size
+        if self.size > self.quota:
+            self.evict()
+
+    # returns the cached value and attributes of a key, computing them with
+    # compute() and storing them on a miss
+    def fetch(self, key, compute):
+        hit = self.get(key)
+        if hit is None:
+            hit = compute()
+            self.put(key, *hit)
+
+        return hit
+
+    # removes the least recently used entries until below the quota, rescanning
+    # the cache as other processes may share it
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        self.size = sum(entry[1] for entry in entries)
+        for _, size, path in entries:
+            if self.size <= self.quota:
+                break
+
+            try:
+                os.remove(path)
+
+            except FileNotFoundError:
+                pass
+
+            self.size -= size
+            self.evictions += 1
+
+    # formats the hit / miss statistics of the cache
+    def format_stats(self):
+        n = self.hits + self.misses
+        rate = 100 * self.hits / n if n else 0
+        return 'hits ' + str(self.hits) + ', misses ' + str(self.misses) +\
+                ' (' + '%.1f'%rate + '% hit rate), evictions ' +\
+                str(self.evictions) + ', size ' + '%.2f'%(self.size / 2**30) +\
+                ' GB'
+
+##################################################################################
+# returns the keys of the fields of the outputs, given as in eval_fields, where
+# pressure-level fields <name>_pl are keyed on pls / log_p as well
+
+def field_keys(in_paths, outputs, backend, timeidx=0, pls=None, log_p=True,
+               extra=None, use_hash=False):
+    keys = {}
+    for out in outputs:
+        name, units = (out, None) if isinstance(out, str) else out
+        out_extra = {'params' : extra}
+        if name.endswith('_pl'):
+            out_extra['pls'] = list(pls)
+            out_extra['log_p'] = log_p
+
+        keys[name] = diag_key(in_paths, name, units, backend, timeidx,
+                              extra=out_extra, use_hash=use_hash)
+
+    return keys
+
+##################################################################################
+# returns whether all fields of the outputs are in the cache, e.g., to skip
+# reading their input files ahead
+
+def has_fields(diag_cache, in_paths, outputs, backend, timeidx=0, pls=None,
+               log_p=True, extra=None, use_hash=False):
+    keys = field_keys(in_paths, outputs, backend, timeidx=timeidx, pls=pls,
+                      log_p=log_p, extra=extra, use_hash=use_hash)
+
+    return all(diag_cache.contains(key) for key in keys.values())
+
+##################################################################################
+# returns the fields of the outputs, given as in eval_fields, from the cache,
+# computing the missing outputs only with compute(missing) and storing them
+
+def cached_fields(diag_cache, in_paths, outputs, compute, backend, timeidx=0,
+                  pls=None, log_p=True, extra=None, use_hash=False):
+    keys = field_keys(in_paths, outputs, backend, timeidx=timeidx, pls=pls,
+                      log_p=log_p, extra=extra, use_hash=use_hash)
+    fields = {}
+    missing = []
+    for out in outputs:
+        name = out if isinstance(out, str) else out[0]
+        hit = diag_cache.get(keys[name])
+        if hit is None:
+            missing.append(out)
+
+        else:
+            fields[name] = hit[0]
+
+    if missing:
+        new = compute(missing)
+        for out in missing:
+            name = out if isinstance(out, str) else out[0]
+            fields[name] = new[name]
+            diag_cache.put(keys[name], new[name])
+
+    return fields
+
+##################################################################################
+# end
@@ -0,0 +1,287 @@
+##################################################################################
+# Description
+##################################################################################
+# This module contains utility methods for the grid geometry of nested WRF
+# domains, locating the points of a parent domain that lie within a nest.  Nest
+# bounds are found either from the x / y grid points of the nest on the parent
+# domain, or from the nesting attributes of the wrfout files, for any depth of
+# nesting.  Results are cached per pair of domains, as the grids of domains
+# without moving nests do not change over the forecast.
+# The geometry of each domain, i.e., lat / lon, x / y grid values on the
+# parent domain, plot limits and projection, is kept in a geometry store that is
+# persisted once per experiment and referenced by the processed outputs of each
+# forecast hour.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+import numpy as np
+import pickle
+import fcntl
+import os
+
+##################################################################################
+# SET GLOBAL PARAMETERS 
+##################################################################################
+# global attributes of wrfout files defining the nesting of a domain
+NEST_ATTRS = [
+              'GRID_ID', 'PARENT_ID', 'I_PARENT_START', 'J_PARENT_START',
+              'PARENT_GRID_RATIO', 'WEST-EAST_GRID_DIMENSION',
+              'SOUTH-NORTH_GRID_DIMENSION',
+             ]
+
+# map projection attributes of wrfout files, identifying the grid of a domain
+# along with the nesting attributes
+MAP_ATTRS = [
+             'MAP_PROJ', 'DX', 'DY', 'CEN_LAT', 'CEN_LON', 'TRUELAT1',
+             'TRUELAT2', 'STAND_LON',
+            ]
+
+# cache of parent indices lying within nests, keyed by the grids of the pair
+NEST_CACHE = {}
+
+# geometry fields of each domain kept in the geometry store
+GEO_FIELDS = ['xx', 'yy', 'lons', 'lats', 'x_lim', 'y_lim']
+
+# version of the geometry store format
+GEO_VERSION = 1
+
+##################################################################################
+# UTILITY METHODS
+##################################################################################
+# reads the nesting attributes of a wrfout file to a dictionary
+
+def get_nest_attrs(nc_file):
+    return {attr: int(nc_file.getncattr(attr)) for attr in NEST_ATTRS}
+
+##################################################################################
+# returns a hashable signature of the grid from its nesting attributes
+
+def grid_signature(nest_attrs):
+    return tuple(nest_attrs[attr] for attr in NEST_ATTRS)
+
+##################################################################################
+# returns the affine map (x0, y0, scale) from the mass point indices of a nest
+# to the mass point indices of its parent, x_parent = x0 + scale * x_nest
+#
+# The first staggered point of the nest coincides with the staggered point
+# I_PARENT_START of the parent, with PARENT_GRID_RATIO nest grid cells per
+# parent grid cell, and mass points lie at the centers of the cells.
+
+def nest_to_parent(nest_attrs):
+    scale = 1.0 / nest_attrs['PARENT_GRID_RATIO']
+    x0 = nest_attrs['I_PARENT_START'] - 1.5 + 0.5 * scale
+    y0 = nest_attrs['J_PARENT_START'] - 1.5 + 0.5 * scale
+
+    return x0, y0, scale
+
+##################################################################################
+# returns the affine map from the mass point indices of the domain grid_id to
+# those of its ancestor anc_id, composing the maps over the nesting chain where
+# attrs maps grid ids to the nesting attributes of each domain
+
+def nest_to_ancestor(attrs, grid_id, anc_id):
+    x0, y0, scale = 0.0, 0.0, 1.0
+    while grid_id != anc_id:
+        if grid_id not in attrs or attrs[grid_id]['PARENT_ID'] == grid_id:
+            raise ValueError('Domain ' + str(anc_id) + ' is not an ancestor ' +\
+                             'of the nest')
+
+        p_x0, p_y0, p_scale = nest_to_parent(attrs[grid_id])
+        x0 = p_x0 + p_scale * x0
+        y0 = p_y0 + p_scale * y0
+        scale = p_scale * scale
+        grid_id = attrs[grid_id]['PARENT_ID']
+
+    return x0, y0, scale
+
+##################################################################################
+# returns the bounds [[x_min, x_max], [y_min, y_max]] of the mass points of the
+# nest grid_id on the grid of ancestor anc_id, rounded to the nearest point of
+# the ancestor as with ll_to_xy
+
+def nest_bounds_from_attrs(attrs, grid_id, anc_id):
+    x0, y0, scale = nest_to_ancestor(attrs, grid_id, anc_id)
+    nx = attrs[grid_id]['WEST-EAST_GRID_DIMENSION'] - 1
+    ny = attrs[grid_id]['SOUTH-NORTH_GRID_DIMENSION'] - 1
+    d_end = [
+             [x0, x0 + scale * (nx - 1)],
+             [y0, y0 + scale * (ny - 1)],
+            ]
+
+    return np.rint(d_end).astype(int).tolist()
+
+##################################################################################
+# returns the bounds [[x_min, x_max], [y_min, y_max]] of the nest x / y grid
+# values on the parent domain
+
+def nest_bounds_from_xy(xx_n, yy_n):
+    return [
+            [np.min(xx_n), np.max(xx_n)],
+            [np.min(yy_n), np.max(yy_n)],
+           ]
+
+##################################################################################
+# returns the mask of parent x / y grid values lying within the nest bounds
+
+def nest_mask(xx_p, yy_p, d_end):
+    xx_p = np.asarray(xx_p)
+    yy_p = np.asarray(yy_p)
+
+    return (xx_p >= d_end[0][0]) & (xx_p <= d_end[0][1]) &\
+           (yy_p >= d_end[1][0]) & (yy_p <= d_end[1][1])
+
+##################################################################################
+# returns the flat indices of the parent grid points lying within the nest from
+# the x / y grid values of both domains on the parent domain
+
+def nest_indices_from_xy(xx_p, yy_p, xx_n, yy_n):
+    d_end = nest_bounds_from_xy(xx_n, yy_n)
+
+    return np.flatnonzero(nest_mask(xx_p, yy_p, d_end))
+
+##################################################################################
+# returns the flat indices of the points of ancestor anc_id lying within the
+# nest grid_id from the nesting attributes, without any grid values, where the
+# indices are ordered as the flattened (south_north, west_east) grid
+
+def nest_indices_from_attrs(attrs, grid_id, anc_id):
+    d_end = nest_bounds_from_attrs(attrs, grid_id, anc_id)
+    nx = attrs[anc_id]['WEST-EAST_GRID_DIMENSION'] - 1
+    ny = attrs[anc_id]['SOUTH-NORTH_GRID_DIMENSION'] - 1
+    x_0, x_1 = max(d_end[0][0], 0), min(d_end[0][1], nx - 1)
+    y_0, y_1 = max(d_end[1][0], 0), min(d_end[1][1], ny - 1)
+    xx, yy = np.meshgrid(np.arange(x_0, x_1 + 1), np.arange(y_0, y_1 + 1))
+
+    return np.ravel(yy * nx + xx)
+
+##################################################################################
+# returns the cached flat indices of the points of ancestor anc_id lying within
+# the nest grid_id, computed from the nesting attributes, or from the x / y grid
+# values on the ancestor in xy = (xx_p, yy_p, xx_n, yy_n) if given
+
+def get_nest_indices(attrs, grid_id, anc_id, xy=None):
+    key = (grid_signature(attrs[anc_id]), grid_signature(attrs[grid_id]),
+           xy is None)
+    if key not in NEST_CACHE:
+        if xy is None:
+            NEST_CACHE[key] = nest_indices_from_attrs(attrs, grid_id, anc_id)
+
+        else:
+            NEST_CACHE[key] = nest_indices_from_xy(*xy)
+
+    return NEST_CACHE[key]
+
+##################################################################################
+# returns the key of a domain in the geometry store from the nesting and map
+# projection attributes of its wrfout file, and the index window of the region
+# the domain is subset to, if any
+
+def get_grid_key(nc_file, domain, window=None):
+    map_attrs = tuple(float(nc_file.getncattr(attr)) for attr in MAP_ATTRS)
+    key = (domain,) + grid_signature(get_nest_attrs(nc_file)) + map_attrs
+    if window is not None:
+        key += ('window',) + tuple(window)
+
+    return key
+
+##################################################################################
+# loads the geometry store, or returns an empty store if it does not exist or
+# has an outdated format
+
+def load_geo_store(path):
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            store = pickle.load(f)
+
+        if store.get('version') == GEO_VERSION:
+            return store
+
+    return {'version' : GEO_VERSION, 'grids' : {}}
+
+##################################################################################
+# writes the geometry store atomically, so that readers never see a partially
+# written store, merging in place the grids written by concurrent processes,
+# e.g., the array jobs sharing the store, under a lock of the store, so that no
+# grid referenced by their outputs is dropped
+
+def save_geo_store(store, path):
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for key, geo in load_geo_store(path)['grids'].items():
+            if key in store['grids']:
+                # keep the fields computed by either process, e.g., indx
+                for name, val in geo.items():
+                    store['grids'][key].setdefault(name, val)
+
+            else:
+                store['grids'][key] = geo
+
+        tmp_path = path + '.tmp.' + str(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(store, f)
+
+        os.replace(tmp_path, path)
+
+##################################################################################
+# restores the geometry of the processed output data of a forecast hour from
+# the geometry store it references, in place, where data_dir is the directory
+# of the output file.  Outputs containing their own geometry are unchanged.
+
+def attach_geometry(data, data_dir):
+    if 'geometry' not in data:
+        return data
+
+    path = os.path.join(data_dir, data['geometry']['path'])
+    grids = load_geo_store(path)['grids']
+    data['cart_proj'] = grids[data['geometry']['root']]['cart_proj']
+    for val in data.values():
+        if isinstance(val, dict) and 'grid' in val:
+            geo = grids[val['grid']]
+            for name in GEO_FIELDS:
+                val[name] = geo[name]
+
+            if 'indx' in geo:
+                val['indx'] = geo['indx'],
+
+    return data
+
+##################################################################################
+# end
@@ -50,13 +50,471 @@
 # Imports
 ##################################################################################
 from netCDF4 import Dataset
+from collections.abc import Mapping
+import numpy as np
+import queue
+import threading
+import time
 import cartopy
 from wrf import (
-                 getvar, interplevel, extract_vars, ALL_TIMES,
+                 getvar, interplevel, extract_vars, ALL_TIMES, to_np,
+                 latlon_coords, ll_to_xy, cartopy_xlim, cartopy_ylim,
+                 get_cartopy,
                 )
 
+##################################################################################
+# GLOBAL PARAMETERS
+##################################################################################
+# raw wrfout variables read by each diagnostic, used to build one extract_vars
+# cache that is shared by all diagnostics of a file / time
+DIAG_VARS = {
+             'pressure'  : ['P', 'PB'],
+             'z'         : ['PH', 'PHB', 'HGT'],
+             'height'    : ['PH', 'PHB', 'HGT'],
+             'ua'        : ['U'],
+             'va'        : ['V'],
+             'wspd_wdir' : ['U', 'V'],
+             'theta'     : ['T'],
+             'temp'      : ['T', 'P', 'PB'],
+             'tk'        : ['T', 'P', 'PB'],
+             'rh'        : ['T', 'P', 'PB', 'QVAPOR'],
+             'slp'       : ['T', 'P', 'PB', 'QVAPOR', 'PH', 'PHB'],
+             'ivt'       : ['QVAPOR', 'U', 'V'],
+             'iwv'       : ['QVAPOR'],
+            }
+
+# coordinate variables read for the metadata of every diagnostic
+COORD_VARS = ['XLAT', 'XLONG']
+
+# physical constants of the wrf-python diagnostics, for the parity of the NumPy
+# backend with getvar
+T_BASE = 300.0
+P1000MB = 100000.0
+RD = 287.0
+CP = 1004.5
+G = 9.81
+USSALR = 0.0065
+EPS = 0.622
+EZERO = 6.112
+ESLCON1 = 17.67
+ESLCON2 = 29.65
+CELKEL = 273.15
+DEG_PER_RAD = 180.0 / np.pi
+
+# unit conversion factors from the base units of each type of variable, with
+# the unit aliases, as in wrf-python
+UNIT_FACTORS = {
+                'pressure' : {'pa' : 1.0, 'hpa' : 0.01, 'mb' : 0.01},
+                'height'   : {'m' : 1.0, 'km' : 1.0 / 1000.0,
+                              'dm' : 1.0 / 10.0, 'ft' : 3.28084},
+                'wind'     : {'m s-1' : 1.0, 'kt' : 1.94384, 'kts' : 1.94384,
+                              'knots' : 1.94384, 'km h-1' : 3.60,
+                              'mi h-1' : 2.23694},
+               }
+
+# temperature units, with aliases
+TEMP_UNITS = {'k' : 'k', 'degc' : 'c', 'c' : 'c', 'degf' : 'f', 'f' : 'f'}
+
 ##################################################################################
 # UTILITY METHODS
+##################################################################################
+# returns the sorted list of raw wrfout variables to cache for the diagnostics,
+# where raw wrfout variables, e.g., QVAPOR, are cached as themselves
+
+def diag_cache_vars(diags):
+    cache_vars = set(COORD_VARS)
+    for diag in diags:
+        if diag in DIAG_VARS:
+            cache_vars.update(DIAG_VARS[diag])
+
+        elif diag.isupper():
+            cache_vars.add(diag)
+
+        else:
+            raise ValueError('Unknown diagnostic ' + diag + ', add its input' +\
+                             ' variables to DIAG_VARS')
+
+    return sorted(cache_vars)
+
+##################################################################################
+# counts the lookups of each variable of a netCDF4 Dataset, each of which is a
+# read from disk when made by wrf-python, to confirm the use of the cache
+
+class CountingVariables(Mapping):
+    def __init__(self, variables, reads):
+        self._variables = variables
+        self.reads = reads
+
+    def __getitem__(self, name):
+        var = self._variables[name]
+        self.reads[name] = self.reads.get(name, 0) + 1
+        return var
+
+    def __iter__(self):
+        return iter(self._variables)
+
+    def __len__(self):
+        return len(self._variables)
+
+    def __contains__(self, name):
+        return name in self._variables
+
+##################################################################################
+# wraps a netCDF4 Dataset for use with wrf-python, counting variable reads
+
+class CountingDataset:
+    def __init__(self, ds):
+        self._ds = ds
+        self.reads = {}
+        self.variables = CountingVariables(ds.variables, self.reads)
+
+    def __getattr__(self, name):
+        return getattr(self._ds, name)
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+##################################################################################
+# formats the read counts of a CountingDataset, flagging repeated reads
+
+def format_read_counts(reads):
+    counts = []
+    for name in sorted(reads):
+        count = name + ' x ' + str(reads[name])
+        if reads[name] > 1:
+            count += ' (REPEATED)'
+
+        counts.append(count)
+
+    return ', '.join(counts)
+
+##################################################################################
+# returns the index window (j_0, j_1, i_0, i_1) of the mass grid of a wrfout
+# file, with exclusive ends, from a region given by an index window, e.g.,
+# {'j' : (100, 220), 'i' : (40, 160)}, or by a lat / lon box, e.g.,
+# {'lat' : (30, 45), 'lon' : (-130, -115)}, bounding all grid points in the box
+
+def region_window(ds, region):
+    if 'lat' in region:
+        lats = np.asarray(ds.variables['XLAT'][0, :, :])
+        lons = np.asarray(ds.variables['XLONG'][0, :, :])
+        mask = (lats >= region['lat'][0]) & (lats <= region['lat'][1]) &\
+               (lons >= region['lon'][0]) & (lons <= region['lon'][1])
+        if not np.any(mask):
+            raise ValueError('No grid points of the domain lie in the region ' +\
+                             str(region))
+
+        j_in = np.flatnonzero(np.any(mask, axis=1))
+        i_in = np.flatnonzero(np.any(mask, axis=0))
+
+        return (int(j_in[0]), int(j_in[-1]) + 1, int(i_in[0]), int(i_in[-1]) + 1)
+
+    else:
+        ny = len(ds.dimensions['south_north'])
+        nx = len(ds.dimensions['west_east'])
+        j_0, j_1 = max(region['j'][0], 0), min(region['j'][1], ny)
+        i_0, i_1 = max(region['i'][0], 0), min(region['i'][1], nx)
+        if j_0 >= j_1 or i_0 >= i_1:
+            raise ValueError('Empty index window of the region ' + str(region))
+
+        return (j_0, j_1, i_0, i_1)
+
+##################################################################################
+# returns the slices of the horizontal dimensions of wrfout variables for the
+# index window, where the staggered dimensions read one extra row / column
+
+def window_slices(window):
+    j_0, j_1, i_0, i_1 = window
+
+    return {
+            'south_north' : slice(j_0, j_1),
+            'south_north_stag' : slice(j_0, j_1 + 1),
+            'west_east' : slice(i_0, i_1),
+            'west_east_stag' : slice(i_0, i_1 + 1),
+           }
+
+##################################################################################
+# expands an index of a variable to a tuple with an entry for each dimension
+
+def expand_index(key, ndim):
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    if Ellipsis in key:
+        k = key.index(Ellipsis)
+        fill = (slice(None),) * (ndim - len(key) + 1)
+        key = key[:k] + fill + key[k + 1:]
+
+    return key + (slice(None),) * (ndim - len(key))
+
+##################################################################################
+# wraps a netCDF4 Variable, reading only the hyperslab of the index window in
+# the horizontal dimensions, where indices are relative to the window
+
+class SubsetVariable:
+    __slots__ = ('_var', '_slices', 'shape')
+
+    def __init__(self, var, slices):
+        self._var = var
+        self._slices = slices
+        self.shape = tuple(len(range(*slices[dim].indices(n)))
+                           if dim in slices else n
+                           for dim, n in zip(var.dimensions, var.shape))
+
+    # the attributes of the variable, as for a netCDF4 Variable
+    @property
+    def __dict__(self):
+        return self._var.__dict__
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getattr__(self, name):
+        return getattr(self._var, name)
+
+    def __getitem__(self, key):
+        key = expand_index(key, self._var.ndim)
+        read_key = []
+        win_key = []
+        for dim, k in zip(self._var.dimensions, key):
+            if dim in self._slices:
+                # read the window, then index within it
+                read_key.append(self._slices[dim])
+                win_key.append(k)
+
+            else:
+                read_key.append(k)
+                if not isinstance(k, (int, np.integer)):
+                    win_key.append(slice(None))
+
+        return self._var[tuple(read_key)][tuple(win_key)]
+
+##################################################################################
+# maps the variables of a netCDF4 Dataset to their hyperslabs in the index
+# window, where variables without horizontal dimensions are unchanged
+
+class SubsetVariables(Mapping):
+    def __init__(self, variables, slices):
+        self._variables = variables
+        self._slices = slices
+
+    def __getitem__(self, name):
+        var = self._variables[name]
+        if any(dim in self._slices for dim in var.dimensions):
+            return SubsetVariable(var, self._slices)
+
+        return var
+
+    def __iter__(self):
+        return iter(self._variables)
+
+    def __len__(self):
+        return len(self._variables)
+
+    def __contains__(self, name):
+        return name in self._variables
+
+##################################################################################
+# wraps a netCDF4 Dataset for use with wrf-python, reading only the hyperslab of
+# the index window of the mass grid, so that all diagnostics are computed on the
+# region.  Global attributes, e.g., the grid dimensions, are those of the full
+# domain, while the lat / lon derived projection parameters are those of the
+# window, so that x / y grid values are relative to the window.
+
+class SubsetDataset:
+    __slots__ = ('_ds', 'window', 'variables')
+
+    def __init__(self, ds, window):
+        self._ds = ds
+        self.window = window
+        self.variables = SubsetVariables(ds.variables, window_slices(window))
+
+    # the global attributes of the file, as for a netCDF4 Dataset
+    @property
+    def __dict__(self):
+        return self._ds.__dict__
+
+    def __getattr__(self, name):
+        return getattr(self._ds, name)
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._ds.close()
+
+##################################################################################
+# opens a wrfout file, subset to the region if given, returning the Dataset and
+# the index window of the region, None for the full domain, where the file is
+# opened in memory from the bytes of the file if memory is given
+
+def open_wrfout(fname, region=None, memory=None):
+    ds = Dataset(fname, memory=memory)
+    if region is None:
+        return ds, None
+
+    try:
+        window = region_window(ds, region)
+
+    except:
+        ds.close()
+        raise
+
+    return SubsetDataset(ds, window), window
+
+##################################################################################
+# reads the files ahead of their processing in a background thread, yielding
+# (fname, memory) in order, with at most ahead files read but not yet yielded.
+# If in_memory, memory is the bytes of the whole file, for open_wrfout /
+# Dataset(fname, memory=memory), else the file is streamed through the page
+# cache, so that the first reads of the Dataset do not stall, and memory is
+# None.  Only plain file reads run in the thread, as the netCDF / HDF5 libraries
+# are not thread safe.  Files for which skip(fname) is True, e.g., served by the
+# diagnostics cache, are not read, with memory None.  With ahead = 0 the files
+# are read when requested, or not at all if not in_memory.  Errors of the thread
+# are raised by the consumer in place of the file.  The time the consumer waits
+# on reads and the time it spends processing between files are accumulated for
+# format_stats.
+
+class Prefetcher:
+    def __init__(self, fnames, ahead=2, in_memory=False, skip=None,
+                 block=64 * 2**20):
+        self.fnames = list(fnames)
+        self.ahead = ahead
+        self.in_memory = in_memory
+        self.skip = skip
+        self.block = block
+        self.n_bytes = 0
+        self.read_time = 0.0
+        self.wait_time = 0.0
+        self.proc_time = 0.0
+        self._index = 0
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+        if ahead > 0:
+            self._queue = queue.Queue(maxsize=ahead)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    # reads a file, returning its bytes if in memory, or None on errors so that
+    # opening the file raises as without prefetching
+    def _read(self, fname):
+        t0 = time.time()
+        chunks = []
+        try:
+            with open(fname, 'rb') as f:
+                while True:
+                    chunk = f.read(self.block)
+                    if not chunk:
+                        break
+
+                    self.n_bytes += len(chunk)
+                    if self.in_memory:
+                        chunks.append(chunk)
+
+        except OSError:
+            return None
+
+        finally:
+            self.read_time += time.time() - t0
+
+        return b''.join(chunks) if self.in_memory else None
+
+    # reads a file unless skipped
+    def _fetch(self, fname):
+        if self.skip is not None and self.skip(fname):
+            return None
+
+        return self._read(fname)
+
+    # reads all files into the bounded queue, until stopped or an error, which
+    # is passed to the consumer in place of the file
+    def _run(self):
+        for fname in self.fnames:
+            try:
+                item = (fname, self._fetch(fname), None)
+
+            except BaseException as err:
+                item = (fname, None, err)
+
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+
+                except queue.Full:
+                    pass
+
+            if self._stop.is_set() or item[2] is not None:
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = time.time()
+        if self._last is not None:
+            self.proc_time += t0 - self._last
+
+        if self._index == len(self.fnames):
+            self._last = None
+            raise StopIteration
+
+        fname = self.fnames[self._index]
+        self._index += 1
+        if self._thread is not None:
+            fname, memory, err = self._queue.get()
+            if err is not None:
+                self._index = len(self.fnames)
+                self._last = None
+                raise err
+
+        elif self.in_memory:
+            memory = self._fetch(fname)
+
+        else:
+            memory = None
+
+        self._last = time.time()
+        self.wait_time += self._last - t0
+
+        return fname, memory
+
+    # stops the reads ahead, e.g., when the consumer exits early
+    def close(self):
+        if self._last is not None:
+            self.proc_time += time.time() - self._last
+            self._last = None
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # formats the read throughput and the split of the time of the consumer
+    # between waiting on reads and processing
+    def format_stats(self):
+        total = self.wait_time + self.proc_time
+        wait = 100 * self.wait_time / total if total else 0
+        rate = self.n_bytes / 2**20 / self.read_time if self.read_time else 0
+        return 'read ' + '%.2f'%(self.n_bytes / 2**30) + ' GB in ' +\
+                '%.1f'%self.read_time + ' s (' + '%.0f'%rate + ' MB/s), ' +\
+                'I/O wait ' + '%.1f'%self.wait_time + ' s (' + '%.1f'%wait +\
+                '%), compute ' + '%.1f'%self.proc_time + ' s'
+
 ##################################################################################
 # gets and interpolates variable to pressure level with specified units available 
 
@@ -82,6 +540,137 @@ def process_D3_raw_vars(ds, p_ds, pl, var, cache=None):
 
     return int_var
 
+##################################################################################
+# orders interpolated levels as (Time, level, south_north, west_east), adding a
+# length one Time dimension for single time data without copying
+
+def time_level_order(int_var):
+    if 'Time' not in int_var.dims:
+        int_var = int_var.expand_dims('Time')
+
+    return int_var
+
+##################################################################################
+# gets variable with specified units available and interpolates to all pressure
+# levels in one pass, returned with dimensions (Time, level, y, x), or with the
+# dimensions (..., level, y, x) returned by interplevel if time_dim is False
+
+def process_D3_vars_multi(ds, p_ds, pls, var, unit, cache=None, time_dim=True):
+    # uses getvar utility from WRF-py, computing the 3D diagnostic once
+    if unit:
+        eta_var = getvar(ds, var, units=unit, cache=cache)
+
+    else:
+        eta_var = getvar(ds, var, cache=cache)
+
+    int_var = interplevel(eta_var, p_ds, list(pls))
+
+    return time_level_order(int_var) if time_dim else int_var
+
+##################################################################################
+# extracts variable and interpolates to all pressure levels in one pass,
+# returned with dimensions as in process_D3_vars_multi
+
+def process_D3_raw_vars_multi(ds, p_ds, pls, var, cache=None, time_dim=True):
+    # uses extract_vars utility from WRF-py, extracting the 3D field once
+    eta_var = extract_vars(ds, ALL_TIMES, var, cache=cache)[var]
+    int_var = interplevel(eta_var, p_ds, list(pls))
+
+    return time_level_order(int_var) if time_dim else int_var
+
+##################################################################################
+# builds the vertical interpolation weights from the pressure field to pressure
+# levels, to be shared over all 3D fields of the same file / time
+#
+# The bracketing eta level indices of each column are searched once for every
+# level in pls, from the pressure field p_ds with dimensions (..., bottom_top,
+# south_north, west_east) decreasing with height.  Weights are linear in log
+# pressure if log_p is True, or linear in pressure as in interplevel otherwise.
+# Levels below the ground or above the model top are masked.  The weights are
+# returned as a dictionary of (..., level, south_north, west_east) arrays of the
+# lower bracketing index, the weight of the upper level and the valid mask.
+
+def build_interp_weights(p_ds, pls, log_p=True):
+    pres = np.asarray(p_ds)
+    n_lev = pres.shape[-3]
+    v_crd = np.log(pres) if log_p else pres
+    shape = pres.shape[:-3] + (len(pls),) + pres.shape[-2:]
+    indx = np.empty(shape, dtype=np.int32)
+    valid = np.empty(shape, dtype=bool)
+    for j, pl in enumerate(pls):
+        # count the eta levels at or below the pressure level
+        n_below = np.sum(pres >= pl, axis=-3)
+        indx[..., j, :, :] = np.clip(n_below - 1, 0, n_lev - 2)
+        valid[..., j, :, :] = ((n_below > 0) & (n_below < n_lev)) |\
+                (pres[..., -1, :, :] == pl)
+
+    targets = np.log(pls) if log_p else np.asarray(pls, dtype=pres.dtype)
+    targets = targets.reshape((len(pls), 1, 1))
+    v_0 = np.take_along_axis(v_crd, indx, axis=-3)
+    v_1 = np.take_along_axis(v_crd, indx + 1, axis=-3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = (v_0 - targets) / (v_0 - v_1)
+
+    return {
+            'pls'    : list(pls),
+            'indx'   : indx,
+            'weight' : weight,
+            'valid'  : valid,
+           }
+
+##################################################################################
+# interpolates a 3D field with dimensions (..., bottom_top, south_north,
+# west_east) to the pressure levels of the weights as a gather and weighted sum,
+# setting masked levels to missing
+
+def apply_interp_weights(weights, field, missing=np.nan):
+    field = np.asarray(field)
+    indx = weights['indx']
+    weight = weights['weight']
+    valid = weights['valid']
+
+    # broadcast the weights over leading dimensions of the field, e.g., the
+    # wind speed / direction dimension of wspd_wdir
+    while indx.ndim < field.ndim:
+        indx = indx[np.newaxis]
+        weight = weight[np.newaxis]
+        valid = valid[np.newaxis]
+
+    f_0 = np.take_along_axis(field, indx, axis=-3)
+    f_1 = np.take_along_axis(field, indx + 1, axis=-3)
+    f_1 -= f_0
+    f_1 *= weight
+    f_0 += f_1
+    f_0[~np.broadcast_to(valid, f_0.shape)] = missing
+
+    return f_0
+
+##################################################################################
+# gets variable with specified units available and interpolates to the pressure
+# levels of the weights, returning the interpolated array and the attributes
+# of the variable, where timeidx must match the times of the weights, computed
+# with the diagnostics backend of get_diag
+
+def interp_D3_vars(ds, weights, var, unit, timeidx=0, cache=None,
+                   backend='wrf'):
+    eta_var = get_diag(ds, var, unit, timeidx, cache, backend=backend)
+    if backend == 'np':
+        # the NumPy backend carries no metadata beyond the units
+        attrs = {'units' : unit} if unit else {}
+
+        return apply_interp_weights(weights, eta_var), attrs
+
+    return apply_interp_weights(weights, eta_var.data), eta_var.attrs
+
+##################################################################################
+# extracts variable and interpolates to the pressure levels of the weights,
+# returning the interpolated array and the attributes of the variable
+
+def interp_D3_raw_vars(ds, weights, var, cache=None):
+    eta_var = extract_vars(ds, ALL_TIMES, var, cache=cache)[var]
+
+    return apply_interp_weights(weights, eta_var.data), eta_var.attrs
+
 ##################################################################################
 # if data is staggered in any dimension, interpolate to unstaggered grid
 
@@ -155,5 +744,634 @@ def comp_IVT_IWV(nc_file, pres):
 
     return ivtm, ivtu, ivtv, ivw
 
+##################################################################################
+# destagger a 2D level of a wind component to the mass grid if staggered
+
+def destagger_level(var, ny, nx, out):
+    if var.shape[-1] == nx + 1:
+        np.add(var[:, :-1], var[:, 1:], out=out)
+        out *= 0.5
+
+    elif var.shape[-2] == ny + 1:
+        np.add(var[:-1, :], var[1:, :], out=out)
+        out *= 0.5
+
+    else:
+        out[:] = var
+
+    return out
+
+##################################################################################
+# compute IVT / IWV in a single fused pass over the eta levels with NumPy
+#
+# This kernel takes the pressure in hPa, the water vapor mixing ratio and the
+# u / v wind components over the eta levels as (bottom_top, south_north,
+# west_east) arrays, where the winds may be given on their staggered grids.  It
+# reproduces the finite differences / layer averages of comp_IVT_IWV exactly,
+# using only 2D buffers for each level rather than full 3D temporaries.  The
+# computation is carried out in dtype, defaulting to the dtype of pres, and the
+# results are written to the optional out tuple of 2D arrays (ivtm, ivtu, ivtv,
+# iwv) to reuse buffers across calls.  Relative to the field maximum, results
+# agree with comp_IVT_IWV to within 1e-12 in float64 and 1e-5 in float32.
+
+def comp_IVT_IWV_np(pres, qvapor, u, v, out=None, dtype=None):
+    # define constant c
+    c = 100/9.8
+    pres, qvapor, u, v = [np.asarray(x) for x in [pres, qvapor, u, v]]
+    dtype = pres.dtype if dtype is None else np.dtype(dtype)
+    n_lev, ny, nx = pres.shape
+
+    if out is None:
+        out = tuple(np.empty([ny, nx], dtype=dtype) for i in range(4))
+
+    ivtm, ivtu, ivtv, iwv = out
+    for arr in out:
+        arr.fill(0)
+
+    # 2D level buffers for the current / previous level
+    buf = lambda: np.empty([ny, nx], dtype=dtype)
+    q_cur, q_prv = buf(), buf()
+    u_cur, u_prv = buf(), buf()
+    v_cur, v_prv = buf(), buf()
+    uq_cur, uq_prv = buf(), buf()
+    vq_cur, vq_prv = buf(), buf()
+    dp, tmp = buf(), buf()
+
+    for k in range(n_lev):
+        # specific humidity, q = qvapor / (1 + qvapor)
+        q_cur[:] = qvapor[k]
+        np.add(q_cur, 1, out=tmp)
+        np.divide(q_cur, tmp, out=q_cur)
+
+        # winds on the mass grid
+        destagger_level(u[k], ny, nx, u_cur)
+        destagger_level(v[k], ny, nx, v_cur)
+
+        if k >= 1:
+            # minus-c-scaled change in pressure over the layer
+            np.subtract(pres[k - 1], pres[k], out=dp)
+            dp *= c
+
+            # WV over layer from the layer mean specific humidity
+            np.add(q_cur, q_prv, out=tmp)
+            tmp *= 0.5
+            tmp *= dp
+            iwv += tmp
+
+            # layer mean winds times specific humidity
+            np.add(u_cur, u_prv, out=uq_cur)
+            uq_cur *= 0.5
+            uq_cur *= q_cur
+            np.add(v_cur, v_prv, out=vq_cur)
+            vq_cur *= 0.5
+            vq_cur *= q_cur
+
+        if k >= 2:
+            # VT over layer from the mean of the adjacent wind-moisture products
+            np.add(uq_cur, uq_prv, out=tmp)
+            tmp *= 0.5
+            tmp *= dp
+            ivtu += tmp
+
+            np.add(vq_cur, vq_prv, out=tmp)
+            tmp *= 0.5
+            tmp *= dp
+            ivtv += tmp
+
+        # swap current / previous level buffers
+        q_cur, q_prv = q_prv, q_cur
+        u_cur, u_prv = u_prv, u_cur
+        v_cur, v_prv = v_prv, v_cur
+        uq_cur, uq_prv = uq_prv, uq_cur
+        vq_cur, vq_prv = vq_prv, vq_cur
+
+    # ivt compute magnitude
+    np.hypot(ivtu, ivtv, out=ivtm)
+
+    return ivtm, ivtu, ivtv, iwv
+
+##################################################################################
+# compute IVT / IWV with the NumPy kernel from the raw wrfout fields, with the
+# wind components destaggered within the kernel
+
+def comp_IVT_IWV_fast(nc_file, pres, timeidx=0, cache=None, out=None,
+                      dtype=None):
+    raw = extract_vars(nc_file, timeidx, ['QVAPOR', 'U', 'V'], cache=cache,
+                       meta=False)
+
+    return comp_IVT_IWV_np(pres, raw['QVAPOR'], raw['U'], raw['V'], out=out,
+                           dtype=dtype)
+
+##################################################################################
+# NumPy diagnostics backend
+#
+# The diagnostics below compute the fields of getvar directly from the raw
+# wrfout arrays returned by extract_vars with meta=False, i.e., from the cache,
+# without the xarray metadata of getvar and its removal by to_np.  Staggered
+# fields are destaggered with slicing, and the outputs are modified in place, so
+# that each diagnostic allocates only its output and the float64 work arrays of
+# the Fortran routines of wrf-python, which are reproduced operation by
+# operation.  The inputs, e.g., the arrays of the cache or intermediate fields
+# shared with other diagnostics, are never modified.
+##################################################################################
+# converts the values of x from the units of the algorithm to the units, in
+# place, as in wrf-python, where kind is pressure, height, wind or temp
+
+def convert_units(x, kind, alg_units, units):
+    if units is None or units.lower() == alg_units.lower():
+        return x
+
+    if kind == 'temp':
+        alg_units = TEMP_UNITS[alg_units.lower()]
+        units = TEMP_UNITS[units.lower()]
+        if units == alg_units:
+            return x
+
+        if alg_units != 'k':
+            raise ValueError('Temperatures are converted from K only')
+
+        x -= CELKEL
+        if units == 'f':
+            x *= 1.8
+            x += 32.0
+
+        return x
+
+    factors = UNIT_FACTORS[kind]
+    base = list(factors)[0]
+    alg_units = alg_units.lower()
+    units = units.lower()
+    if alg_units == base:
+        x *= factors[units]
+
+    elif units == base:
+        x *= 1.0 / factors[alg_units]
+
+    else:
+        x *= 1.0 / factors[alg_units] * factors[units]
+
+    return x
+
+##################################################################################
+# destaggers the field along axis into a new array, as wrf-python destagger
+
+def destagger_np(var, axis):
+    n = var.shape[axis]
+    lo = [slice(None)] * var.ndim
+    hi = [slice(None)] * var.ndim
+    lo[axis] = slice(0, n - 1)
+    hi[axis] = slice(1, n)
+    out = np.add(var[tuple(lo)], var[tuple(hi)])
+    out *= 0.5
+
+    return out
+
+##################################################################################
+# full pressure in Pa / in hPa
+
+def p_full_np(P, PB):
+    return np.add(P, PB)
+
+def pressure_np(p_full):
+    return np.multiply(p_full, 0.01)
+
+##################################################################################
+# potential temperature in K
+
+def theta_np(T):
+    return np.add(T, T_BASE)
+
+##################################################################################
+# temperature in K, computed in float64 as the Fortran routine of wrf-python and
+# rounded to the input dtype
+
+def tk_np(p_full, theta):
+    tk = p_full.astype(np.float64)
+    tk /= P1000MB
+    tk **= RD / CP
+    tk *= theta
+
+    return tk.astype(theta.dtype)
+
+##################################################################################
+# water vapor mixing ratio clipped at zero, as used by the rh / slp routines
+
+def qv_np(QVAPOR):
+    return np.maximum(QVAPOR, 0)
+
+##################################################################################
+# relative humidity in %
+
+def rh_np(qv, p_full, tk):
+    t = tk.astype(np.float64)
+
+    # saturation vapor pressure in hPa, then saturation mixing ratio
+    es = t - CELKEL
+    es *= ESLCON1
+    t -= ESLCON2
+    es /= t
+    np.exp(es, out=es)
+    es *= EZERO
+    denom = p_full.astype(np.float64)
+    denom *= 0.01
+    denom -= (1.0 - EPS) * es
+    qvs = np.multiply(es, EPS, out=es)
+    qvs /= denom
+
+    rh = np.divide(qv, qvs, out=qvs)
+    np.clip(rh, 0.0, 1.0, out=rh)
+    rh *= 100.0
+
+    return rh.astype(tk.dtype)
+
+##################################################################################
+# full geopotential on the staggered levels / geopotential height above mean sea
+# level on the mass levels in m
+
+def ph_full_np(PH, PHB):
+    return np.add(PH, PHB)
+
+def height_np(ph_full):
+    z = destagger_np(ph_full, -3)
+    z /= G
+
+    return z
+
+##################################################################################
+# grid-relative u / v wind components on the mass grid in m s-1
+
+def ua_np(U):
+    return destagger_np(U, -1)
+
+def va_np(V):
+    return destagger_np(V, -2)
+
+##################################################################################
+# grid-relative wind speed in m s-1 / direction stacked on a leading dimension
+# of 2
+
+def wspd_wdir_np(ua, va):
+    out = np.empty((2,) + ua.shape, dtype=ua.dtype)
+    u64 = ua.astype(np.float64)
+    v64 = va.astype(np.float64)
+    out[0] = np.sqrt(u64 * u64 + v64 * v64)
+
+    # direction the wind blows from
+    wdir = np.arctan2(v64, u64)
+    wdir *= -DEG_PER_RAD
+    wdir += 270.0
+    out[1] = np.mod(wdir, 360.0, out=wdir)
+
+    return out
+
+##################################################################################
+# sea level pressure in hPa, as the Fortran routine of wrf-python from the
+# temperature / pressure 100 hPa above the surface, including its layer
+# interpolation and the MM5 ridge test as written
+
+def slp_np(ph_full, tk, p_full, qv):
+    pconst = 10000.0
+    tc = 273.16 + 17.5
+
+    # inputs in float64 as the wrf-python wrapper, with the height divided by
+    # gravity before destaggering as in wrf-python
+    t = tk.astype(np.float64)
+    p = p_full.astype(np.float64)
+    q = qv.astype(np.float64)
+    z = np.divide(ph_full, G)
+    z = destagger_np(z, -3).astype(np.float64)
+    n_lev = p.shape[-3]
+
+    # least eta level that is pconst above the surface
+    p_sfc = p[..., 0, :, :]
+    above = p < (p_sfc - pconst)[..., np.newaxis, :, :]
+    if not np.all(np.any(above, axis=-3)):
+        raise ValueError('Error in finding 100 hPa up')
+
+    level = np.argmax(above, axis=-3)[..., np.newaxis, :, :]
+    klo = np.maximum(level - 1, 0)
+    khi = np.minimum(klo + 1, n_lev - 2)
+    if np.any(klo == khi):
+        raise ValueError('Error trapping levels')
+
+    take = lambda x, k: np.take_along_axis(x, k, axis=-3)[..., 0, :, :]
+    plo, phi = take(p, klo), take(p, khi)
+    tlo = take(t, klo) * (1.0 + 0.608 * take(q, klo))
+    thi = take(t, khi) * (1.0 + 0.608 * take(q, khi))
+    zlo, zhi = take(z, klo), take(z, khi)
+
+    # temperature / height pconst above the surface, extrapolated to the surface
+    # and to sea level
+    p_at_pconst = p_sfc - pconst
+    log_c = np.log(p_at_pconst / phi)
+    log_lo = np.log(plo / phi)
+    t_at_pconst = thi - (thi - tlo) * log_c * log_lo
+    z_at_pconst = zhi - (zhi - zlo) * log_c * log_lo
+    t_surf = t_at_pconst * (p_sfc / p_at_pconst)**(USSALR * RD / G)
+    t_sea_level = t_at_pconst + USSALR * z_at_pconst
+
+    # correction of sea level temperatures that are too hot
+    too_hot = (t_surf <= tc) & ~(t_sea_level < tc)
+    t_sea_level = np.where(too_hot, tc, tc - 0.005 * (t_surf - tc)**2)
+
+    # the conversion to hPa uses a single precision 0.01 in the Fortran routine
+    slp = np.exp((2.0 * G * z[..., 0, :, :]) / (RD * (t_sea_level + t_surf)))
+    slp = float(np.float32(0.01)) * (p_sfc * slp)
+
+    return slp.astype(tk.dtype)
+
+##################################################################################
+# IVT / IWV with the fused kernel, from the pressure in hPa and the winds on the
+# mass grid, returned as the tuple (ivtm, ivtu, ivtv, iwv)
+
+def ivt_np(pressure, QVAPOR, ua, va):
+    return comp_IVT_IWV_np(pressure, QVAPOR, ua, va)
+
+##################################################################################
+# Derived-field registry
+#
+# Each derived field declares its inputs, which are raw wrfout variables in
+# upper case or other derived fields, and the function computing it from them.
+# The fields are computed in the units of the algorithm, with the unit types of
+# FIELD_UNITS for conversion of the requested outputs.  Any field <name>_pl is
+# <name> interpolated to the pressure levels of the evaluator, sharing the
+# interpolation weights over all fields.  A new diagnostic declared from the
+# inputs below costs no extra reads.
+
+FIELDS = {
+          'p_full'    : (['P', 'PB'], p_full_np),
+          'pressure'  : (['p_full'], pressure_np),
+          'theta'     : (['T'], theta_np),
+          'tk'        : (['p_full', 'theta'], tk_np),
+          'qv'        : (['QVAPOR'], qv_np),
+          'rh'        : (['qv', 'p_full', 'tk'], rh_np),
+          'ph_full'   : (['PH', 'PHB'], ph_full_np),
+          'z'         : (['ph_full'], height_np),
+          'ua'        : (['U'], ua_np),
+          'va'        : (['V'], va_np),
+          'wspd_wdir' : (['ua', 'va'], wspd_wdir_np),
+          'slp'       : (['ph_full', 'tk', 'p_full', 'qv'], slp_np),
+          'ivt'       : (['pressure', 'QVAPOR', 'ua', 'va'], ivt_np),
+          'ivtm'      : (['ivt'], lambda ivt: ivt[0]),
+          'ivtu'      : (['ivt'], lambda ivt: ivt[1]),
+          'ivtv'      : (['ivt'], lambda ivt: ivt[2]),
+          'iwv'       : (['ivt'], lambda ivt: ivt[3]),
+         }
+
+# getvar names of the derived fields
+FIELD_ALIASES = {
+                 'temp'   : 'tk',
+                 'height' : 'z',
+                }
+
+# unit types and units of the algorithm of the derived fields
+FIELD_UNITS = {
+               'p_full'    : ('pressure', 'Pa'),
+               'pressure'  : ('pressure', 'hPa'),
+               'slp'       : ('pressure', 'hPa'),
+               'theta'     : ('temp', 'K'),
+               'tk'        : ('temp', 'K'),
+               'z'         : ('height', 'm'),
+               'ua'        : ('wind', 'm s-1'),
+               'va'        : ('wind', 'm s-1'),
+               'wspd_wdir' : ('wind', 'm s-1'),
+              }
+
+##################################################################################
+# returns the registry name of a field, resolving the getvar aliases
+
+def field_name(name):
+    if name.endswith('_pl'):
+        return field_name(name[:-3]) + '_pl'
+
+    return FIELD_ALIASES.get(name, name)
+
+##################################################################################
+# returns the inputs of a field of the registry, where raw wrfout variables
+# have none
+
+def field_inputs(name):
+    if name in FIELDS:
+        return FIELDS[name][0]
+
+    elif name == 'weights':
+        return ['pressure']
+
+    elif name.endswith('_pl') and name[:-3] in FIELDS:
+        return [name[:-3], 'weights']
+
+    elif name.isupper():
+        return []
+
+    else:
+        raise ValueError('Unknown field ' + name + ', add it to FIELDS')
+
+##################################################################################
+# returns the fields / raw variables the outputs depend on in evaluation order,
+# with the number of fields consuming each
+
+def field_graph(outputs):
+    order = []
+    n_uses = {}
+
+    def visit(name):
+        if name in n_uses:
+            return
+
+        n_uses[name] = 0
+        for dep in field_inputs(name):
+            visit(dep)
+            n_uses[dep] += 1
+
+        order.append(name)
+
+    for name in outputs:
+        visit(field_name(name))
+
+    return order, n_uses
+
+##################################################################################
+# returns the sorted raw wrfout variables read for the outputs, given as in
+# eval_fields
+
+def field_raw_vars(outputs):
+    order, _ = field_graph([out if isinstance(out, str) else out[0]
+                            for out in outputs])
+
+    return sorted(name for name in order if not field_inputs(name))
+
+##################################################################################
+# evaluates the derived fields of a wrfout file, computing every intermediate
+# field the outputs depend on exactly once and freeing it after its last
+# consumer, from the raw variables read once with extract_vars, e.g., from the
+# cache.  Outputs are field names, or (name, units) pairs for unit conversion,
+# with pressure-level fields <name>_pl interpolated to pls, in log pressure if
+# log_p.  Returns the dictionary of NumPy arrays of the outputs by name.
+
+def eval_fields(ds, outputs, timeidx=0, cache=None, pls=None, log_p=True):
+    outputs = [(out, None) if isinstance(out, str) else tuple(out)
+               for out in outputs]
+    names = [field_name(out) for out, _ in outputs]
+    order, n_uses = field_graph(names)
+    raw_vars = [name for name in order if not field_inputs(name)]
+    vals = dict(extract_vars(ds, timeidx, raw_vars, cache=cache, meta=False))
+
+    for name in order:
+        deps = field_inputs(name)
+        if not deps:
+            continue
+
+        args = [vals[dep] for dep in deps]
+        if name == 'weights':
+            if pls is None:
+                raise ValueError('Pressure-level fields require pls')
+
+            vals[name] = build_interp_weights(args[0], pls, log_p=log_p)
+
+        elif name.endswith('_pl'):
+            vals[name] = apply_interp_weights(args[1], args[0])
+
+        else:
+            vals[name] = FIELDS[name][1](*args)
+
+        # free the inputs after their last consumer
+        for dep in deps:
+            n_uses[dep] -= 1
+            if n_uses[dep] == 0 and dep not in names:
+                del vals[dep]
+
+    # convert the outputs in place, copying fields requested more than once
+    fields = {}
+    for (out, units), name in zip(outputs, names):
+        val = vals[name]
+        kind = FIELD_UNITS.get(name[:-3] if name.endswith('_pl') else name)
+        if units and kind:
+            if names.count(name) > 1:
+                val = val.copy()
+
+            if name.startswith('wspd_wdir'):
+                # convert the speed only, leaving the direction in degrees
+                convert_units(val[0], kind[0], kind[1], units)
+
+            else:
+                val = convert_units(val, kind[0], kind[1], units)
+
+        fields[out] = val
+
+    return fields
+
+##################################################################################
+# returns the diagnostic var of a wrfout file computed by the backend, where
+# 'wrf' calls getvar, returning an xarray DataArray with metadata, and 'np'
+# returns a NumPy array evaluated from the raw variables with eval_fields
+
+def get_diag(ds, var, units=None, timeidx=0, cache=None, backend='wrf'):
+    if backend == 'wrf':
+        if units:
+            return getvar(ds, var, timeidx=timeidx, units=units, cache=cache)
+
+        return getvar(ds, var, timeidx=timeidx, cache=cache)
+
+    elif backend == 'np':
+        return eval_fields(ds, [(var, units)], timeidx, cache)[var]
+
+    else:
+        raise ValueError('Unknown diagnostics backend ' + backend)
+
+##################################################################################
+# returns the maximum difference of the NumPy backend from getvar relative to
+# the maximum magnitude of the getvar field, validating the backend on a file
+
+def diag_parity(ds, var, units=None, timeidx=0, cache=None):
+    ref = to_np(get_diag(ds, var, units, timeidx, cache, backend='wrf'))
+    val = get_diag(ds, var, units, timeidx, cache, backend='np')
+    if ref.shape != val.shape:
+        raise ValueError('Shape ' + str(val.shape) + ' of the NumPy backend' +\
+                         ' differs from ' + str(ref.shape) + ' for ' + var)
+
+    scale = np.nanmax(np.abs(ref))
+
+    return np.nanmax(np.abs(val - ref)) / (scale if scale > 0 else 1.0)
+
+##################################################################################
+# computes the geometry of a domain from its pressure field, i.e., lat / lon,
+# x / y grid values on the parent domain of p_file, plot limits and projection
+
+def domain_geometry(p_ds, p_file):
+    lat, lon = latlon_coords(p_ds)
+    xx, yy = ll_to_xy(p_file, lat, lon, meta=False)
+
+    return {
+            'xx' : xx,
+            'yy' : yy,
+            'lons' : to_np(lon),
+            'lats' : to_np(lat),
+            'x_lim' : cartopy_xlim(p_ds),
+            'y_lim' : cartopy_ylim(p_ds),
+            'cart_proj' : get_cartopy(p_ds),
+           }
+
+##################################################################################
+# returns a new accumulator of the online mean / variance of a field, with the
+# counts of values exceeding the thresholds
+
+def new_accum(shape, thresholds=()):
+    return {
+            'n' : np.zeros(shape, dtype=np.int64),
+            'mean' : np.zeros(shape),
+            'm2' : np.zeros(shape),
+            'exceed' : {thr: np.zeros(shape, dtype=np.int64)
+                        for thr in thresholds},
+           }
+
+##################################################################################
+# updates the accumulator with a sample of the field using Welford's algorithm,
+# skipping missing values, e.g., pressure levels below the ground
+
+def update_accum(acc, x):
+    x = np.asarray(x, dtype=np.float64)
+    valid = np.isfinite(x)
+    x = np.where(valid, x, 0)
+    acc['n'] += valid
+    delta = np.where(valid, x - acc['mean'], 0)
+    acc['mean'] += delta / np.maximum(acc['n'], 1)
+    acc['m2'] += np.where(valid, delta * (x - acc['mean']), 0)
+    for thr, count in acc['exceed'].items():
+        count += valid & (x > thr)
+
+    return acc
+
+##################################################################################
+# merges two accumulators of disjoint samples into the first, combining the
+# means / variances as in Chan et al.
+
+def merge_accum(acc, other):
+    n = acc['n'] + other['n']
+    n_div = np.maximum(n, 1)
+    delta = other['mean'] - acc['mean']
+    acc['mean'] += delta * other['n'] / n_div
+    acc['m2'] += other['m2'] + delta**2 * acc['n'] * other['n'] / n_div
+    acc['n'] = n
+    for thr, count in acc['exceed'].items():
+        count += other['exceed'][thr]
+
+    return acc
+
+##################################################################################
+# returns the mean, sample standard deviation and the probabilities of
+# exceeding each threshold from the accumulator, missing where undefined
+
+def finalize_accum(acc, dtype=np.float32):
+    n = acc['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, acc['mean'], np.nan)
+        std = np.where(n > 1, np.sqrt(acc['m2'] / (n - 1)), np.nan)
+        probs = {thr: np.where(n > 0, count / n, np.nan)
+                 for thr, count in acc['exceed'].items()}
+
+    probs = {thr: prob.astype(dtype) for thr, prob in probs.items()}
+
+    return mean.astype(dtype), std.astype(dtype), probs
+
 ##################################################################################
 # end
@@ -0,0 +1,198 @@
+##################################################################################
+# Description
+##################################################################################
+# This module contains utility methods for storing the processed numpy outputs
+# of proc_wrfout_np.py in NetCDF4 files, replacing the pickled dictionaries.
+# Each domain is written to a group of the file, with the pressure-level fields
+# stored as (level, south_north, west_east) variables chunked per level and the
+# 2D fields as (south_north, west_east) variables, all zlib compressed.  Readers
+# load only the requested fields / levels, reconstructing the dictionaries of
+# the pickled outputs so that plotting scripts are unchanged.  Grid geometry
+# is referenced from the geometry store of wrf_geo_utilities.
+#
+##################################################################################
+# License Statement:
+##################################################################################
+# This software is Copyright © 2024 The Regents of the University of California.
+# All Rights Reserved. Permission to copy, modify, and distribute this software
+# and its documentation for educational, research and non-profit purposes,
+# without fee, and without a written agreement is hereby granted, provided that
+# the above copyright notice, this paragraph and the following three paragraphs
+# appear in all copies. Permission to make commercial use of this software may
+# be obtained by contacting:
+#
+#     Office of Innovation and Commercialization
+#     9500 Gilman Drive, Mail Code 0910
+#     University of California
+#     La Jolla, CA 92093-0910
+#     innovation@ucsd.edu
+#
+# This software program and documentation are copyrighted by The Regents of the
+# University of California. The software program and documentation are supplied
+# "as is", without any accompanying services from The Regents. The Regents does
+# not warrant that the operation of the program will be uninterrupted or
+# error-free. The end-user understands that the program was developed for
+# research purposes and is advised not to rely exclusively on the program for
+# any reason.
+#
+# IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+# DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION,
+# EVEN IF THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED
+# HEREUNDER IS ON AN “AS IS” BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO
+# OBLIGATIONS TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR
+# MODIFICATIONS.
+# 
+# 
+##################################################################################
+# Imports
+##################################################################################
+from netCDF4 import Dataset
+import numpy as np
+import pickle
+import ast
+import os
+from wrf_geo_utilities import attach_geometry
+
+##################################################################################
+# SET GLOBAL PARAMETERS 
+##################################################################################
+# zlib compression level of stored fields
+COMPLEVEL = 4
+
+##################################################################################
+# UTILITY METHODS
+##################################################################################
+# returns the dimensions of a field of the group with trailing dimensions
+# (south_north, west_east), creating a component dimension <var>_comp for the
+# leading axis of fields with more dimensions, e.g., the speed / direction axis
+# of wspd_wdir
+
+def field_dims(grp, var, shape):
+    if len(shape) == 2:
+        return ()
+
+    name = var + '_comp'
+    if name not in grp.dimensions:
+        grp.createDimension(name, shape[0])
+
+    return (name,)
+
+##################################################################################
+# writes the processed data of a forecast hour, as produced by proc_wrfout_np.py
+# with a shared geometry store, to a NetCDF4 file
+
+def write_np_data(data, out_path, complevel=COMPLEVEL):
+    if 'geometry' not in data:
+        raise ValueError('Writing NetCDF4 outputs requires the geometry to be' +\
+                         ' kept in a geometry store')
+
+    with Dataset(out_path, 'w', format='NETCDF4') as dst:
+        dst.setncattr('date', data['date'])
+        dst.setncattr('geometry_path', data['geometry']['path'])
+        dst.setncattr('geometry_root', repr(data['geometry']['root']))
+        for domain, dom_data in data.items():
+            if domain in ['date', 'geometry']:
+                continue
+
+            grp = dst.createGroup(domain)
+            grp.setncattr('grid', repr(dom_data['grid']))
+
+            # pressure levels in the order they were processed
+            pl_keys = [key for key in dom_data if key.startswith('pl_')]
+            grp.setncattr('level_names', ','.join(pl_keys))
+            d2_keys = [key for key in dom_data if key != 'grid' and\
+                       key not in pl_keys]
+            ny, nx = np.shape(dom_data[d2_keys[0]])[-2:]
+            grp.createDimension('level', len(pl_keys))
+            grp.createDimension('south_north', ny)
+            grp.createDimension('west_east', nx)
+
+            # pressure-level fields, chunked per level
+            if pl_keys:
+                for var in dom_data[pl_keys[0]]:
+                    field = np.stack([dom_data[key][var] for key in pl_keys])
+                    dims = field_dims(grp, var, field.shape[1:])
+                    x = grp.createVariable(var, field.dtype,
+                                           ('level',) + dims +\
+                                           ('south_north', 'west_east'),
+                                           zlib=True, complevel=complevel,
+                                           chunksizes=(1,) + field.shape[1:])
+                    x[:] = field
+
+            # 2D fields
+            for var in d2_keys:
+                field = np.asarray(dom_data[var])
+                dims = field_dims(grp, var, field.shape)
+                x = grp.createVariable(var, field.dtype,
+                                       dims + ('south_north', 'west_east'),
+                                       zlib=True, complevel=complevel,
+                                       chunksizes=field.shape)
+                x[:] = field
+
+##################################################################################
+# reads a single field of a domain from a NetCDF4 output, at the pressure level
+# if given, reading only that level from disk
+
+def read_np_field(in_path, domain, var, level=None):
+    with Dataset(in_path) as src:
+        src.set_auto_mask(False)
+        grp = src[domain]
+        if level is None:
+            return grp[var][:]
+
+        else:
+            pl_keys = grp.getncattr('level_names').split(',')
+            return grp[var][pl_keys.index('pl_' + str(level)), ...]
+
+##################################################################################
+# loads the processed data of a forecast hour as the dictionary written by
+# proc_wrfout_np.py with its geometry attached, reading only the listed fields
+# and pressure levels of NetCDF4 outputs if given, or loading the whole pickled
+# dictionary of .bin outputs
+
+def load_np_data(in_path, fields=None, levels=None):
+    if in_path.endswith('.bin'):
+        with open(in_path, 'rb') as f:
+            data = pickle.load(f)
+
+        return attach_geometry(data, os.path.dirname(in_path))
+
+    if levels is not None:
+        levels = ['pl_' + str(level) for level in levels]
+
+    with Dataset(in_path) as src:
+        src.set_auto_mask(False)
+        data = {
+                'geometry' : {
+                              'path' : src.getncattr('geometry_path'),
+                              'root' : ast.literal_eval(
+                                          src.getncattr('geometry_root')),
+                             },
+                'date' : src.getncattr('date'),
+               }
+
+        for domain, grp in src.groups.items():
+            dom_data = {'grid' : ast.literal_eval(grp.getncattr('grid'))}
+            pl_keys = grp.getncattr('level_names').split(',')
+            for var, x in grp.variables.items():
+                if fields is not None and var not in fields:
+                    continue
+
+                if 'level' in x.dimensions:
+                    for j, key in enumerate(pl_keys):
+                        if levels is None or key in levels:
+                            dom_data.setdefault(key, {})[var] = x[j, ...]
+
+                else:
+                    dom_data[var] = x[:]
+
+            data[domain] = dom_data
+
+    return attach_geometry(data, os.path.dirname(in_path))
+
+##################################################################################
+# end
@@ -13,7 +13,7 @@
 # reply='y'
 #
 # thereby removing the interactive prompt.  This allows one to rocoto boot the
-# next cycle first task by grepping the rocoto workflow logs and prompting the
+# next cycle first task by reading the rocoto workflow database and prompting the
 # cycle to run using a dummy task "boot_next_cycle" which can be trigged based on
 # arbitrary conditions within the current cycle.  This is a very hacky solution and
 # will be made obsolete when the system is fully re-written for using Cylc to
@@ -78,60 +78,20 @@ if [ ! ${FLW} ]; then
   exit 1
 fi
 
-# define the workflow log
-worklog=${CLNE_ROOT}/workflow_status/${CSE}-${FLW}_workflow_status.txt 
-
-# check the number of lines
-linecount=`wc -l < ${worklog}`
-
-if [ ! -r ${worklog} ]; then
-  echo "ERROR: worfklow log ${worklog} does not exist or is not readable."
-  exit 1
-elif [ ${linecount} -eq 0 ]; then
-  echo "ERROR: workflow log ${worklog} is empty."
-  exit 1
-else
-  # grep the next task from the workflow status log
-  IFS=" " read -ra cyc_stat <<< `grep "${CYC}" ${worklog} | head -n 1`
-fi
-
-# unpack next task to boot from the status log
-tsk=${cyc_stat[1]}
-
 cmd="cd ${CLNE_ROOT}"
 echo ${cmd}; eval ${cmd}
 
-cmd="python -c 'import rocoto_utilities; rocoto_utilities.run_rocotoboot([\"${CSE}\"],[\"${FLW}\"],[\"${CYC}\"],[\"${tsk}\"])'"
-echo ${cmd}; eval ${cmd}
-
-cmd="sleep 300"
+# boot the first task of the next cycle and wait until the task is queued, with
+# the task state read directly from the rocoto database
+cmd="python -c 'import sys, rocoto_utilities;"
+cmd+=" rec = rocoto_utilities.boot_next_cycle(\"${CSE}\", \"${FLW}\", \"${CYC}\");"
+cmd+=" sys.exit(0 if rec else 1)'"
 echo ${cmd}; eval ${cmd}
+error=$?
 
-# check for an update to the workflow log with new status for job
-if [ ! -r ${worklog} ]; then
-  echo "ERROR: worfklow log ${worklog} does not exist or is not readable."
-  exit 1
-elif [ ${linecount} -eq 0 ]; then
-  echo "ERROR: workflow log ${worklog} is empty."
-  exit 1
-else
-  IFS=" " read -ra cyc_stat <<< `grep "${CYC}" ${worklog} | head -n 1`
-fi
-
-# define a regular expression to match integer patterns to check for job id
-re='^[0-9]+$'
-
-# unpack grepped line
-cycle=${cyc_stat[0]}
-task=${cyc_stat[1]}
-job_id=${cyc_stat[2]}
-
-if ! [[ ${job_id} =~ ${re} ]]; then
+if [ ${error} -ne 0 ]; then
   echo "ERROR: task did not update."
-  exit 1
-else
-  echo "Task ${task} booted for cycle ${cycle} with job id:"
-  echo "${job_id}"
+  exit ${error}
 fi
 
 echo "Script completed at `date +%Y-%m-%d_%H_%M_%S`."